@@ -22,6 +22,9 @@ setup_kwargs = {
                          'jinja2',
                          'pyyaml',
                         ],
+    'extras_require': {
+                       'keygen': ['cryptography'],  # in-process ssh key generation instead of calling ssh-keygen
+                      },
     'entry_points': '''
         [console_scripts]
         saltx=saltx:main
@@ -33,6 +33,7 @@ import logging
 import os
 import sys
 
+from . import agent
 from . import exceptionlogger
 from . import entry
 
@@ -48,17 +49,29 @@ def usage():
     print('                                    default: info')
     print('  -i, --instance <name>             choose saltx instance')
     print('                                    default: default')
+    print('  --offline                         use local vault snapshot instead of vault')
+    print('                                    (operations "update", "local", "ssh", "batch")')
+    print('  --noagent                         do not pass the operation to a running agent')
+    print('  --refresh                         recompute cached grains of the target (operation "ssh")')
     print('  <operation>                       operation to execute')
     print('  <arguments...>                    additional arguments depending on operation')
     print()
     print('Operations:')
     print('  %s initmaster                                      Prepares the local machine to provision others' % name)
     print('  %s initlocal                                       Prepares for using Saltstack locally' % name)
-    print('  %s initremote <target>                             Prepares remote machine for being provisioned' % name)    
-    print('  %s update [all|git|vault]                          Update local data' % name)
+    print('  %s initremote <target...>|@<file>                  Prepares remote machine(s) for being provisioned' % name)    
+    print('  %s [--all-instances] update [all|git|vault]        Update local data (of all instances)' % name)
+    print('  %s update vault <realm>[:<path>]...                Update selected local data from vault' % name)
     print('  %s [--noupdate] local <salt-call arguments>        Run "salt-call --local"' % name)
-    print('  %s [--noupdate] ssh <target> <salt-ssh arguments>  Run "salt-ssh"' % name)
+    print('  %s [--noupdate] [--refresh] ssh <target> <args>    Run "salt-ssh"' % name)
+    print('  %s fillkeypool [count]                             Pre-generates ssh key pairs for "initremote"' % name)
+    print('  %s targets [<prefix>|<glob>|re:<regex>]            List known targets' % name)
+    print('  %s probe [<prefix>|<glob>|re:<regex>]              Checks whether known targets are reachable via ssh' % name)
+    print('  %s results [<target>|all] [count]                  Shows changed/failed states of the latest Salt runs' % name)
     print('  %s startshell <target>                             Open ssh shell to target machine' % name)
+    print('  %s [--noupdate] batch <file>|- [workers]           Runs operations listed in a file' % name)
+    print('  %s agent [minutes|stop]                            Serves operations until idle for some minutes' % name)
+    print('  %s status                                          Shows the state of the local Saltx folder' % name)
     print('  %s unlock [minutes]                                Unlocks the local encrypted folder' % name)
     print('  %s lock                                            Locks the local encrypted folder' % name)
     print('  %s purgelocal                                      Removes the user\'s Saltx configuration' % name)
@@ -67,10 +80,18 @@ def usage():
     print('            %s initmaster' % name)
     print('            %s initlocal' % name)
     print('            %s initremote myuser@myhost.mydomain:22' % name)
+    print('            %s initremote @targets.txt' % name)
     print('            %s update' % name)
+    print('            %s --all-instances update git' % name)
+    print('            %s update vault pillar:myhost.mydomain' % name)
     print('            %s local --id testserver state.apply' % name)
     print('            %s ssh myhost.mydomain state.apply' % name)
+    print('            %s targets "web*"' % name)
+    print('            %s probe "web*"' % name)
+    print('            %s results myhost.mydomain 10' % name)
     print('            %s startshell myhost.mydomain' % name)
+    print('            %s batch operations.txt 4' % name)
+    print('            %s agent 120 &' % name)
     print()
 
 def show_usage_and_exit(text = None):
@@ -85,7 +106,7 @@ def parseopts():
     """Check and parse the command line arguments"""
     # Parse arguments using "getopt"
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'm:l:i:?', ['help', 'loglevel=', 'instance=', 'noupdate'])
+        opts, args = getopt.getopt(sys.argv[1:], 'm:l:i:?', ['help', 'loglevel=', 'instance=', 'noupdate', 'all-instances', 'offline', 'noagent', 'refresh'])
     except getopt.GetoptError as ex:
         # Print help information and exit
         show_usage_and_exit(ex) # will print something like "option -a not recognized"
@@ -112,18 +133,34 @@ def parseopts():
             instance = a.lower()
         elif o in ('--noupdate'):
             kwargs['noupdate'] = True
+        elif o == '--all-instances':
+            kwargs['all_instances'] = True
+        elif o == '--offline':
+            kwargs['offline'] = True
+        elif o == '--noagent':
+            kwargs['noagent'] = True
+        elif o == '--refresh':
+            kwargs['refresh'] = True
         else:
             assert False, 'unhandled option'
     if len(args) == 0:
         show_usage_and_exit('Welcome to saltx!')
     operation = args.pop(0)
+    if kwargs.get('all_instances') and (operation != 'update'):
+        show_usage_and_exit(f'option "--all-instances" is not supported for operation [{operation}]')
+    if kwargs.get('offline') and (operation not in ['update', 'local', 'ssh', 'batch']):
+        show_usage_and_exit(f'option "--offline" is not supported for operation [{operation}]')
+    if kwargs.get('refresh') and (operation != 'ssh'):
+        show_usage_and_exit(f'option "--refresh" is not supported for operation [{operation}]')
     if operation == 'update':
-        if len(args) > 1:
-            show_usage_and_exit(f'too many arguments for operation [{operation}]')
         if len(args) == 0:
             args = ['all']
         if args[0] not in ['all', 'git', 'vault']:
             show_usage_and_exit(f'invalid argument for operation [{operation}], only "all", "git", and "vault" allowed')
+        if (len(args) > 1) and (args[0] != 'vault'):
+            show_usage_and_exit(f'too many arguments for operation [{operation}]; filters are only supported for "vault"')
+        if (len(args) > 1) and kwargs.get('all_instances'):
+            show_usage_and_exit(f'option "--all-instances" is not supported with filters')
     elif operation == 'lock':
         if len(args) > 0:
             show_usage_and_exit(f'too many arguments for operation [{operation}]')
@@ -148,14 +185,47 @@ def parseopts():
             show_usage_and_exit(f'too many arguments for operation [{operation}]')
     elif operation == 'initremote':
         if len(args) == 0:
-            show_usage_and_exit(f'operation [{operation}] requires an argument (the target to be provisioned)')
+            show_usage_and_exit(f'operation [{operation}] requires at least one argument (the target to be provisioned)')
+    elif operation == 'fillkeypool':
+        if len(args) > 1:
+            show_usage_and_exit(f'too many arguments for operation [{operation}]')
+        if len(args) == 0:
+            args = ['20']  # set default pool size
+        if not args[0].isdigit():
+            show_usage_and_exit(f'invalid argument for operation [{operation}], a number is required')
+    elif operation == 'targets':
+        if len(args) > 1:
+            show_usage_and_exit(f'too many arguments for operation [{operation}]')
+    elif operation == 'probe':
         if len(args) > 1:
             show_usage_and_exit(f'too many arguments for operation [{operation}]')
+    elif operation == 'results':
+        if len(args) > 2:
+            show_usage_and_exit(f'too many arguments for operation [{operation}]')
+        if (len(args) == 2) and not args[1].isdigit():
+            show_usage_and_exit(f'invalid argument for operation [{operation}], a number of runs is required')
+        if (len(args) > 0) and (args[0] == 'all'):
+            args[0] = None
     elif operation == 'startshell':
         if len(args) == 0:
             show_usage_and_exit(f'operation [{operation}] requires an argument (the target to be accessed)')
         if len(args) > 1:
             show_usage_and_exit(f'too many arguments for operation [{operation}]')
+    elif operation == 'batch':
+        if len(args) == 0:
+            show_usage_and_exit(f'operation [{operation}] requires an argument (the file listing the operations)')
+        if len(args) > 2:
+            show_usage_and_exit(f'too many arguments for operation [{operation}]')
+        if (len(args) == 2) and (not args[1].isdigit() or (int(args[1]) < 1)):
+            show_usage_and_exit(f'invalid argument for operation [{operation}], a positive number of workers is required')
+    elif operation == 'agent':
+        if len(args) > 1:
+            show_usage_and_exit(f'too many arguments for operation [{operation}]')
+        if (len(args) == 1) and (args[0] != 'stop') and not args[0].isdigit():
+            show_usage_and_exit(f'invalid argument for operation [{operation}], a number or "stop" is required')
+    elif operation == 'status':
+        if len(args) > 0:
+            show_usage_and_exit(f'too many arguments for operation [{operation}]')
     else:
         show_usage_and_exit(f'provided operation [{operation}] is invalid')
     return loglevel, instance, operation, args, kwargs
@@ -165,6 +235,13 @@ def main():
     loglevel, instance, operation, args, kwargs = parseopts()
     logging.basicConfig(format='%(asctime)s %(levelname)s %(module)s: %(message)s', level=loglevel)  # use %(name)s instead of %(module) to include hierarchy information, see https://docs.python.org/2/library/logging.html
     logger = logging.getLogger(__name__)
+    # Let a running agent execute the operation so that it can reuse its state
+    if not kwargs.pop('noagent', False) and (operation in agent.agent_operations):
+        rc = agent.AgentClient(instance).run(operation, args, kwargs, loglevel)
+        if rc is not None:
+            sys.exit(rc)
+        if operation == 'status':
+            print(f'Agent: not running for instance [{instance}]')
     entry_obj = entry.Entry(instance)
     operation = getattr(entry_obj, operation)
     exceptionlogger.call(operation, *args, **kwargs, reraise_exceptions=True)
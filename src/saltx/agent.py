@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for an agent process serving Saltx operations via a unix socket and the corresponding client"""
+
+import datetime
+import fcntl
+import json
+import logging
+import os
+import pty
+import select
+import signal
+import socket
+import struct
+import sys
+import termios
+import time
+import tty
+
+from . import entry
+from . import exceptionlogger
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+agent_operations = ['update', 'local', 'ssh', 'startshell', 'targets', 'probe', 'results', 'status', 'batch']  # operations the agent can serve
+
+
+def get_socket_name(instance):
+    """Returns the filename of the agent's unix socket for the given instance"""
+    socket_dir = os.environ.get('XDG_RUNTIME_DIR', os.path.expanduser('~'))
+    return os.path.join(socket_dir, f'.saltx_agent_{instance}.sock')
+
+def send_message(conn, data):
+    """Sends a message (dictionary) as line of JSON"""
+    conn.sendall(json.dumps(data).encode() + b'\n')
+
+
+class Agent():
+
+    def __init__(self, instance, logicobj, idle_minutes=60):
+        """Object initialization"""
+        self.instance = instance
+        self.logic = logicobj  # prepared logic object (folder mounted, configuration loaded)
+        self.idle_minutes = idle_minutes  # also used as idle time of the encrypted folder's mount
+        self.socket_name = get_socket_name(instance)
+        self.time_start = datetime.datetime.now()
+        self.children = set()  # process ids of running request handlers
+        self.config_mtime = None
+
+    def get_config_mtime(self):
+        """Returns the time of the last vault update (which may change the configuration)"""
+        try:
+            return os.path.getmtime(self.logic.file_last_update_vault)
+        except FileNotFoundError:
+            return None
+
+    def prepare(self):
+        """Keeps state that is expensive to create for serving requests"""
+        self.config_mtime = self.get_config_mtime()
+        self.logic.get_target_index()
+        try:
+            self.logic.bw_session = self.logic.create_bw()
+        except SystemExit:
+            logger.warning('Vault not accessible; vault updates served by the agent will access the vault themselves')
+
+    def open_socket(self):
+        """Creates the listening unix socket (only accessible by the user)"""
+        if os.path.exists(self.socket_name):
+            if AgentClient(self.instance).connect() is not None:
+                logger.critical(f'An agent is already running for instance [{self.instance}]')
+                exit(1)
+            os.unlink(self.socket_name)  # stale socket of a terminated agent
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(self.socket_name)
+        finally:
+            os.umask(old_umask)
+        sock.listen()
+        return sock
+
+    def reap_children(self):
+        """Removes terminated request handlers"""
+        for pid in list(self.children):
+            try:
+                finished, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                finished = pid
+            if finished:
+                self.children.discard(pid)
+
+    def is_peer_allowed(self, conn):
+        """Returns whether the connected process belongs to our user"""
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+        return uid == os.getuid()
+
+    def ensure_folder_mounted(self):
+        """Mounts the encrypted folder again if it was unmounted meanwhile (e.g. by "saltx lock")"""
+        if self.logic.is_folder_available():
+            return
+        logger.info('Saltx folder is no longer mounted; mounting it again')
+        self.logic.prepared = False
+        self.logic.prepare_folder_config(unlock_allow_other=True, unlock_minutes=self.idle_minutes)
+
+    def serve(self):
+        """Serves requests until no request was received for the idle time"""
+        idle_minutes = self.idle_minutes
+        self.prepare()
+        sock = self.open_socket()
+        sock.settimeout(5)
+        logger.info(f'Agent for instance [{self.instance}] listening on [{self.socket_name}]; exiting after [{idle_minutes}] idle minutes')
+        time_last_activity = time.monotonic()
+        try:
+            while True:
+                self.reap_children()
+                if len(self.children):
+                    time_last_activity = time.monotonic()
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    if time.monotonic() - time_last_activity > idle_minutes * 60:
+                        logger.info('Agent idle; exiting')
+                        break
+                    continue
+                time_last_activity = time.monotonic()
+                with conn:
+                    if not self.is_peer_allowed(conn):
+                        logger.warning('Rejecting request of another user')
+                        continue
+                    try:
+                        data, fds, _, _ = socket.recv_fds(conn, 65536, 3)
+                        request = json.loads(data)
+                    except (OSError, ValueError) as e:
+                        logger.warning(f'Invalid agent request [{e}]')
+                        continue
+                    if request.get('operation') == 'stop':
+                        for fd in fds:
+                            os.close(fd)
+                        send_message(conn, { 'rc': 0 })
+                        logger.info('Agent stop requested; exiting')
+                        break
+                    try:
+                        self.ensure_folder_mounted()
+                    except SystemExit:
+                        for fd in fds:
+                            os.close(fd)
+                        send_message(conn, { 'rc': 1 })
+                        continue
+                    # Reload configuration if a vault update might have changed it
+                    if self.get_config_mtime() != self.config_mtime:
+                        self.config_mtime = self.get_config_mtime()
+                        self.logic.prepare_config()
+                    pid = os.fork()
+                    if pid == 0:
+                        sock.close()
+                        self.handle_request(conn, request, fds)  # does not return
+                    self.children.add(pid)
+                    for fd in fds:
+                        os.close(fd)
+        except KeyboardInterrupt:
+            logger.info('Agent interrupted; exiting')
+        finally:
+            sock.close()
+            os.unlink(self.socket_name)
+
+    def handle_request(self, conn, request, fds):
+        """Handles a request in a forked process using the client's terminal"""
+        rc = 1
+        try:
+            # Use the client's stdin/stdout/stderr in an own session so that the client can forward Ctrl-C
+            for i, fd in enumerate(fds):
+                os.dup2(fd, i)
+                os.close(fd)
+            os.setsid()
+            if os.isatty(0):
+                # Pseudo terminal of the client: make it our controlling terminal with us in the foreground (needed for prompts and "ssh -t")
+                try:
+                    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+                    os.tcsetpgrp(0, os.getpgrp())
+                except OSError as e:
+                    logger.debug(f'Could not acquire terminal of client [{e}]')
+            send_message(conn, { 'pid': os.getpid() })
+            if os.path.isdir(request.get('cwd', '')):
+                os.chdir(request['cwd'])
+            logging.getLogger().setLevel(request.get('loglevel', logging.INFO))
+            rc = self.execute(request)
+        except Exception as e:
+            logger.error(f'Handling agent request failed [{e}]')
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            try:
+                send_message(conn, { 'rc': rc })
+            except OSError:
+                pass  # client is gone
+            os._exit(rc)  # skip the agent's exit handlers
+
+    def execute(self, request):
+        """Executes the requested operation and returns its exit code"""
+        operation = request.get('operation')
+        if operation not in agent_operations:
+            logger.error(f'Operation [{operation}] is not served by the agent')
+            return 2
+        if operation == 'status':
+            print(f'Agent: process [{os.getppid()}], instance [{self.instance}], running since [{self.time_start:%Y-%m-%d %H:%M:%S}], vault session [{'yes' if self.logic.bw_session is not None else 'no'}]')
+        entry_obj = entry.Entry(self.instance, logicobj=self.logic)
+        try:
+            exceptionlogger.call(getattr(entry_obj, operation), *request.get('args', []), **request.get('kwargs', dict()), reraise_exceptions=True)
+            rc = 0
+        except SystemExit as e:
+            rc = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except KeyboardInterrupt:
+            rc = 130
+        except Exception:
+            rc = 1
+        finally:
+            self.logic.cleanup()
+            metrics_file = self.logic.cfg.get_item('general.metrics_file')
+            if metrics_file is not None:
+                metrics.registry.write_textfile(metrics_file)
+        return rc
+
+
+class AgentClient():
+
+    def __init__(self, instance):
+        """Object initialization"""
+        self.instance = instance
+        self.socket_name = get_socket_name(instance)
+
+    def connect(self):
+        """Connects to the agent; returns None if no agent is running"""
+        if not os.path.exists(self.socket_name):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_name)
+        except (ConnectionRefusedError, FileNotFoundError):
+            sock.close()
+            return None
+        return sock
+
+    @staticmethod
+    def parse_messages(buffer):
+        """Returns the complete messages in the given buffer and the remaining data"""
+        messages = []
+        while b'\n' in buffer:
+            line, _, buffer = buffer.partition(b'\n')
+            messages.append(json.loads(line))
+        return messages, buffer
+
+    def receive_messages(self, sock):
+        """Yields the messages received from the agent; Ctrl-C is forwarded to the request handler"""
+        buffer = b''
+        pgid = None
+        while True:
+            try:
+                data = sock.recv(4096)
+            except KeyboardInterrupt:
+                if pgid is not None:
+                    os.killpg(pgid, signal.SIGINT)
+                continue
+            if not data:
+                return
+            messages, buffer = self.parse_messages(buffer + data)
+            for message in messages:
+                if 'pid' in message:
+                    pgid = message['pid']
+                yield message
+
+    @staticmethod
+    def copy_window_size(master):
+        """Copies the window size of our terminal to the pseudo terminal (which signals SIGWINCH to its processes)"""
+        try:
+            fcntl.ioctl(master, termios.TIOCSWINSZ, fcntl.ioctl(1, termios.TIOCGWINSZ, b'\0' * 8))
+        except OSError:
+            pass
+
+    def relay_terminal(self, sock, master):
+        """Relays between our terminal and the pseudo terminal of the request handler; returns the exit code"""
+        attributes = termios.tcgetattr(0)
+        previous_handler = signal.signal(signal.SIGWINCH, lambda signum, frame: self.copy_window_size(master))
+        tty.setraw(0)  # keys like Ctrl-C are passed on and handled by the pseudo terminal
+        buffer = b''
+        rc = None
+        master_open = True
+        inputs = [sock, master, 0]
+        try:
+            while master_open:
+                readable, _, _ = select.select(inputs, [], [], 0.2)
+                if (rc is not None) and not readable:
+                    break  # handler finished and no further output
+                if master in readable:
+                    try:
+                        data = os.read(master, 65536)
+                    except OSError:
+                        data = b''  # EIO: all processes using the pseudo terminal terminated
+                    if not data:
+                        master_open = False
+                    while data:
+                        data = data[os.write(1, data):]
+                if 0 in readable:
+                    data = os.read(0, 4096)
+                    if data:
+                        os.write(master, data)
+                    else:
+                        inputs.remove(0)  # our terminal is gone
+                if sock in readable:
+                    data = sock.recv(4096)
+                    if not data:
+                        if rc is None:
+                            rc = 1
+                            master_open = False
+                            logger.error('Connection to agent lost')
+                        continue
+                    messages, buffer = self.parse_messages(buffer + data)
+                    for message in messages:
+                        if 'rc' in message:
+                            rc = message['rc']
+        finally:
+            termios.tcsetattr(0, termios.TCSADRAIN, attributes)
+            signal.signal(signal.SIGWINCH, previous_handler)
+            os.close(master)
+        return 1 if (rc is None) else rc
+
+    def run(self, operation, args, kwargs, loglevel=logging.INFO):
+        """Lets the agent execute the operation using our terminal; returns the exit code or None if no agent is running"""
+        sock = self.connect()
+        if sock is None:
+            return None
+        logger.debug(f'Passing operation [{operation}] to agent [{self.socket_name}]')
+        with sock:
+            request = { 'operation': operation, 'args': list(args), 'kwargs': kwargs, 'cwd': os.getcwd(), 'loglevel': loglevel }
+            if os.isatty(0) and os.isatty(1):
+                # Pass a pseudo terminal so that the handler can have a controlling terminal of its own
+                master, slave = pty.openpty()
+                termios.tcsetattr(slave, termios.TCSANOW, termios.tcgetattr(0))
+                self.copy_window_size(master)
+                socket.send_fds(sock, [json.dumps(request).encode() + b'\n'], [slave, slave, slave if os.isatty(2) else 2])
+                os.close(slave)
+                return self.relay_terminal(sock, master)
+            socket.send_fds(sock, [json.dumps(request).encode() + b'\n'], [0, 1, 2])
+            for message in self.receive_messages(sock):
+                if 'rc' in message:
+                    return message['rc']
+        logger.error('Connection to agent lost')
+        return 1
+
+    def stop(self):
+        """Asks the agent to exit"""
+        sock = self.connect()
+        if sock is None:
+            logger.info(f'No agent running for instance [{self.instance}]')
+            return False
+        with sock:
+            send_message(sock, { 'operation': 'stop' })
+            for message in self.receive_messages(sock):
+                if 'rc' in message:
+                    logger.info('Agent stopped')
+                    return True
+        return False
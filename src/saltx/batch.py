@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""Class for running a list of Saltx operations read from a file"""
+
+import concurrent.futures
+import logging
+import shlex
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+batch_operations = ['local', 'ssh', 'targets']  # operations allowed in a batch file
+
+
+class Batch():
+
+    def __init__(self):
+        """Object initialization"""
+        self.commands = []  # list of tuples (line, operation, arguments)
+        self.results = []  # list of tuples (line, exit code, duration in seconds, note) in order of the commands
+        self.excluded = dict()  # index of command -> reason for not running it
+
+    def read(self, filename):
+        """Reads the operations from the given file ("-" for stdin); returns success"""
+        try:
+            if filename == '-':
+                lines = sys.stdin.read().splitlines()
+            else:
+                with open(filename, 'r') as f:
+                    lines = f.read().splitlines()
+        except OSError as e:
+            logger.error(f'Could not read batch file [{filename}] [{e}]')
+            return False
+        ok = True
+        for number, line in enumerate(lines, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                parts = shlex.split(line)
+            except ValueError as e:
+                logger.error(f'Invalid line [{number}] in batch file [{e}]')
+                ok = False
+                continue
+            if parts[0] == 'saltx':
+                parts.pop(0)
+            if not parts or (parts[0] not in batch_operations):
+                logger.error(f'Invalid operation in line [{number}] of batch file; allowed: {", ".join(batch_operations)}')
+                ok = False
+                continue
+            if (parts[0] == 'ssh') and (len(parts) < 2):
+                logger.error(f'Missing target in line [{number}] of batch file')
+                ok = False
+                continue
+            self.commands.append((line, parts[0], parts[1:]))
+        return ok
+
+    def has_operation(self, operation):
+        """Returns whether the batch contains the given operation"""
+        return any([command[1] == operation for command in self.commands])
+
+    def get_targets(self, operation='ssh'):
+        """Returns the targets of the commands with the given operation"""
+        return list(dict.fromkeys([args[0] for _, command_operation, args in self.commands if command_operation == operation]))
+
+    def exclude_targets(self, targets, reason, operation='ssh'):
+        """Excludes the commands with the given operation for the given targets from running"""
+        for index, (_, command_operation, args) in enumerate(self.commands):
+            if (command_operation == operation) and (args[0] in targets):
+                self.excluded[index] = reason
+
+    def run_command(self, func, operation, args):
+        """Runs a single command and returns its exit code and duration"""
+        time_start = time.monotonic()
+        try:
+            func(operation, args)
+            rc = 0
+        except SystemExit as e:
+            rc = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception as e:
+            logger.error(f'Operation [{operation}] failed [{e}]')
+            rc = 1
+        return rc, time.monotonic() - time_start
+
+    def run(self, func, max_workers=1):
+        """Runs all commands using the given function (called with operation and arguments); returns whether all succeeded"""
+        logger.info(f'Running [{len(self.commands)}] operations with up to [{max_workers}] in parallel...')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [None if (index in self.excluded) else executor.submit(self.run_command, func, operation, args)
+                       for index, (line, operation, args) in enumerate(self.commands)]
+        self.results = [(command[0], 1, 0.0, self.excluded[index]) if (future is None) else (command[0], *future.result(), '')
+                        for index, (command, future) in enumerate(zip(self.commands, futures))]
+        return all([rc == 0 for _, rc, _, _ in self.results])
+
+    def print_results(self):
+        """Prints a table with exit code and duration of each command"""
+        width = max([len(line) for line, _, _, _ in self.results] + [len('Operation')])
+        print()
+        print(f'{"#":>3}  {"Operation":<{width}}  {"Exit":>4}  {"Duration":>9}')
+        for number, (line, rc, duration, note) in enumerate(self.results, start=1):
+            print(f'{number:>3}  {line:<{width}}  {rc:>4}  {duration:>8.1f}s  {note}'.rstrip())
+        failed = len([rc for _, rc, _, _ in self.results if rc != 0])
+        print(f'{len(self.results)} operations, {failed} failed')
@@ -3,19 +3,109 @@
 """Class for accessing a Bitwarden/Vaultwarden vault using the bwinterface module"""
 
 import bwinterface
+import inspect
+import json
 import logging
+import threading
+import time
+
+from . import metrics
 
 
 logger = logging.getLogger(__name__)
 
 
+class CallBudgetExceededError(Exception):
+    """Raised if more calls of the Bitwarden CLI are made than allowed"""
+
+
+class InstrumentedBWInterface():
+    """Wrapper around a BWInterface object recording number and duration of calls"""
+
+    def __init__(self, bw, max_calls=None):
+        """Object initialization"""
+        self._bw = bw
+        self.max_calls = max_calls  # maximum number of calls since last budget reset (None for unlimited)
+        self.calls = 0  # number of calls since last budget reset
+        self.durations = dict()  # method name -> list of call durations since last budget reset
+        self.lock = threading.Lock()  # calls are made from multiple threads
+
+    def reset_budget(self):
+        """Starts counting calls against the budget and recording their durations anew"""
+        with self.lock:
+            self.calls = 0
+            self.durations = dict()
+
+    def check_budget(self, name):
+        """Counts a call and fails if the budget is exceeded"""
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        if (self.max_calls is not None) and (calls > self.max_calls):
+            raise CallBudgetExceededError(f'Calling [{name}] exceeds the budget of [{self.max_calls}] Bitwarden CLI calls')
+
+    def record(self, name, duration):
+        """Records the duration of a call"""
+        with self.lock:
+            self.durations.setdefault(name, []).append(duration)
+        metrics.registry.observe('bw_call_duration_seconds', duration, { 'method': name })
+
+    def __getattr__(self, name):
+        """Returns the attribute of the wrapped object; calls are recorded"""
+        if isinstance(inspect.getattr_static(type(self._bw), name, None), property):
+            # Properties of BWInterface call the Bitwarden CLI as well
+            self.check_budget(name)
+            time_start = time.monotonic()
+            try:
+                return getattr(self._bw, name)
+            finally:
+                self.record(name, time.monotonic() - time_start)
+        attr = getattr(self._bw, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.check_budget(name)
+            time_start = time.monotonic()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.record(name, time.monotonic() - time_start)
+
+        return call
+
+    def get_stats(self):
+        """Returns call statistics per method, highest total duration first"""
+        stats = []
+        with self.lock:
+            durations_by_name = { name: list(durations) for name, durations in self.durations.items() }
+        for name, durations in durations_by_name.items():
+            stats.append({ 'method': name, 'calls': len(durations), 'total': sum(durations), 'mean': sum(durations) / len(durations), 'max': max(durations) })
+        return sorted(stats, key=lambda entry: entry['total'], reverse=True)
+
+    def log_stats(self):
+        """Logs the call statistics at debug level"""
+        for entry in self.get_stats():
+            logger.debug(f'Bitwarden CLI [{entry['method']}]: {entry['calls']} calls, {entry['total']:.2f}s total, {entry['mean']:.2f}s mean, {entry['max']:.2f}s max')
+
+    def dump_stats(self, filename):
+        """Writes the call statistics to a file in JSON format"""
+        try:
+            with open(filename, 'w') as f:
+                json.dump(self.get_stats(), f, indent=2)
+        except OSError as e:
+            logger.error(f'Writing Bitwarden CLI call statistics to [{filename}] failed [{e}]')
+            return False
+        return True
+
+
 class BWVault():
     
-    def __init__(self, bw_params, bw_server, bw_clientid, bw_clientsecret, bw_password, bw_org):
+    def __init__(self, bw_params, bw_server, bw_clientid, bw_clientsecret, bw_password, bw_org, max_calls=None):
         """Object initialization"""
-        self.bw = bwinterface.BWInterface(**bw_params)
+        self.bw = InstrumentedBWInterface(bwinterface.BWInterface(**bw_params), max_calls=max_calls)
         status = self.bw.get_status()
-        if status.rc != 0:
+        if not self.check_result('get_status', status):
             logger.critical('Get status failed')
             exit(1)
         status = status.data
@@ -23,32 +113,57 @@ class BWVault():
             self.bw.set_config_server(bw_server)
         if status.get('status') == 'unauthenticated':
             result = self.bw.login_apikey(bw_clientid, bw_clientsecret)
-            if result.rc != 0:
+            if not self.check_result('login_apikey', result):
                 logger.critical('Login to vault failed')
                 exit(1)
         result = self.bw.sync()
-        if result.rc != 0:
+        self.synced = self.check_result('sync', result)
+        if not self.synced:
             logger.warn('Sync failed. Continuing with locally cached data.')        
         result = self.bw.unlock(bw_password)
-        if result.rc != 0:
+        if not self.check_result('unlock', result):
             logger.critical('Unlocking vault failed')
             exit(1)
         self.bw_org = bw_org
+        self.offline = False
+
+    def check_result(self, method, result):
+        """Returns whether a call of the Bitwarden CLI was successful and counts failures"""
+        if result.rc != 0:
+            metrics.registry.inc('bw_call_failures_total', { 'method': method })
+            return False
+        return True
 
     def is_org_present(self):
         """Returns whether our organization is already present in the vault"""
         return self.bw_org in self.bw.organizations_asdictbyname
 
+    def reset_call_budget(self):
+        """Starts counting Bitwarden CLI calls against the budget anew"""
+        self.bw.reset_budget()
+
+    def log_call_stats(self):
+        """Logs the Bitwarden CLI call statistics at debug level"""
+        self.bw.log_stats()
+
+    def dump_call_stats(self, filename):
+        """Writes the Bitwarden CLI call statistics to a file in JSON format"""
+        return self.bw.dump_stats(filename)
+
+    def get_all_items(self):
+        """Returns a dictionary of all items of our organization"""
+        return self.bw.get_items_asdictbyname(organization=self.bw_org)
+
     def get_items(self, realm):
         """Returns a dictionary of items for the given realm"""
-        items = self.bw.get_items_asdictbyname(organization=self.bw_org)
+        items = self.get_all_items()
         items = { key: value for key, value in items.items() if key.startswith(f'{realm}:')}
         return items
 
     def create_item(self, name, collection, data):
         """Creates an item with the given data"""
         result = self.bw.create_item(name, username='', password='', organization=self.bw_org, collection=collection, notes=data)
-        return result.rc == 0
+        return self.check_result('create_item', result)
 
     def get_item(self, name):
         """Returns the data of an item"""
@@ -60,25 +175,29 @@ class BWVault():
     def update_item(self, itemid, data):
         """Updates an item with the given identifier"""
         result = self.bw.edit_item(itemid, organization=self.bw_org, notes=data)
-        return result.rc == 0
+        return self.check_result('edit_item', result)
 
     def delete_item(self, itemid):
         """Deletes an item with the given identifier"""
         result = self.bw.delete_item(itemid)
-        return result.rc == 0
+        return self.check_result('delete_item', result)
+
+    def get_all_collections(self):
+        """Returns a dictionary of all collections of our organization"""
+        return self.bw.get_collections_asdictbyname(organization=self.bw_org)
 
     def get_collections(self, realm):
         """Returns a dictionary of collections for the given realm"""
-        collections = self.bw.get_collections_asdictbyname(organization=self.bw_org)
+        collections = self.get_all_collections()
         collections = { key: value for key, value in collections.items() if key.startswith(f'{realm}:')}
         return collections
 
     def create_collection(self, name):
         """Creates a collection with the given name"""
         result = self.bw.create_collection(name, organization=self.bw_org)
-        return result.rc == 0
+        return self.check_result('create_collection', result)
 
     def delete_collection(self, name):
         """Deletes the collection with the given name"""
         result = self.bw.delete_collection(name, organization=self.bw_org)
-        return result.rc == 0
+        return self.check_result('delete_collection', result)
@@ -29,7 +29,7 @@ class Configuration():
         """Object initialization"""
         self._default = yamlconfig.YAMLConfig(filename='')
         self._etc = yamlconfig.YAMLConfig(filename=filename_etc)
-        self._instance = yamlconfig.YAMLConfig(filename=filename_instance)
+        self._instance = yamlconfig.YAMLConfig(filename=kw.get('filename_instance', filename_instance))
         self._user = yamlconfig.YAMLConfig(filename=filename_user)
         self.instance = kw['instance']
 
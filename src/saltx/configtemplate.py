@@ -17,6 +17,10 @@ config_template = r'''
       # If not set to true or false, the user is asked.
       # auto_download_bw:
 
+      # Directory for caching downloads (e.g. the Bitwarden CLI tool); files are named by their SHA-256 digest
+      # Defaults to "/var/cache/saltx" if writable, "~/.cache/saltx" otherwise
+      # download_cache_dir:
+
       # Define whether Git shall be installed automatically
       # If not set to true or false, the user is asked.
       # auto_install_git:
@@ -25,6 +29,58 @@ config_template = r'''
       # If not set to true or false, the user is asked.
       # auto_install_salt:
 
+      # Keep the encrypted Saltx folder mounted after the last Saltx process finished (until the EncFS idle timeout)
+      # This avoids mounting the folder again for each command. If false, the process that mounted the folder unmounts it
+      # when it is the last one using it. A mount created by "saltx unlock" is never unmounted by other processes.
+      # keep_mounted: true
+
+      # Lazily unmount the encrypted Saltx folder on exit if it is still busy after retrying
+      # lazy_unmount: false
+
+      # Type of ssh keys created for target hosts (ed25519, ecdsa, or rsa)
+      # ssh_key_type: ed25519
+
+      # Maximum number of hosts prepared concurrently with "saltx initremote" for multiple targets
+      # ssh_max_workers: 10
+
+      # Before running salt-ssh, check whether targets are reachable by opening a TCP connection to their ssh port
+      # Unreachable targets are reported (and skipped in batches) instead of running into the ssh timeout.
+      # Results are cached for "probe_cache_ttl" seconds. Set "probe_timeout" (seconds) to 0 to disable probing.
+      # probe_timeout: 2
+      # probe_cache_ttl: 30
+      # probe_max_workers: 500
+
+      # Copy the private data into RAM-backed storage (tmpfs) for running Salt so that file access does not go through EncFS
+      # Changed files are synced back and the copy is wiped on exit.
+      # ram_working_set: false
+      # ram_working_set_dir: /dev/shm  # defaults to $XDG_RUNTIME_DIR, otherwise /dev/shm
+
+      # Write metrics of each run (durations, changed items, failures) to this file in Prometheus text format
+      # Example: metrics_file: /var/lib/prometheus/node-exporter/saltx_myuser.prom
+      # metrics_file:
+
+      # Capture the results of state runs ("saltx local"/"saltx ssh" with state.apply etc.) as JSON in "~/saltx/results/<target>"
+      # Salt is then called with "--out=json" and Saltx prints the results including changes (see "saltx results").
+      # capture_results: true
+      # results_keep: 20  # number of runs kept per target
+
+      # Maximum number of instances updated concurrently with "saltx --all-instances update"
+      # max_workers: 4
+
+      # Settings for the generated Salt master/minion configuration (regenerated automatically on changes)
+      # Enabling the pillar cache makes vault updates visible only after the pillar cache TTL.
+      # salt:
+      #   ssh_max_procs: 25
+      #   worker_threads: 5
+      #   pillar_cache: false
+      #   pillar_cache_ttl: 3600
+      #   grains_cache_expiration: 300
+      #   ssh_cache_life: 60  # minutes the grains of salt-ssh targets are reused ("saltx ssh --refresh" forces recomputation)
+      #   fileserver_list_cache_time: 20
+      #   ssh_minion_opts: {}
+      #   master_opts: {}  # additional master options
+      #   minion_opts: {}  # additional minion options
+
     # Section with per instance configuration
     instances:
         
@@ -38,6 +94,11 @@ config_template = r'''
           # Path to the Bitwarden CLI tool
           # cli: ~/.local/bin/bw
 
+          # URL and SHA-256 digest of the Bitwarden CLI tool archive for automatic download
+          # The download is verified against the digest if given.
+          # download_url: https://github.com/bitwarden/clients/releases/download/cli-v2024.9.0/bw-linux-2024.9.0.zip
+          # download_sha256:
+
           # URL for accessing the Bitwarden/Vaultwarden server
           # Example; server: https://vaultwarden.mydomain.com
           # server:
@@ -58,6 +119,30 @@ config_template = r'''
           # print_indent: 2
           # print_resultdata: false
 
+          # Use the local vault snapshot (updated on each vault sync) if the vault server is not reachable
+          # offline_fallback: true
+
+          # Abort a vault sync if it needs more than this number of Bitwarden CLI calls
+          # max_calls: 1000
+
+          # Write number and duration of Bitwarden CLI calls of the last vault sync to this file (JSON format)
+          # call_stats_file: ~/saltx/bw_call_stats.json
+
+          # Store files larger than the threshold (characters) compressed in the "Notes" field (zlib, base64-encoded)
+          # Other Bitwarden/Vaultwarden clients show such Items as encoded text; smaller files stay plain text.
+          # By default, only files that would not fit into the "Notes" field as plain text are compressed.
+          # compress: false
+          # compress_threshold: 10000  # defaults to max_notes_size
+
+          # Maximum size of the "Notes" field configured on the server
+          # max_notes_size: 10000
+
+          # Store files too large for the "Notes" field of one Item in several chunk Items (named "<item>//<hash>")
+          # Only enable if all users of the Organization use a Saltx version supporting this.
+          # Chunk Items are created/deleted using this number of concurrent Bitwarden CLI calls.
+          # chunking: false
+          # chunk_workers: 1
+
         # Define folder for public data (folder for Git repository)
         # folder_public: ~/saltx/public
         
@@ -81,11 +166,33 @@ config_template = r'''
           # Access token (needed permissions: read_api, read_repository, read_registry)
           # Example: token: aaaaa-bbbbbbb-cccccccccccc
           # token:
+
+          # Limit history depth of the local clone (shallow clone; pulls keep this depth and only fast-forward)
+          # Example: depth: 1
+          # depth:
+
+          # Object filter for a partial clone (file contents are fetched on demand)
+          # Example: filter: blob:none
+          # filter:
+
+          # Only check out the given paths of the repository (sparse checkout)
+          # Example: sparse_paths:
+          #            - state/myproject
+          #            - pillar/myproject
+          # sparse_paths:
         
         # Enable if the user shall not be asked what to do with the local copy
         # If everything is enabled, vault is always leading. But be careful with automatic deletion as any local changes will get lost.
         # auto_create_locally: false
         # auto_update_locally: false
         # auto_delete_locally: false              
+
+        # How to ask what to do with differences between local copy and vault
+        # "item": ask for each item; "table": show all differences in one table and decide using bulk rules
+        # conflict_resolution: item
+
+        # Decide on differences without asking using the rules in this file (e.g. saved from the table)
+        # Example: conflict_policy: ~/saltx/conflict_policy.yaml
+        # conflict_policy:
     '''
 config_template = textwrap.dedent(config_template).lstrip()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""Class for rules deciding on differences between local files and vault items without asking per item"""
+
+import fnmatch
+import logging
+import os
+import yaml
+
+
+logger = logging.getLogger(__name__)
+actions = ['to-file', 'to-vault', 'newest', 'default', 'skip']  # possible decisions of a rule
+
+
+class ConflictPolicy():
+
+    def __init__(self, default='default', collections=None, items=None):
+        """Object initialization"""
+        self.default = default  # action for differences not matched by other rules
+        self.collections = dict() if (collections is None) else collections  # collection name or glob -> action
+        self.items = dict() if (items is None) else items  # item name -> action
+
+    def load(self, filename):
+        """Loads the rules from the given YAML file; returns success"""
+        try:
+            with open(os.path.expanduser(filename), 'r') as f:
+                data = yaml.load(f, Loader=yaml.SafeLoader)
+        except (OSError, yaml.YAMLError) as e:
+            logger.error(f'Could not read conflict policy [{filename}] [{e}]')
+            return False
+        data = data if isinstance(data, dict) else dict()
+        self.default = data.get('default', 'default')
+        self.collections = data.get('collections') or dict()
+        self.items = data.get('items') or dict()
+        invalid = [action for action in [self.default, *self.collections.values(), *self.items.values()] if action not in actions]
+        if len(invalid):
+            logger.error(f'Invalid actions {invalid} in conflict policy [{filename}]; allowed: {", ".join(actions)}')
+            return False
+        return True
+
+    def save(self, filename):
+        """Saves the rules to the given YAML file; returns success"""
+        data = { 'default': self.default, 'collections': self.collections, 'items': self.items }
+        try:
+            with open(os.path.expanduser(filename), 'w') as f:
+                yaml.dump(data, f, default_flow_style=False, sort_keys=False)
+        except OSError as e:
+            logger.error(f'Could not write conflict policy [{filename}] [{e}]')
+            return False
+        return True
+
+    def get_action(self, conflict):
+        """Returns the action for the given difference; item rules take precedence over the last matching collection rule"""
+        action = self.items.get(conflict['item'])
+        if action is not None:
+            return action
+        for pattern, action in reversed(self.collections.items()):
+            if fnmatch.fnmatchcase(conflict['collection'], pattern):
+                return action
+        return self.default
+
+    def decide(self, conflict):
+        """Returns the decision for the given difference (True: mirror to file, False: mirror to vault, None: skip)"""
+        action = self.get_action(conflict)
+        if action == 'to-file':
+            return True
+        if action == 'to-vault':
+            return False
+        if action == 'skip':
+            return None
+        if (action == 'newest') and (conflict['kind'] == 'update'):
+            return conflict['file_mtime'] < conflict['item_mtime']
+        return conflict['default']  # also for "newest" if only one side exists
+
+    def apply(self, conflicts):
+        """Sets the decision for all given differences"""
+        for conflict in conflicts:
+            conflict['sync_to_file'] = self.decide(conflict)
+            logger.info(f'Conflict policy: [{conflict['item']}] {self.describe(conflict)}')
+
+    @staticmethod
+    def describe(conflict):
+        """Returns a description of the decision for the given difference"""
+        sync_to_file = conflict['sync_to_file']
+        if sync_to_file is None:
+            return 'skipped'
+        if conflict['kind'] == 'onlyfile':
+            return 'delete local file' if sync_to_file else 'create in vault'
+        if conflict['kind'] == 'onlyvault':
+            return 'create local file' if sync_to_file else 'delete in vault'
+        return 'update local file' if sync_to_file else 'update vault'
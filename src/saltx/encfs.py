@@ -3,6 +3,8 @@
 """Class for interacting with the EncFS tool"""
 
 import atexit
+import contextlib
+import fcntl
 import logging
 import os
 import time
@@ -18,6 +20,8 @@ class EncFS():
     def __init__(self, queryuserobj):
         """Object initialization"""
         self.mounted = False
+        self.leased = False
+        self.created_mount = False  # whether this process mounted the folder (a reused mount is never unmounted)
         self.folder_decrypted = None
         self.queryuserobj = queryuserobj
         
@@ -66,24 +70,153 @@ class EncFS():
         self.mounted = (rc == 0)
         return self.mounted
 
-    def unmount(self, folder_decrypted=None, force=False):
-        """Unmount previously mounted folder"""
+    @staticmethod
+    def get_busy_holders(folder):
+        """Returns a list of tuples (process id, process name) of local processes using files within the given folder"""
+        folder = os.path.realpath(folder)
+
+        def is_within_folder(path):
+            return (path == folder) or path.startswith(folder + os.path.sep)
+
+        holders = []
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit() or (int(pid) == os.getpid()):
+                continue
+            links = [os.path.join('/proc', pid, 'cwd'), os.path.join('/proc', pid, 'root')]
+            try:
+                fd_dir = os.path.join('/proc', pid, 'fd')
+                links.extend([os.path.join(fd_dir, fd) for fd in os.listdir(fd_dir)])
+            except OSError:
+                pass  # process terminated or belongs to another user
+            for link in links:
+                try:
+                    if is_within_folder(os.readlink(link)):
+                        break
+                except OSError:
+                    continue
+            else:
+                continue
+            try:
+                with open(os.path.join('/proc', pid, 'comm'), 'r') as f:
+                    name = f.read().strip()
+            except OSError:
+                name = '?'
+            holders.append((int(pid), name))
+        return holders
+
+    def unmount(self, folder_decrypted=None, force=False, timeout=10, lazy_fallback=False):
+        """Unmount previously mounted folder; retries with exponential backoff while the folder is busy"""
         if folder_decrypted is None:
             folder_decrypted = self.folder_decrypted
         if not self.mounted and not force:
             logger.warn(f'Skipping attempt to unmount folder [{folder_decrypted}] that has not been successfully mounted before')
             return False
-        rc, _, err = setupenv.run_process(f'fusermount -u {folder_decrypted}')
-        if 'busy' in err:
-            # Handle the case that attempt to unmount happens too early after mount
-            logger.info('Retrying to unmount...')
-            time.sleep(1)
-            rc, _, err = setupenv.run_process(f'fusermount -u {folder_decrypted}')
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        while True:
+            rc, _, err = setupenv.run_process(f'fusermount -u {folder_decrypted}', print_stderr=False)
+            if (rc == 0) or ('busy' not in err):
+                break
+            # Handle the case that the folder is still in use (e.g. attempt to unmount happens too early after mount)
+            if time.monotonic() + delay > deadline:
+                break
+            logger.debug(f'Folder [{folder_decrypted}] is busy; retrying to unmount in [{delay}] seconds...')
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+        if (rc != 0) and ('busy' in err):
+            holders = self.get_busy_holders(folder_decrypted)
+            holders_text = ', '.join([f'{name} ({pid})' for pid, name in holders]) if len(holders) else 'unknown'
+            logger.warning(f'Folder [{folder_decrypted}] is still busy; used by processes: {holders_text}')
+            if lazy_fallback is None:
+                lazy_fallback = self.queryuserobj.get_lazy_unmount(folder_decrypted)
+            if lazy_fallback:
+                logger.info(f'Lazily unmounting folder [{folder_decrypted}]; it is detached now and unmounted once no longer in use')
+                rc, _, err = setupenv.run_process(f'fusermount -u -z {folder_decrypted}', print_stderr=False)
         if rc == 0:
             self.mounted = False
+        else:
+            logger.error(f'Unmounting folder [{folder_decrypted}] failed [{err.strip()}]')
         return rc == 0
-    
+
     def register_auto_unmount(self):
         """Registers unmounting of encrypted folder on program exit"""
         atexit.register(self.unmount)
-        
\ No newline at end of file
+
+    @staticmethod
+    def get_lease_filename(decr_path):
+        """Returns the name of the file keeping track of the processes using a mounted folder"""
+        return decr_path.rstrip(os.path.sep) + '.lease'
+
+    @staticmethod
+    def is_process_alive(pid):
+        """Returns whether a process with the given process id exists"""
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass  # process exists but belongs to another user
+        return True
+
+    @contextlib.contextmanager
+    def lease_holders(self, decr_path):
+        """Locks the lease file and provides the set of process ids holding a lease; changes are written back"""
+        filename = self.get_lease_filename(decr_path)
+        descriptor = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+        with open(descriptor, 'r+') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)  # released when the file is closed
+            holders = { int(line) for line in file.read().split() if line.isdigit() }
+            # Drop leases of processes that terminated without releasing them
+            holders = { pid for pid in holders if self.is_process_alive(pid) }
+            yield holders
+            file.seek(0)
+            file.truncate()
+            file.write(''.join([f'{pid}\n' for pid in sorted(holders)]))
+
+    def acquire_lease(self, encr_path, decr_path, minutes, allow_other=False):
+        """Makes sure the encrypted folder is mounted (reusing an existing mount) and registers this process as user"""
+        # Register first so that the folder is not unmounted by others meanwhile; the lease file is only locked briefly
+        with self.lease_holders(decr_path) as holders:
+            holders.add(os.getpid())
+            self.leased = True
+            self.folder_decrypted = decr_path
+        # Mounting may ask for the password; only processes that need to mount as well wait for it
+        with open(os.open(decr_path.rstrip(os.path.sep) + '.mountlock', os.O_RDWR | os.O_CREAT, 0o600)) as file:
+            fcntl.flock(file, fcntl.LOCK_EX)  # released when the file is closed
+            if os.path.ismount(decr_path):
+                logger.debug(f'Reusing existing mount [{decr_path}]')
+                self.mounted = True
+            elif self.mount(encr_path, decr_path, minutes, allow_other=allow_other):
+                self.created_mount = True
+            else:
+                with self.lease_holders(decr_path) as holders:
+                    holders.discard(os.getpid())
+                    self.leased = False
+                return False
+        return True
+
+    def release_lease(self, keep_mounted=True, lazy_fallback=False):
+        """Unregisters this process as user of the mounted folder; unmounts it if this process mounted it, it was the last user and it shall not be kept mounted"""
+        if not self.leased:
+            return False
+        with self.lease_holders(self.folder_decrypted) as holders:
+            holders.discard(os.getpid())
+            self.leased = False
+            if len(holders):
+                logger.debug(f'Not unmounting folder [{self.folder_decrypted}] as it is still used by processes {sorted(holders)}')
+                return True
+            if not self.created_mount:
+                logger.debug(f'Not unmounting folder [{self.folder_decrypted}] as it was mounted by another process (e.g. "saltx unlock")')
+                return True
+            if keep_mounted:
+                logger.debug(f'Keeping folder [{self.folder_decrypted}] mounted until idle timeout')
+                return True
+            return self.unmount(lazy_fallback=lazy_fallback)
+
+    def clear_leases(self, decr_path):
+        """Removes all leases of the given folder (e.g. after forcibly unmounting it)"""
+        with self.lease_holders(decr_path) as holders:
+            holders.discard(os.getpid())
+            if len(holders):
+                logger.warning(f'Folder [{decr_path}] was still used by processes {sorted(holders)}')
+            holders.clear()
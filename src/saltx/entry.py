@@ -4,6 +4,8 @@
 
 import logging
 
+from . import agent
+from . import batch
 from . import logic
 
 
@@ -12,10 +14,10 @@ logger = logging.getLogger(__name__)
 
 class Entry():
 
-    def __init__(self, instance):
+    def __init__(self, instance, logicobj=None):
         """Object initialization"""
         self.instance = instance
-        self.logic = logic.Logic(instance)
+        self.logic = logic.Logic(instance) if (logicobj is None) else logicobj
 
     def lock(self):
         """Locks the encrypted folder"""
@@ -45,11 +47,54 @@ class Entry():
         """Removes local installation"""
         self.logic.purge_directory()
 
-    def initremote(self, target):
-        """Prepare remote host for use"""
-        logger.info('Ensuring that remote host is accessible via ssh key...')
+    def initremote(self, *args):
+        """Prepare remote host(s) for use"""
+        self.logic.prepare_folder_config()
+        targets = self.logic.read_targets(args)
+        if (len(targets) == 1) and not args[0].startswith('@'):
+            logger.info('Ensuring that remote host is accessible via ssh key...')
+            self.logic.prepare_ssh(targets[0])
+        else:
+            logger.info('Ensuring that remote hosts are accessible via ssh key...')
+            if not self.logic.prepare_ssh_batch(targets):
+                exit(1)
+
+    def fillkeypool(self, count):
+        """Pre-generates ssh key pairs for later use"""
+        self.logic.prepare_folder_config()
+        if not self.logic.fill_key_pool(int(count)):
+            exit(1)
+
+    def targets(self, pattern=None):
+        """Lists known targets"""
+        self.logic.prepare_folder_config()
+        self.logic.list_targets(pattern)
+
+    def probe(self, pattern=None):
+        """Probes whether known targets are reachable via ssh"""
+        self.logic.prepare_folder_config()
+        if not self.logic.show_reachability(pattern):
+            exit(1)
+
+    def results(self, target=None, count='5'):
+        """Shows changed and failed states of the latest Salt runs"""
         self.logic.prepare_folder_config()
-        self.logic.prepare_ssh(target)
+        self.logic.show_results(target, int(count))
+
+    def status(self):
+        """Shows the state of the Saltx folder"""
+        self.logic.show_status()
+
+    def agent(self, arg=None):
+        """Runs an agent serving operations for the given number of idle minutes or stops a running agent"""
+        if arg == 'stop':
+            if not agent.AgentClient(self.instance).stop():
+                exit(1)
+            return
+        # Allow access by root so that the agent can serve "local" as well
+        idle_minutes = int(arg or 60)
+        self.logic.prepare_folder_config(unlock_allow_other=True, unlock_minutes=idle_minutes)
+        agent.Agent(self.instance, self.logic, idle_minutes=idle_minutes).serve()
 
     def startshell(self, target):
         """Prepare remote host for use"""
@@ -57,18 +102,24 @@ class Entry():
         self.logic.prepare_folder_config()
         self.logic.start_ssh(target)
 
-    def update(self, scope):
-        """Updates git and/or vault as specified"""
+    def update(self, scope, *filters, **kwargs):
+        """Updates git and/or vault as specified (vault optionally restricted by filters)"""
+        self.logic.offline = kwargs.get('offline', False)
         self.logic.prepare_folder_config()
+        if kwargs.get('all_instances', False):
+            if not self.logic.update_all_instances(scope):
+                exit(1)
+            return
         # Update vault first as it might contain updated configuration data
         if scope in ['vault', 'all']:
-            self.logic.update_vault()
+            self.logic.update_vault(filters=filters)
         if scope in ['git', 'all']:
             self.logic.update_git()
 
     def local(self, *args, **kwargs):
         """Runs salt-call locally"""
         args_string = ' '.join(args)
+        self.logic.offline = kwargs.get('offline', False)
         self.logic.prepare_folder_config(unlock_allow_other=True)
         if not kwargs.get('noupdate', False):
             self.logic.check_updates()
@@ -77,7 +128,37 @@ class Entry():
     def ssh(self, *args, **kwargs):
         """Runs salt-ssh"""
         args_string = ' '.join(args)
+        self.logic.offline = kwargs.get('offline', False)
         self.logic.prepare_folder_config()
         if not kwargs.get('noupdate', False):
             self.logic.check_updates()
-        self.logic.run_salt_ssh(target=args[0], args_string=args_string)
+        self.logic.run_salt_ssh(target=args[0], args_string=args_string, refresh=kwargs.get('refresh', False))
+
+    def run_batch_operation(self, operation, args):
+        """Runs an operation of a batch (preparation and update check already done)"""
+        if operation == 'targets':
+            self.targets(*args)
+        else:
+            getattr(self, operation)(*args, noupdate=True, offline=self.logic.offline)
+
+    def batch(self, filename, workers='1', **kwargs):
+        """Runs the operations listed in a file, preparing and checking for updates only once"""
+        batchobj = batch.Batch()
+        if not batchobj.read(filename):
+            exit(1)
+        self.logic.offline = kwargs.get('offline', False)
+        self.logic.prepare_folder_config(unlock_allow_other=batchobj.has_operation('local'))
+        if not kwargs.get('noupdate', False):
+            self.logic.check_updates()
+        # Prepare shared state once before operations run concurrently
+        self.logic.init_salt()
+        self.logic.get_target_index()
+        # Probe all ssh targets up front so that unreachable ones do not cost an ssh timeout each
+        batchobj.exclude_targets(self.logic.find_unreachable_targets(batchobj.get_targets('ssh')), 'unreachable')
+        try:
+            ok = batchobj.run(self.run_batch_operation, max_workers=int(workers))
+        finally:
+            self.logic.cleanup()
+        batchobj.print_results()
+        if not ok:
+            exit(1)
@@ -3,7 +3,9 @@
 """Class for interacting with Git"""
 
 import logging
+import shlex
 
+from . import metrics
 from . import setupenv
 
 
@@ -12,12 +14,15 @@ logger = logging.getLogger(__name__)
 
 class GitRepo():
     
-    def __init__(self, repopath=None, repourl=None, username='', token='', queryuserobj=None):
+    def __init__(self, repopath=None, repourl=None, username='', token='', queryuserobj=None, depth=None, filter=None, sparse_paths=None):
         """Object initialization"""
         assert queryuserobj is not None
         self.queryuserobj = queryuserobj
         self.repopath = repopath
         self.repourl = repourl
+        self.depth = depth  # history depth for shallow clones (None for full history)
+        self.filter = filter  # object filter for partial clones, e.g. "blob:none"
+        self.sparse_paths = sparse_paths  # list of paths to check out (None for full checkout)
         self.repourl_full = None
         if repourl is not None:
             if len(token) and not len(username):
@@ -76,14 +81,48 @@ class GitRepo():
         else:
             return self.git_init()
 
+    def get_clone_options(self):
+        """Returns the options for shallow, partial and sparse clones as string"""
+        options = ''
+        if self.depth is not None:
+            options += f' --depth {int(self.depth)}'
+        if self.filter is not None:
+            options += f' --filter={shlex.quote(self.filter)}'
+        if self.sparse_paths:
+            options += ' --sparse'
+        return options
+
+    def git_sparse_checkout(self):
+        """Restricts the working tree to the configured sparse paths"""
+        if not self.sparse_paths:
+            return True
+        paths = ' '.join([shlex.quote(path) for path in self.sparse_paths])
+        rc, out, err = setupenv.run_process(f'git sparse-checkout set {paths}', cwd=self.repopath)
+        return rc == 0
+
     def git_clone(self):
         """Clones a Git repository"""
         self.ensure_installed()        
-        rc, out, err = setupenv.run_process(f'git clone {self.repourl_full} {self.repopath}', cwd=self.repopath)
-        return rc == 0
+        with metrics.registry.timer('git_duration_seconds', { 'operation': 'clone' }):
+            rc, out, err = setupenv.run_process(f'git clone{self.get_clone_options()} {self.repourl_full} {self.repopath}', cwd=self.repopath)
+            ok = (rc == 0) and self.git_sparse_checkout()
+        if not ok:
+            metrics.registry.inc('git_failures_total', { 'operation': 'clone' })
+        return ok
 
     def git_pull(self):
         """Pulls a Git repository"""
         self.ensure_installed()        
-        rc, out, err = setupenv.run_process(f'git pull', cwd=self.repopath)
-        return rc == 0
+        options = ''
+        if self.depth is not None:
+            # Keep shallow history; only fast-forward as local history is truncated
+            options += f' --depth {int(self.depth)} --ff-only'
+        with metrics.registry.timer('git_duration_seconds', { 'operation': 'pull' }):
+            # Apply sparse paths first in case they have changed since cloning
+            ok = self.git_sparse_checkout()
+            if ok:
+                rc, out, err = setupenv.run_process(f'git pull{options}', cwd=self.repopath)
+                ok = (rc == 0)
+        if not ok:
+            metrics.registry.inc('git_failures_total', { 'operation': 'pull' })
+        return ok
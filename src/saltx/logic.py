@@ -2,32 +2,49 @@
 
 """Class for controlling the business logic of the application"""
 
+import atexit
+import concurrent.futures
+import datetime
 import logging
 import os
 import pathlib
+import re
 import shutil
+import sys
+import tempfile
+import threading
+import time
 
 from . import bwvault
 from . import config
+from . import conflictpolicy
 from . import encfs
 from . import gitrepo
+from . import metrics
 from . import queryuser
+from . import reachability
 from . import salt
+from . import saltresults
 from . import setupenv
 from . import sshtools
+from . import targetindex
 from . import userinteraction
+from . import vaultsnapshot
 from . import vaultsync
+from . import workingset
 from . import yamlconfig
 
 
 logger = logging.getLogger(__name__)
 folder_main  = os.path.expanduser('~/saltx')
 folder_encrypted = os.path.expanduser('~/saltx_encrypted')
+folder_keypool = os.path.join(folder_main, 'keypool')
+folder_results = os.path.join(folder_main, 'results')
 
 
 class Logic():
 
-    def __init__(self, instance):
+    def __init__(self, instance, queryuserobj=None):
         """Object initialization"""
         self.instance = instance
         self.file_last_update_vault = os.path.join(folder_main, 'last_update_private')
@@ -35,10 +52,22 @@ class Logic():
         self.folder_saltx_priv = None
         self.folder_state_priv = None
         self.folder_pillar_priv = None
-        self.queryuserobj = queryuser.QueryUser()
+        self.target_index = None
+        self.reachability = None
+        self.offline = False  # use local vault snapshot instead of accessing the vault
+        self.prepared = False
+        self.bw_session = None  # unlocked vault object kept by a long-running process (agent)
+        self.workingset = None
+        self.workingset_saltfile = None
+        self.salt = None
+        self.salt_params = None  # folders and settings the Salt object was created for
+        self.lock = threading.RLock()  # guards state shared by operations running concurrently (batch)
+        self.queryuserobj = queryuser.QueryUser() if (queryuserobj is None) else queryuserobj
         
-    def prepare_folder_config(self, unlock_allow_other=False):
+    def prepare_folder_config(self, unlock_allow_other=False, unlock_minutes=15):
         """Prepares the Saltx folder and the configuration object for use"""
+        if self.prepared:
+            return  # e.g. already done by the agent serving this request
         # Make sure saltx directory in home directory exists
         if not os.path.isdir(folder_main):
             if not os.path.isdir(folder_encrypted):
@@ -51,8 +80,23 @@ class Logic():
                     os.makedirs(os.path.expanduser(folder_encrypted), mode=0o700)
             os.makedirs(os.path.expanduser(folder_main), mode=0o700)
         # Create/mount encrypted storage
-        self.unlock_folder(allow_other=unlock_allow_other)
+        self.unlock_folder(minutes=unlock_minutes, allow_other=unlock_allow_other)
         # Prepare config object
+        self.prepare_config()
+        # Export metrics of this run on exit if configured
+        metrics.registry.set_context(instance=self.instance)
+        metrics_file = self.cfg.get_item('general.metrics_file')
+        if metrics_file is not None:
+            metrics.registry.set('run_timestamp_seconds', time.time())
+            atexit.register(metrics.registry.write_textfile, metrics_file)
+        self.prepared = True
+
+    def is_folder_available(self):
+        """Returns whether the Saltx folder can be used (i.e. mounted if encrypted)"""
+        return os.path.ismount(folder_main) or not os.path.isdir(folder_encrypted)
+
+    def prepare_config(self):
+        """Prepares the configuration object for use (the Saltx folder needs to be available already)"""
         self.init_config(first_run=True)
         if (self.cfg.get_item('instance.folder_public') is not None) or (self.cfg.get_item('instance.folder_private') is not None) or (self.folder_saltx_priv is not None):
             self.init_config() # need to call a second time to consider path information and instance config path that got read the first time
@@ -91,7 +135,8 @@ class Logic():
         """Create/mount encrypted storage"""
         if os.path.ismount(folder_main):
             self.encrypteddir = encfs.EncFS(self.queryuserobj)
-            self.encrypteddir.unmount(folder_decrypted=folder_main, force=True)
+            if self.encrypteddir.unmount(folder_decrypted=folder_main, force=True, lazy_fallback=None):
+                self.encrypteddir.clear_leases(folder_main)
         else:
             logger.critical(f'Folder [{folder_main}] is not mounted')
             exit(1)
@@ -100,10 +145,18 @@ class Logic():
         """Mount encrypted storage"""
         self.encrypteddir = encfs.EncFS(self.queryuserobj)
         if os.path.isdir(folder_encrypted):
-            if self.encrypteddir.mount(folder_encrypted, folder_main, minutes, allow_other=allow_other):
-                if not persistent:
-                    self.encrypteddir.register_auto_unmount()
+            if persistent:
+                if os.path.ismount(folder_main):
+                    logger.info(f'Folder [{folder_main}] is already unlocked')
+                    ok = True
+                else:
+                    ok = self.encrypteddir.mount(folder_encrypted, folder_main, minutes, allow_other=allow_other)
             else:
+                # Share the mount with concurrently running Saltx processes
+                ok = self.encrypteddir.acquire_lease(folder_encrypted, folder_main, minutes, allow_other=allow_other)
+                if ok:
+                    atexit.register(self.release_folder)
+            if not ok:
                 logger.critical(f'Mounting encrypted folder [{folder_main}] failed')
                 exit(1)
         else:
@@ -111,20 +164,44 @@ class Logic():
                 logger.critical(f'This installation does not use encrypted storage')
                 exit(1)
                 
+    def release_folder(self):
+        """Releases this process' use of the encrypted storage; unmounts it if not used by others"""
+        keep_mounted = True
+        lazy_unmount = False
+        if hasattr(self, 'cfg'):
+            keep_mounted = self.cfg.get_item('general.keep_mounted', True)
+            lazy_unmount = self.cfg.get_item('general.lazy_unmount', False)
+        self.encrypteddir.release_lease(keep_mounted=keep_mounted, lazy_fallback=lazy_unmount)
+
+    def show_status(self):
+        """Prints the state of the Saltx folder"""
+        if os.path.ismount(folder_main):
+            with encfs.EncFS(self.queryuserobj).lease_holders(folder_main) as holders:
+                pids = ', '.join([str(pid) for pid in sorted(holders)])
+            print(f'Folder [{folder_main}] is unlocked; used by processes [{pids}]')
+        elif os.path.isdir(folder_encrypted):
+            print(f'Folder [{folder_main}] is locked')
+        else:
+            print(f'Folder [{folder_main}] is not encrypted')
+        for name, filename in [('vault', self.file_last_update_vault), ('Git', self.file_last_update_git)]:
+            if os.path.exists(filename):
+                print(f'Last {name} update: [{datetime.datetime.fromtimestamp(os.path.getmtime(filename)):%Y-%m-%d %H:%M:%S}]')
+            else:
+                print(f'Last {name} update: [never]')
+
     def init_config(self, first_run=False):
         """Initializes the configuration object"""
         # Instance-specific config
-        if self.folder_saltx_priv is not None:
-            config.filename_instance = os.path.join(self.folder_saltx_priv, 'config.yaml')
+        filename_instance = '' if (self.folder_saltx_priv is None) else os.path.join(self.folder_saltx_priv, 'config.yaml')
         # Create config object
-        self.cfg = config.Configuration(instance=self.instance)
+        self.cfg = config.Configuration(instance=self.instance, filename_instance=filename_instance)
         self.set_config_defaults()
         self.cfg.load_config()
         if not self.cfg.is_userfile_present():
             if self.queryuserobj.get_create_config(config.filename_user):
                 self.cfg.create_userfile()
                 if self.queryuserobj.edit_file_asked(config.filename_user):
-                    self.cfg = config.Configuration(instance=self.instance)
+                    self.cfg = config.Configuration(instance=self.instance, filename_instance=filename_instance)
                     self.set_config_defaults()
                     self.cfg.load_config()
         if self.cfg.get_item('instance.bw') is None:
@@ -152,6 +229,7 @@ class Logic():
         self.folder_saltx_priv = os.path.join(self.folder_priv, 'saltx')
         self.folder_state_priv = os.path.join(self.folder_priv, 'state', private)
         self.folder_pillar_priv = os.path.join(self.folder_priv, 'pillar', private)
+        self.target_index = None
         if not first_run:
             logger.debug(f'Private folders: Saltx [{self.folder_saltx_priv}], State [{self.folder_state_priv}], Pillar [{self.folder_pillar_priv}]')
 
@@ -174,7 +252,9 @@ class Logic():
             if download_bw is None:
                 download_bw = self.queryuserobj.get_download_bw()
             if download_bw:
-                if not setupenv.download_bitwarden_cli(self.cfg.get_item('instance.bw.download_url'), bw_params['bw_cli']):
+                if not setupenv.download_bitwarden_cli(self.cfg.get_item('instance.bw.download_url'), bw_params['bw_cli'],
+                                                       sha256=self.cfg.get_item('instance.bw.download_sha256'),
+                                                       cache_dir=self.cfg.get_item('general.download_cache_dir')):
                     logger.critical(f'Download and extraction of Bitwarden CLI tool [{bw_params['bw_cli']}] failed')
                     exit(1)
                 if not setupenv.find_tool(bw_params['bw_cli']):
@@ -190,8 +270,44 @@ class Logic():
                 exit(1)
         return bw_cfg, bw_params
 
-    def init_bw(self):
-        """Initializes access to Bitwarden/Vaultwarden vault"""
+    def get_bw_session_key(self):
+        """Returns a key identifying the vault session (same key means that the session can be shared)"""
+        bw_cfg = self.cfg.get_item('instance.bw', dict())
+        return (bw_cfg.get('cli'), bw_cfg.get('server'), bw_cfg.get('clientid'), bw_cfg.get('org'))
+
+    def get_vault_snapshot(self):
+        """Returns the object for the local snapshot of our organization in the vault (kept in the Saltx folder)"""
+        bw_org = self.cfg.get_item('instance.bw.org')
+        return vaultsnapshot.SnapshotVault(os.path.join(folder_main, f'vault_snapshot_{bw_org}.json'))
+
+    def create_snapshot_vault(self):
+        """Creates an object for accessing the local vault snapshot instead of the vault"""
+        snapshot = self.get_vault_snapshot()
+        if not snapshot.load():
+            logger.critical(f'No local vault snapshot [{snapshot.filename}] available; a successful vault sync is needed first')
+            exit(1)
+        logger.info('Using local vault snapshot; changes are applied to the vault on the next online sync')
+        return snapshot
+
+    def create_bw(self):
+        """Creates an object for accessing the Bitwarden/Vaultwarden vault (or its local snapshot if offline)"""
+        if self.offline:
+            return self.create_snapshot_vault()
+        fallback = self.cfg.get_item('instance.bw.offline_fallback', True) and self.get_vault_snapshot().is_present()
+        try:
+            bw = self.create_bwvault()
+        except SystemExit:
+            if not fallback:
+                raise
+            logger.warning('Accessing vault failed; falling back to local vault snapshot')
+            return self.create_snapshot_vault()
+        if not bw.synced and fallback:
+            logger.warning('Vault server not reachable; falling back to local vault snapshot')
+            return self.create_snapshot_vault()
+        return bw
+
+    def create_bwvault(self):
+        """Creates an object for accessing the Bitwarden/Vaultwarden vault"""
         # Access Bitwarden/Vaultwarden
         bw_cfg, bw_params = self.ensure_bw()
         bw_server = bw_cfg.get('server')
@@ -209,21 +325,46 @@ class Logic():
                              bw_clientid=bw_clientid, 
                              bw_clientsecret=bw_clientsecret, 
                              bw_password=bw_password, 
-                             bw_org=bw_org)
+                             bw_org=bw_org,
+                             max_calls=bw_cfg.get('max_calls'))
         # Make sure organization is present in vault
         if not bw.is_org_present():
             logger.critical(f'You need to manually create the organization [{bw_org}] in the vault (or get access to it) first')
             exit(1)
+        return bw
+
+    def init_bw(self, bw=None):
+        """Initializes access to Bitwarden/Vaultwarden vault (an already unlocked vault object may be provided)"""
+        if bw is None:
+            bw = self.create_bw() if self.bw_session is None else self.bw_session
         # Prepare sync
         realms = { 'saltx': self.folder_saltx_priv, 'pillar': self.folder_pillar_priv, 'state': self.folder_state_priv }
         realms = self.cfg.get_item('instance.realms', realms)        
         auto_create_locally = self.cfg.get_item('instance.auto_create_locally')
         auto_update_locally = self.cfg.get_item('instance.auto_update_locally')
         auto_delete_locally = self.cfg.get_item('instance.auto_delete_locally')
-        self.vs = vaultsync.VaultSync(realms, bw, auto_create_locally, auto_update_locally, auto_delete_locally)
+        state_filename = os.path.join(folder_main, f'vault_sync_state_{self.instance}.json')
+        compress = self.cfg.get_item('instance.bw.compress', False)
+        compress_threshold = self.cfg.get_item('instance.bw.compress_threshold')
+        max_notes_size = self.cfg.get_item('instance.bw.max_notes_size', 10000)
+        chunking = self.cfg.get_item('instance.bw.chunking', False)
+        chunk_workers = self.cfg.get_item('instance.bw.chunk_workers', 1)
+        self.vs = vaultsync.VaultSync(realms, bw, auto_create_locally, auto_update_locally, auto_delete_locally, state_filename=state_filename,
+                                      compress=compress, compress_threshold=compress_threshold, max_notes_size=max_notes_size,
+                                      chunking=chunking, chunk_workers=chunk_workers)
         self.vs.register_hook('onlyfile', userinteraction.on_onlyfile)
         self.vs.register_hook('onlyvault', userinteraction.on_onlyvault)
         self.vs.register_hook('update', userinteraction.on_updatefile)
+        # Decide on all differences at once if configured
+        conflict_policy = self.cfg.get_item('instance.conflict_policy')
+        if conflict_policy is not None:
+            policy = conflictpolicy.ConflictPolicy()
+            if not policy.load(conflict_policy):
+                logger.critical('Loading conflict policy failed')
+                exit(1)
+            self.vs.register_hook('resolve', policy.apply)
+        elif self.cfg.get_item('instance.conflict_resolution', 'item') == 'table':
+            self.vs.register_hook('resolve', userinteraction.resolve_conflicts)
 
     def ensure_git(self):
         """Makes sure that Git can be used on the system"""
@@ -239,7 +380,11 @@ class Logic():
         if git_repourl is None:
             logger.critical(f'Git repository URL not set in config')
             exit(1)
-        self.git = gitrepo.GitRepo(self.folder_pub, git_repourl, token=git_token, queryuserobj=self.queryuserobj)
+        git_depth = self.cfg.get_item('instance.git.depth')
+        git_filter = self.cfg.get_item('instance.git.filter')
+        git_sparse_paths = self.cfg.get_item('instance.git.sparse_paths')
+        self.git = gitrepo.GitRepo(self.folder_pub, git_repourl, token=git_token, queryuserobj=self.queryuserobj,
+                                   depth=git_depth, filter=git_filter, sparse_paths=git_sparse_paths)
         repo_presence = self.git.is_repo()
         if repo_presence is None:
             logger.critical(f'Checking presence of Git repository failed')
@@ -248,9 +393,21 @@ class Logic():
             logger.info(f'Cloning Git repository [{git_repourl}]')
             self.git.git_clone()
 
+    def get_salt_settings(self):
+        """Returns the settings for the Salt configuration templates"""
+        settings = self.cfg.get_item('general.salt')
+        return settings if isinstance(settings, dict) else dict()
+
     def init_salt(self):
-        """Prepare use of Salt"""
-        self.salt = salt.Salt(folder_main, self.folder_pub, self.folder_priv, queryuserobj=self.queryuserobj)
+        """Prepare use of Salt (done once for the current folders and settings, also if operations run concurrently)"""
+        with self.lock:
+            params = (self.folder_pub, self.folder_priv, self.get_salt_settings())
+            if (self.salt is not None) and (params == self.salt_params):
+                return
+            self.salt = salt.Salt(folder_main, self.folder_pub, self.folder_priv, queryuserobj=self.queryuserobj, settings=params[2])
+            self.salt_params = params
+            if self.salt.is_configured():
+                self.salt.ensure_configured()  # regenerates the configuration if outdated
 
     def ensure_salt(self, saltssh=False):
         """Makes sure that Salt is available on the system"""
@@ -268,18 +425,111 @@ class Logic():
         if self.git.git_pull():
             setupenv.touch_file(self.file_last_update_git)
             logger.info('Updating local Git repository done')
+            return True
         else:
             logger.error('Updating local Git repository failed')
+            return False
 
-    def update_vault(self):
-        """Updates credential vault"""
-        self.init_bw()
+    def update_vault(self, bw=None, reload_config=True, filters=None):
+        """Updates credential vault (optionally only the realms/collections/paths selected by the given filters)"""
+        self.init_bw(bw)
+        if filters:
+            try:
+                self.vs.parse_scope(filters)
+            except ValueError as e:
+                logger.critical(f'Invalid vault sync filter [{e}]; available realms: {", ".join(self.vs.realms.keys())}')
+                exit(1)
+        vault = self.vs.vault
+        if not vault.offline:
+            snapshot = self.get_vault_snapshot()
+            if snapshot.load() and not snapshot.replay_pending(vault):
+                logger.warning('Not all changes made offline could be applied to the vault; retrying with the next update')
         logger.info('Syncing vault...')
-        self.vs.sync_all()
-        setupenv.touch_file(self.file_last_update_vault)
+        try:
+            self.vs.sync_all(filters)
+        except bwvault.CallBudgetExceededError as e:
+            logger.critical(f'Syncing vault aborted [{e}]; increase "instance.bw.max_calls" if needed')
+            exit(1)
+        finally:
+            vault.log_call_stats()
+            call_stats_file = self.cfg.get_item('instance.bw.call_stats_file')
+            if call_stats_file is not None:
+                vault.dump_call_stats(os.path.expanduser(call_stats_file))
+        if not vault.offline:
+            snapshot.save_from(vault)
+        if not filters and not vault.offline:
+            setupenv.touch_file(self.file_last_update_vault)  # neither a partial nor an offline sync replaces the regular update
         logger.info('Syncing vault done')
         # Reload config since we might have got a new config file in the Git repository
-        self.init_config()
+        if reload_config:
+            self.init_config()
+        return True
+
+    def get_instances(self):
+        """Returns the names of all configured instances"""
+        instances = self.cfg.get_item('instances')
+        if not isinstance(instances, dict):
+            return [self.instance]
+        return sorted(set(instances.keys()) | {self.instance})  # the current instance need not be listed
+
+    def update_all_instances(self, scope):
+        """Updates vault and/or git of all configured instances with bounded concurrency"""
+        # Prepare config objects; this is done sequentially as it may query the user
+        logics = dict()
+        for instance in self.get_instances():
+            if instance == self.instance:
+                logics[instance] = self
+            else:
+                logics[instance] = Logic(instance, queryuserobj=self.queryuserobj)
+                logics[instance].prepare_config()
+        results = { instance: dict() for instance in logics }
+        # Vault updates are done one after the other as the Bitwarden CLI keeps its state per user; one session per server and account
+        vault_lock = threading.Lock()
+        sessions = dict()
+
+        def run_timed(instance, what, func, *args, **kwargs):
+            """Runs the given update function and records its result and duration"""
+            time_start = time.monotonic()
+            metrics.registry.set_context(instance=instance)
+            try:
+                ok = func(*args, **kwargs)
+            except (Exception, SystemExit) as e:
+                logger.error(f'Updating {what} of instance [{instance}] failed [{e}]')
+                ok = False
+            results[instance][what] = (ok, time.monotonic() - time_start)
+
+        def update_vault(logic):
+            """Updates the vault of an instance sharing the session with other instances of the same server and account"""
+            with vault_lock:
+                key = logic.get_bw_session_key()
+                if key not in sessions:
+                    sessions[key] = logic.create_bw()
+                return logic.update_vault(bw=sessions[key], reload_config=(scope == 'all'))
+
+        def update_instance(instance, logic):
+            """Updates vault first (it might contain updated configuration data), then git of an instance"""
+            if scope in ['vault', 'all']:
+                run_timed(instance, 'vault', update_vault, logic)
+            if scope in ['git', 'all']:
+                run_timed(instance, 'git', logic.update_git)
+
+        max_workers = self.cfg.get_item('general.max_workers', 4)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(update_instance, instance, logic) for instance, logic in logics.items()]
+            concurrent.futures.wait(futures)
+
+        def format_result(result):
+            """Formats a result for the summary"""
+            if result is None:
+                return '-'
+            ok, duration = result
+            return f'{'ok' if ok else 'FAILED'} ({duration:.1f}s)'
+
+        # Print summary
+        print(f'{'Instance':<20} {'Vault':<18} {'Git':<18}')
+        for instance in logics:
+            print(f'{instance:<20} {format_result(results[instance].get('vault')):<18} {format_result(results[instance].get('git')):<18}')
+        return all([result[0] for instance_results in results.values() for result in instance_results.values()])
 
     def check_updates(self):
         """Checks whether the last updates are more than a certain time ago and triggers updates if needed"""
@@ -292,26 +542,69 @@ class Logic():
         else:
             logger.info(f'Not updating local Git repository as last update has not taken place more than one hour ago')
 
+    def get_saltfile_for_run(self):
+        """Returns the Saltfile to use; prepares a RAM-backed copy of the private data first if configured"""
+        saltfile_name = self.salt.get_saltfile_name()
+        if not self.cfg.get_item('general.ram_working_set', False) or not self.salt.is_configured():
+            return saltfile_name
+        with self.lock:
+            # Runs of a batch share the working set
+            if self.workingset is not None:
+                return self.workingset_saltfile
+            workingset_new = workingset.WorkingSet(self.folder_priv, self.cfg.get_item('general.ram_working_set_dir'))
+            if not workingset_new.create():
+                logger.warning('Using private data in place as RAM-backed working set could not be created')
+                return saltfile_name
+            workingset_new.register_auto_close()
+            saltfile_name_ram = self.salt.write_conf_for_folder_priv(workingset_new.folder, os.path.join(workingset_new.folder_base, 'salt'))
+            if saltfile_name_ram is None:
+                logger.warning('Using private data in place as Salt configuration for RAM-backed working set could not be written')
+                workingset_new.remove()
+                return saltfile_name
+            self.workingset = workingset_new
+            self.workingset_saltfile = saltfile_name_ram
+            return saltfile_name_ram
+
+    def cleanup(self):
+        """Releases resources of a finished run that would otherwise only be released on exit"""
+        if self.workingset is not None:
+            self.workingset.close()
+            self.workingset = None
+
+    def get_result_recorder(self, target, command, args_string):
+        """Returns an object capturing the results of a Salt run (returns 'None' if they are not captured)"""
+        if not self.cfg.get_item('general.capture_results', True) or not saltresults.is_capturable(args_string):
+            return None
+        return saltresults.ResultRecorder(folder_results, target, command, args_string, keep=int(self.cfg.get_item('general.results_keep', 20)))
+
+    def show_results(self, target=None, count=5):
+        """Prints changed and failed states and durations of the latest captured Salt runs"""
+        saltresults.print_summaries(saltresults.load_summaries(folder_results, target, count))
+
     def run_salt_call(self, args_string):
         """Run salt-call locally"""
         logger.info('Running salt-call locally...')
         self.init_salt()
+        recorder = self.get_result_recorder('local', 'salt-call', args_string)
         # Argument for Saltfile
-        saltfile_name = self.salt.get_saltfile_name()
+        saltfile_name = self.get_saltfile_for_run()
         if saltfile_name is None:
             logger.critical('Saltfile not found; run "saltx initlocal" first')
             exit(1)
         args_string = f'--saltfile={saltfile_name} ' + args_string
         # Call salt-call
-        if not self.salt.run_salt_call_locally(args_string):
+        if not self.salt.run_salt_call_locally(args_string, recorder=recorder):
             logger.critical('Command failed')
             exit(1)
 
-    def run_salt_ssh(self, target, args_string):
+    def run_salt_ssh(self, target, args_string, refresh=False):
         """Run salt-ssh"""
         logger.info('Running salt-ssh...')
         self.init_salt()
+        recorder = self.get_result_recorder(target, 'salt-ssh', args_string)
         target_user, target_host, target_port, target_dir = self.get_target_parts(target)
+        if self.find_unreachable_targets([target]):
+            logger.warning('Calling salt-ssh anyway (disable probing with "general.probe_timeout: 0")')
         if target_dir is None:
             logger.warning(f'Host directory not found for [{target}]; just calling salt-ssh with the provided arguments')
         else:
@@ -327,49 +620,180 @@ class Logic():
                 else:
                     args_string = f'--priv {keydata.priv_key_filename} ' + args_string
                 # Argument for Saltfile
-                saltfile_name = self.salt.get_saltfile_name()
+                saltfile_name = self.get_saltfile_for_run()
                 if saltfile_name is None:
                     logger.critical('Saltfile not found; run "saltx initmaster" first')
                     exit(1)
                 args_string = f'--saltfile={saltfile_name} ' + args_string
+                # Reuse the grains of the target cached by salt-ssh (within the Saltx folder) unless a refresh is requested;
+                # salt-ssh caches them under the host given (without user), which is only known for a single known target
+                minion_id = target.rpartition('@')[2]
+                if (':' in minion_id) or (self.get_target_index().find(minion_id)[1] is None):
+                    minion_id = None  # e.g. glob or host with port
+                cache_age = None
+                if minion_id is not None:
+                    self.salt.ensure_target_cache_dir(minion_id)
+                    cache_age = self.salt.get_target_cache_age(minion_id)
+                if refresh:
+                    logger.info('Refreshing cached grains of target')
+                    args_string = '--refresh-cache ' + args_string
+                elif cache_age is not None:
+                    logger.debug(f'Cached grains of target are {cache_age:.0f} minutes old')
             else:
                 logger.warning('Salt is not yet configured (run "saltx initmaster"); just calling salt-ssh with the provided arguments')
         # Call salt-ssh
-        if not self.salt.run_salt_ssh(args_string, folder_main=folder_main):
+        if not self.salt.run_salt_ssh(args_string, folder_main=folder_main, target=target_host, recorder=recorder):
             logger.critical('Command failed')
             exit(1)
 
+    def get_target_index(self):
+        """Returns the index of targets in the private State folder (loaded from cache if still current)"""
+        with self.lock:
+            if self.target_index is None:
+                target_prefix = self.cfg.get_item('instance.target_prefix', 'host_')
+                cache_filename = os.path.join(folder_main, f'targets_{self.instance}.json')
+                self.target_index = targetindex.TargetIndex(self.folder_state_priv, target_prefix, cache_filename)
+                self.target_index.load()
+            return self.target_index
+
     def find_private_folder(self, target):
         """Find the private pillar folder for the given target"""
-        target_prefix = self.cfg.get_item('instance.target_prefix', 'host_')
-        target_dir = target_prefix + target
-        target_dir = os.path.join(self.folder_state_priv, target_dir)
-        if os.path.isdir(target_dir):
+        _, target_data = self.get_target_index().find(target)
+        if target_data is not None:
+            target_dir = target_data['dir']
             logger.debug(f'Private pillar folder for target [{target}] is [{target_dir}]')
             return target_dir
         else:
+            target_prefix = self.cfg.get_item('instance.target_prefix', 'host_')
+            target_dir = os.path.join(self.folder_state_priv, target_prefix + target.partition('.')[0])
             logger.error(f'Private pillar folder for target [{target}] should be [{target_dir}]. But it does not exist')
         return None
 
     def get_target_parts(self, target):
         """Split the target information into parts"""
         # Obtain and remove user info
-        target_user = 'root'  # default if not given
+        target_user = None
         tmp = target.partition('@')
         if tmp[1] == '@':
             target_user = tmp[0]
             target = tmp[2]
         # Obtain and remove port info
-        target_port = '22'
+        target_port = None
         tmp = target.partition(':')
         if tmp[1] == ':':
             target = tmp[0]
             target_port = tmp[2]        
         # Get directory name for target (target host)
-        target_dir = self.find_private_folder(target.partition('.')[0])
+        target_dir = self.find_private_folder(target)
+        # Take defaults from the target config if present
+        name, target_data = self.get_target_index().find(target)
+        if target_data is not None:
+            # Only a target name or alias is replaced by the configured host; a host name given is used as is
+            if (target_data['host'] is not None) and (target.lower() in [alias.lower() for alias in [name] + target_data['aliases']]):
+                target = target_data['host']
+            if target_user is None:
+                target_user = target_data['user']
+            if target_port is None:
+                target_port = target_data['port']
+        if target_user is None:
+            target_user = 'root'  # default if not given
+        if target_port is None:
+            target_port = '22'
         # Finally return the data
         return target_user, target, target_port, target_dir
 
+    def probe_targets(self, targets):
+        """Probes the ssh port of the given targets concurrently; returns a list of tuples (target, host, port, reachable, detail)"""
+        with self.lock:
+            if self.reachability is None:
+                self.reachability = reachability.Reachability(os.path.join(folder_main, 'reachability.json'),
+                                                              timeout=float(self.cfg.get_item('general.probe_timeout', 2) or 2),  # also used by "saltx probe" if disabled
+                                                              cache_ttl=int(self.cfg.get_item('general.probe_cache_ttl', 30)),
+                                                              max_workers=int(self.cfg.get_item('general.probe_max_workers', 500)))
+                self.reachability.load()
+        target_parts = [self.get_target_parts(target) for target in targets]
+        # Hosts only reachable through a proxy can't be probed directly; others are probed at the host name and port ssh actually uses
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(targets) or 1)) as executor:
+            ssh_configs = list(executor.map(lambda parts: sshtools.SshTools.get_effective_config(*parts[:3]) or dict(), target_parts))
+        endpoints = []
+        proxied = dict()  # target -> proxy
+        for target, (_, target_host, target_port, _), ssh_config in zip(targets, target_parts, ssh_configs):
+            proxy = [ssh_config.get(key) for key in ('proxyjump', 'proxycommand') if ssh_config.get(key, 'none') != 'none']
+            if proxy:
+                proxied[target] = proxy[0]
+            endpoints.append((target, ssh_config.get('hostname', target_host), ssh_config.get('port', target_port)))
+        results = self.reachability.probe([(host, port) for target, host, port in endpoints if target not in proxied])
+        return [(target, host, port, *((True, f'not probed, via proxy [{proxied[target]}]') if target in proxied else results[reachability.Reachability.get_key(host, port)]))
+                for target, host, port in endpoints]
+
+    def expand_target(self, target):
+        """Returns the names of the known targets denoted by the given target (glob or "re:" regular expression matching several)"""
+        name, _ = self.get_target_index().find(target)
+        if name is not None:
+            return [target]
+        if target.startswith('re:') or any([ch in target for ch in '*?[']):
+            try:
+                return [name for name, _ in self.get_target_index().match(target)]
+            except re.error:
+                return []
+        return []  # unknown host
+
+    def find_unreachable_targets(self, targets):
+        """Returns the given targets of which no host is reachable via ssh (logging a warning for each unreachable host)"""
+        if not self.cfg.get_item('general.probe_timeout', 2):
+            return []  # probing disabled
+        expanded = { target: self.expand_target(target) for target in targets }
+        results = { result[0]: result for result in self.probe_targets(sorted(set(sum(expanded.values(), [])))) }
+        for name, host, port, reachable, detail in results.values():
+            if not reachable:
+                logger.warning(f'Target [{name}] ([{host}:{port}]) is not reachable [{detail}]')
+        unreachable = []
+        for target, names in expanded.items():
+            if names and not any([results[name][3] for name in names]):
+                unreachable.append(target)
+        return unreachable
+
+    def show_reachability(self, pattern=None):
+        """Probes the targets matching the given pattern and prints the results; returns whether all are reachable"""
+        targets = [name for name, _ in self.get_target_index().match(pattern)]
+        results = self.probe_targets(targets)
+        print(f'{'Target':<24} {'Host':<32} {'Port':<6} Result')
+        for target, host, port, reachable, detail in results:
+            print(f'{target:<24} {host:<32} {port:<6} {'ok' if reachable else 'unreachable'} ({detail})')
+        unreachable = len([result for result in results if not result[3]])
+        print(f'{len(results)} targets, {unreachable} unreachable')
+        return unreachable == 0
+
+    def list_targets(self, pattern=None):
+        """Prints the targets matching the given pattern"""
+        targets = self.get_target_index().match(pattern)
+        print(f'{'Target':<24} {'Host':<32} {'User':<10} {'Port':<6} Key')
+        for name, data in targets:
+            print(f'{name:<24} {data['host'] or '-':<32} {data['user'] or '-':<10} {data['port'] or '-':<6} {'yes' if data['key'] else 'no'}')
+        return len(targets) > 0
+
+    def get_ssh_key_type(self):
+        """Returns the type of ssh keys to create"""
+        key_type = self.cfg.get_item('general.ssh_key_type', 'ed25519')
+        if key_type not in sshtools.key_types:
+            logger.critical(f'Invalid ssh key type [{key_type}]; supported types are {sshtools.key_types}')
+            exit(1)
+        return key_type
+
+    def fill_key_pool(self, count):
+        """Pre-generates ssh key pairs so that preparing targets does not need to wait for key generation"""
+        logger.info(f'Filling ssh key pool [{folder_keypool}] with [{count}] key pairs...')
+        return sshtools.SshTools.fill_pool(folder_keypool, count, key_type=self.get_ssh_key_type())
+
+    def deploy_pubkey(self, target_user, target_host, target_port, keydata, ssh_options='', print_output=True):
+        """Deploy the public key of the given key pair to a remote host"""
+        # In a later version, also get user info from Saltstack roster file; for now, we just assume "root"
+        salt_user = 'root'
+        if target_user == salt_user:
+            return sshtools.SshTools.call_sshcopyid(target_user, target_host, target_port, keydata.pub_key_filename, ssh_options=ssh_options, print_output=print_output)
+        else:
+            return sshtools.SshTools.install_pubkey_usingsudo(target_user, target_host, target_port, keydata.pub_key, ssh_options=ssh_options, print_output=print_output)
+
     def prepare_ssh(self, target):
         """Prepare ssh access to a remote host"""
         logger.debug(f'Preparing ssh access to target [{target}]...')
@@ -377,22 +801,90 @@ class Logic():
         if target_dir is None:
             logger.info('Please create the folder for the target and start over')
             return False
-        keydata = sshtools.SshTools.ensure_keypair(target_dir)
+        keydata = sshtools.SshTools.ensure_keypair(target_dir, key_type=self.get_ssh_key_type(), pool_dir=folder_keypool)
         if keydata is None:
             logger.error('No keypair available')
             return False
         logger.info(f'Using key pair in [{target_dir}]')
         logger.debug(f'Public key is [{keydata.pub_key}]')
-        # In a later version, also get user info from Saltstack roster file; for now, we just assume "root"
-        salt_user = 'root'
-        if target_user == salt_user:
-            result = sshtools.SshTools.call_sshcopyid(target_user, target_host, target_port, keydata.pub_key_filename)
-        else:
-            result = sshtools.SshTools.install_pubkey_usingsudo(target_user, target_host, target_port, keydata.pub_key)
+        result = self.deploy_pubkey(target_user, target_host, target_port, keydata)
         if result:
             logger.info('Deployment of ssh key successful')
         return result
 
+    def read_targets(self, args):
+        """Returns the list of targets given as arguments; arguments starting with "@" denote files listing one target per line"""
+        targets = []
+        for arg in args:
+            if arg.startswith('@'):
+                try:
+                    with open(arg[1:], 'r') as f:
+                        for line in f:
+                            line = line.partition('#')[0].strip()
+                            if line:
+                                targets.append(line)
+                except OSError as e:
+                    logger.critical(f'Could not read targets file [{arg[1:]}] [{e}]')
+                    exit(1)
+            else:
+                targets.append(arg)
+        return targets
+
+    def prepare_ssh_batch(self, targets):
+        """Prepare ssh access to multiple remote hosts concurrently and print a report"""
+        logger.info(f'Preparing ssh access to [{len(targets)}] targets...')
+        results = dict()  # target -> error message (None if successful)
+        target_parts = dict()
+        for target in targets:
+            parts = self.get_target_parts(target)
+            if parts[3] is None:
+                results[target] = 'host directory not found'
+            else:
+                target_parts[target] = parts
+        max_workers = self.cfg.get_item('general.ssh_max_workers', 10)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Create missing key pairs first
+            key_type = self.get_ssh_key_type()
+            keydata = dict(zip(target_parts, executor.map(lambda target: sshtools.SshTools.ensure_keypair(target_parts[target][3], key_type=key_type, pool_dir=folder_keypool), target_parts)))
+            for target, data in keydata.items():
+                if data is None:
+                    results[target] = 'no key pair available'
+            # Deploy public keys; connections are not interactive and multiplexed per host
+            with tempfile.TemporaryDirectory(prefix='saltx_ssh_') as control_dir:
+                control_path = f'{control_dir}/%C'
+                ssh_options = f'-o BatchMode=yes -o ControlMaster=auto -o ControlPath={control_path} -o ControlPersist=10'
+                futures = dict()
+                for target, (target_user, target_host, target_port, _) in target_parts.items():
+                    if keydata[target] is not None:
+                        futures[executor.submit(self.deploy_pubkey, target_user, target_host, target_port, keydata[target], ssh_options=ssh_options, print_output=False)] = target
+                retry = []
+                for future in concurrent.futures.as_completed(futures):
+                    target = futures[future]
+                    try:
+                        results[target] = None if future.result() else 'deployment of public key failed'
+                        if results[target] is not None:
+                            retry.append(target)
+                    except Exception as e:
+                        results[target] = f'deployment of public key failed [{e}]'
+                # Stop the master connections before their sockets are removed
+                list(executor.map(lambda target: sshtools.SshTools.stop_control_master(*target_parts[target][:3], control_path), futures.values()))
+        # Deploy to targets requiring a password (or failing otherwise) one at a time, interactively
+        if retry and sys.stdin.isatty():
+            logger.info(f'Retrying deployment to [{len(retry)}] targets interactively (e.g. asking for passwords)...')
+            for target in [target for target in targets if target in retry]:
+                target_user, target_host, target_port, _ = target_parts[target]
+                logger.info(f'Deploying public key to [{target}]...')
+                with queryuser.prompt_lock:
+                    if self.deploy_pubkey(target_user, target_host, target_port, keydata[target]):
+                        results[target] = None
+        # Print report
+        print(f'{'Target':<40} Result')
+        for target in targets:
+            print(f'{target:<40} {'ok' if results[target] is None else results[target]}')
+        failed = len([result for result in results.values() if result is not None])
+        logger.info(f'Deployment of ssh keys successful for [{len(results) - failed}] targets, failed for [{failed}] targets')
+        return failed == 0
+
     def start_ssh(self, target):
         """Start an ssh shell to a remote host"""
         target_user, target_host, target_port, target_dir = self.get_target_parts(target)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""Class for collecting metrics of a run and exporting them in Prometheus text format"""
+
+import contextlib
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+default_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Metrics():
+
+    def __init__(self, prefix='saltx_'):
+        """Object initialization"""
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.context = threading.local()  # labels added to all metrics recorded by the current thread
+        self.types = dict()  # metric name -> metric type
+        self.descriptions = dict()  # metric name -> help text
+        self.values = dict()  # (metric name, labels) -> value for counters and gauges
+        self.histograms = dict()  # (metric name, labels) -> [bucket counts, sum, count]
+
+    def describe(self, name, metric_type, description):
+        """Sets type and help text of a metric"""
+        self.types[name] = metric_type
+        self.descriptions[name] = description
+
+    def set_context(self, **labels):
+        """Sets labels added to all metrics subsequently recorded by the current thread"""
+        self.context.labels = labels
+
+    def get_key(self, name, labels):
+        """Returns the key for the given metric name and labels (including context labels)"""
+        all_labels = dict(getattr(self.context, 'labels', dict()))
+        if labels is not None:
+            all_labels.update(labels)
+        return (name, tuple(sorted([(key, str(value)) for key, value in all_labels.items()])))
+
+    def inc(self, name, labels=None, value=1):
+        """Increments a counter"""
+        key = self.get_key(name, labels)
+        with self.lock:
+            self.types.setdefault(name, 'counter')
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        """Sets a gauge"""
+        key = self.get_key(name, labels)
+        with self.lock:
+            self.types.setdefault(name, 'gauge')
+            self.values[key] = value
+
+    def observe(self, name, value, labels=None):
+        """Records an observation in a histogram"""
+        key = self.get_key(name, labels)
+        with self.lock:
+            self.types.setdefault(name, 'histogram')
+            histogram = self.histograms.setdefault(key, [[0] * len(default_buckets), 0, 0])
+            for i, bound in enumerate(default_buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=None):
+        """Records the duration of the enclosed block in a histogram"""
+        time_start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - time_start, labels)
+
+    def format_labels(self, labels, extra=None):
+        """Returns the labels in Prometheus text format"""
+        labels = list(labels)
+        if extra is not None:
+            labels.append(extra)
+        if not len(labels):
+            return ''
+        labels = ','.join([f'{key}="{value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')}"' for key, value in labels])
+        return '{' + labels + '}'
+
+    def format(self):
+        """Returns all metrics in Prometheus text format"""
+        lines = []
+        with self.lock:
+            names = { name for name, _ in self.values } | { name for name, _ in self.histograms }
+            for name in sorted(names):
+                full_name = self.prefix + name
+                if name in self.descriptions:
+                    lines.append(f'# HELP {full_name} {self.descriptions[name]}')
+                lines.append(f'# TYPE {full_name} {self.types[name]}')
+                for (key_name, labels), value in sorted(self.values.items()):
+                    if key_name == name:
+                        lines.append(f'{full_name}{self.format_labels(labels)} {value}')
+                for (key_name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                    if key_name == name:
+                        for bound, bucket_count in zip(default_buckets, buckets):
+                            lines.append(f'{full_name}_bucket{self.format_labels(labels, ('le', str(bound)))} {bucket_count}')
+                        lines.append(f'{full_name}_bucket{self.format_labels(labels, ('le', '+Inf'))} {count}')
+                        lines.append(f'{full_name}_sum{self.format_labels(labels)} {total}')
+                        lines.append(f'{full_name}_count{self.format_labels(labels)} {count}')
+        return ''.join([line + '\n' for line in lines])
+
+    def write_textfile(self, filename):
+        """Writes all metrics to the given file atomically (for the node_exporter textfile collector)"""
+        filename = os.path.expanduser(filename)
+        filename_tmp = f'{filename}.{os.getpid()}.tmp'
+        try:
+            with open(filename_tmp, 'w') as f:
+                f.write(self.format())
+            os.replace(filename_tmp, filename)
+        except OSError as e:
+            logger.error(f'Writing metrics to [{filename}] failed [{e}]')
+            return False
+        logger.debug(f'Metrics written to [{filename}]')
+        return True
+
+
+# Metrics of the current run
+registry = Metrics()
+registry.describe('run_timestamp_seconds', 'gauge', 'Time of the Saltx run')
+registry.describe('vault_sync_duration_seconds', 'histogram', 'Duration of syncing a realm with the vault')
+registry.describe('vault_sync_items_total', 'counter', 'Number of items changed by vault sync per operation')
+registry.describe('bw_call_duration_seconds', 'histogram', 'Duration of Bitwarden CLI calls')
+registry.describe('bw_call_failures_total', 'counter', 'Number of failed Bitwarden CLI calls')
+registry.describe('git_duration_seconds', 'histogram', 'Duration of Git operations')
+registry.describe('git_failures_total', 'counter', 'Number of failed Git operations')
+registry.describe('salt_run_duration_seconds', 'histogram', 'Duration of salt-call and salt-ssh runs')
+registry.describe('salt_runs_total', 'counter', 'Number of salt-call and salt-ssh runs per result')
@@ -10,14 +10,17 @@ import threading
 logger = logging.getLogger(__name__)
 
 
-def run_process(command, env=None, cwd=None, shell=False, print_stdout=True, print_stderr=True):
-    """Execute a command and return result"""
+def run_process(command, env=None, cwd=None, shell=False, print_stdout=True, print_stderr=True, stdout_handler=None):
+    """Execute a command and return result (standard output is passed line by line to the handler instead if given)"""
 
     def read_stdout(pipe):
         while True:
             line = pipe.readline()
             if not line:
                 break
+            if stdout_handler is not None:
+                stdout_handler(line)
+                continue
             if print_stdout:
                 print(line, end='')  # prints to stdout
             stdout_lines.append(line)
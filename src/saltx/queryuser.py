@@ -2,14 +2,26 @@
 
 """Class for querying the user for his input"""
 
+import functools
 import getpass
 import logging
 import subprocess
+import threading
 
 from . import setupenv
 
 
 logger = logging.getLogger(__name__)
+prompt_lock = threading.RLock()  # serializes prompts of operations running concurrently (e.g. updates of all instances)
+
+
+def serialize_prompts(func):
+    """Decorator making sure that prompts of concurrently running operations do not interleave"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with prompt_lock:
+            return func(*args, **kwargs)
+    return wrapper
 
 
 class QueryUser():
@@ -19,6 +31,7 @@ class QueryUser():
         """Object initialization"""
         self._expert = None
 
+    @serialize_prompts
     def input_yes_no(self, display_text, default='Yes', expert_question=False):
         """Queries the user for a yes or no answer"""
         if expert_question is not None:
@@ -48,12 +61,14 @@ class QueryUser():
             self._expert = self.query_expert()
         return self._expert
 
+    @serialize_prompts
     def get_input(self, display_text):
         """Queries the user for input"""
         userdata = input(f'{display_text} ')
         userdata = userdata.strip()
         return userdata
 
+    @serialize_prompts
     def get_password(self, display_text):
         """Queries the user for a password"""
         userdata = getpass.getpass(f'{display_text} ')
@@ -143,6 +158,10 @@ class QueryUser():
                 break
         return password
 
+    def get_lazy_unmount(self, path):
+        """Query whether a busy folder shall be unmounted lazily"""
+        return self.input_yes_no(f'Folder [{path}] is busy. Do you want to unmount it lazily (detach now, unmount once no longer used)? [No]', default='No')
+
     def get_purge_local(self):
         """Query whether local Saltx folder shall be removed"""
         return self.input_yes_no(f'Do you really want to completely remove the local Saltx folder? [No]', default='No')
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Class for probing whether target hosts are reachable via ssh before running Salt"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Reachability():
+
+    def __init__(self, cache_filename=None, timeout=2.0, cache_ttl=30, max_workers=500):
+        """Object initialization"""
+        self.cache_filename = cache_filename
+        self.timeout = timeout  # seconds to wait for a TCP connection
+        self.cache_ttl = cache_ttl  # seconds a probe result is reused
+        self.max_workers = max_workers
+        self.results = dict()  # "host:port" -> (time of probe, reachable, detail)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(host, port):
+        """Returns the key of the given endpoint"""
+        return f'{host}:{port}'
+
+    def load(self):
+        """Loads the probe results from the cache file"""
+        if self.cache_filename is None:
+            return
+        try:
+            with open(self.cache_filename, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.debug(f'Ignoring reachability cache [{self.cache_filename}] [{e}]')
+            return
+        with self.lock:
+            for key, value in data.items():
+                self.results[key] = tuple(value)
+
+    def save(self):
+        """Writes the probe results still valid to the cache file"""
+        if self.cache_filename is None:
+            return
+        now = time.time()
+        with self.lock:
+            data = { key: list(value) for key, value in self.results.items() if now - value[0] < self.cache_ttl }
+        filename_tmp = f'{self.cache_filename}.{os.getpid()}.tmp'
+        try:
+            with open(filename_tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(filename_tmp, self.cache_filename)
+        except OSError as e:
+            logger.debug(f'Writing reachability cache [{self.cache_filename}] failed [{e}]')
+
+    def get_cached(self, key):
+        """Returns the cached result (reachable, detail) for the given key (returns 'None' if not cached or expired)"""
+        with self.lock:
+            result = self.results.get(key)
+        if (result is None) or (time.time() - result[0] >= self.cache_ttl):
+            return None
+        return result[1], result[2]
+
+    def probe_endpoint(self, host, port):
+        """Tries to open a TCP connection to the given endpoint; returns reachable and a detail text"""
+        time_start = time.monotonic()
+        try:
+            with socket.create_connection((host, int(port)), timeout=self.timeout):
+                pass
+        except socket.timeout:
+            return False, f'timeout after {self.timeout}s'
+        except (OSError, ValueError) as e:
+            return False, str(e)
+        return True, f'{(time.monotonic() - time_start) * 1000:.0f}ms'
+
+    def probe(self, endpoints):
+        """Probes the given (host, port) endpoints concurrently; returns a dictionary "host:port" -> (reachable, detail)"""
+        results = dict()
+        pending = []
+        for host, port in set(endpoints):
+            key = self.get_key(host, port)
+            result = self.get_cached(key)
+            if result is None:
+                pending.append((key, host, port))
+            else:
+                results[key] = result
+        if pending:
+            logger.debug(f'Probing [{len(pending)}] endpoints ([{len(results)}] cached)')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as executor:
+                futures = { key: executor.submit(self.probe_endpoint, host, port) for key, host, port in pending }
+            now = time.time()
+            with self.lock:
+                for key, future in futures.items():
+                    results[key] = future.result()
+                    self.results[key] = (now, *results[key])
+            self.save()
+        return results
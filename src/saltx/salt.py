@@ -4,8 +4,11 @@
 
 import logging
 import os
+import time
 
+from . import metrics
 from . import processexec
+from . import saltconf
 from . import setupenv
 
 
@@ -14,11 +17,12 @@ logger = logging.getLogger(__name__)
 
 class Salt():
     
-    def __init__(self, folder_main, folder_pub, folder_priv, queryuserobj=None):
+    def __init__(self, folder_main, folder_pub, folder_priv, queryuserobj=None, settings=None):
         """Object initialization"""
         self.folder_main = folder_main
         self.folder_pub = folder_pub
         self.folder_priv = folder_priv
+        self.settings = settings  # settings for the configuration templates
         assert queryuserobj is not None
         self.queryuserobj = queryuserobj
 
@@ -62,17 +66,72 @@ class Salt():
                 logger.critical('Saltstack is not available on this system')
                 exit(1)
 
+    def is_conf_current(self):
+        """Checks whether the Salt configuration was generated from the current template, paths and settings"""
+        salt_dir = os.path.dirname(self.get_saltfile_name())
+        params = saltconf.get_params(salt_dir, os.path.join(salt_dir, 'roster'), self.folder_pub, self.folder_priv, self.settings)
+        return saltconf.is_current(salt_dir, params)
+
     def ensure_configured(self):
-        """Make sure that Salt configuration files are present"""
+        """Make sure that Salt configuration files are present and up-to-date"""
         if self.is_configured():
-            return True
+            if self.is_conf_current():
+                return True
+            logger.info('Regenerating Salt configuration as template, paths or settings changed')
         saltfile_name = self.get_saltfile_name()
-        result = setupenv.write_salt_conf(saltfile_name, self.folder_pub, self.folder_priv)
+        result = setupenv.write_salt_conf(saltfile_name, self.folder_pub, self.folder_priv, settings=self.settings)
         if result:
             result = setupenv.write_saltfile(saltfile_name)
         return result
 
-    def run_salt_call_locally(self, args_string):
+    def write_conf_for_folder_priv(self, folder_priv, config_dir):
+        """Writes a separate Salt configuration using another private folder and returns its Saltfile name"""
+        saltfile_name = os.path.join(config_dir, 'Saltfile')
+        root_dir = os.path.dirname(self.get_saltfile_name())
+        result = setupenv.write_salt_conf(saltfile_name, self.folder_pub, folder_priv, root_dir=root_dir, settings=self.settings)
+        if result:
+            result = setupenv.write_saltfile(saltfile_name)
+        return saltfile_name if result else None
+
+    def get_target_cache_dir(self, target):
+        """Returns the directory in which salt-ssh caches the data (e.g. grains) of the given target"""
+        return os.path.join(os.path.dirname(self.get_saltfile_name()), 'cache', 'minions', target)
+
+    def get_target_cache_age(self, target):
+        """Returns the age (in minutes) of the cached grains of the given target (returns 'None' if not cached)"""
+        try:
+            mtime = os.stat(os.path.join(self.get_target_cache_dir(target), 'ssh_data.p')).st_mtime
+        except OSError:
+            return None
+        return (time.time() - mtime) / 60
+
+    def ensure_target_cache_dir(self, target):
+        """Make sure that the cache directory of the given target exists and is only accessible by the user"""
+        cache_dir = self.get_target_cache_dir(target)
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        return cache_dir
+
+    def record_run(self, command, target, ok, duration):
+        """Records a Salt run in the metrics of this run"""
+        labels = { 'command': command, 'target': '' if (target is None) else target }
+        metrics.registry.observe('salt_run_duration_seconds', duration, labels)
+        metrics.registry.inc('salt_runs_total', labels | { 'result': 'success' if ok else 'failure' })
+
+    def run_captured(self, command, args_string, recorder=None, requires_root=False):
+        """Runs the given Salt command; if a recorder is given, Salt's JSON output is captured by it"""
+        if recorder is None:
+            rc, _, _ = setupenv.run_process(f'{command} --force-color {args_string}', requires_root=requires_root)
+            return rc
+        recorder.open()
+        rc = -1
+        try:
+            rc, _, _ = setupenv.run_process(f'{command} --out=json {args_string}', requires_root=requires_root, stdout_handler=recorder.handle_line)
+        finally:
+            recorder.close(rc)
+        logger.info(f'Results written to [{recorder.filename}]')
+        return rc
+
+    def run_salt_call_locally(self, args_string, recorder=None):
         """Runs 'salt-call --local' with the provided arguments"""
         if not self.is_installed():
             logger.critical('"salt-call" is not installed (run "saltx initlocal" first). Aborting.')
@@ -80,10 +139,12 @@ class Salt():
         if not self.is_configured():
             logger.critical('Salt is not configured (run "saltx initlocal" first). Aborting.')
             exit(1)
-        rc, _, _ = setupenv.run_process(f'salt-call --local --force-color {args_string}', requires_root=True)
+        time_start = time.monotonic()
+        rc = self.run_captured('salt-call --local', args_string, recorder=recorder, requires_root=True)
+        self.record_run('salt-call', None, rc == 0, time.monotonic() - time_start)
         return rc == 0
 
-    def run_salt_ssh(self, args_string, folder_main):
+    def run_salt_ssh(self, args_string, folder_main, target=None, recorder=None):
         """Runs 'salt-ssh' with the provided arguments"""
         if not self.is_installed():
             logger.critical('"salt-ssh" is not installed (run "saltx initmaster" first). Aborting.')
@@ -91,5 +152,7 @@ class Salt():
         if not self.is_configured():
             logger.critical('Salt is not configured (run "saltx initmaster" first). Aborting.')
             exit(1)
-        rc, _, _ = setupenv.run_process(f'salt-ssh --force-color {args_string}')
+        time_start = time.monotonic()
+        rc = self.run_captured('salt-ssh', args_string, recorder=recorder)
+        self.record_run('salt-ssh', target, rc == 0, time.monotonic() - time_start)
         return rc == 0
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""Templates for the Salt master and minion configuration generated by Saltx"""
+
+import hashlib
+import jinja2
+import json
+import logging
+import os
+import textwrap
+import yaml
+
+
+logger = logging.getLogger(__name__)
+template_version = 3  # increase on each change of the templates so that existing configurations are regenerated
+stamp_filename = 'saltx_conf.json'  # file in the Salt config directory recording what the configuration was generated from
+
+default_settings = {
+    'ssh_max_procs': 25,  # number of targets salt-ssh works on concurrently
+    'worker_threads': 5,
+    'pillar_cache': False,  # caching rendered pillars means vault updates become visible only after the TTL
+    'pillar_cache_ttl': 3600,
+    'grains_cache_expiration': 300,
+    'ssh_cache_life': 60,  # minutes salt-ssh reuses the cached grains of a target
+    'fileserver_list_cache_time': 20,
+    'ssh_minion_opts': dict(),  # additional minion options for salt-ssh targets
+    'master_opts': dict(),  # additional options for the master configuration
+    'minion_opts': dict(),  # additional options for the minion configuration
+}
+
+common_template = '''
+    # Generated by Saltx (template version {{ version }}); changes are overwritten
+    root_dir: {{ root_dir }}
+    cachedir: {{ root_dir }}/cache
+
+    file_roots:
+      base:
+        - {{ folder_priv }}/state
+        - {{ folder_pub }}/state
+
+    pillar_roots:
+      base:
+        - {{ folder_priv }}/pillar
+        - {{ folder_pub }}/pillar
+
+    fileserver_backend:
+      - roots
+    fileserver_list_cache_time: {{ settings.fileserver_list_cache_time }}
+'''
+
+master_template = common_template + '''
+    roster_file: {{ roster_file }}
+
+    minion_data_cache: true
+    cache_life: {{ settings.ssh_cache_life }}
+    pillar_cache: {{ settings.pillar_cache | tojson }}
+    pillar_cache_ttl: {{ settings.pillar_cache_ttl }}
+    pillar_cache_backend: disk
+
+    worker_threads: {{ settings.worker_threads }}
+    ssh_max_procs: {{ settings.ssh_max_procs }}
+    {%- if settings.ssh_minion_opts %}
+    ssh_minion_opts: {{ settings.ssh_minion_opts | tojson }}
+    {%- endif %}
+    {%- for key, value in settings.master_opts.items() %}
+    {{ key }}: {{ value | tojson }}
+    {%- endfor %}
+'''
+
+minion_template = common_template + '''
+    roster_file: {{ roster_file }}
+
+    file_client: local
+    grains_cache: true
+    grains_cache_expiration: {{ settings.grains_cache_expiration }}
+    {%- for key, value in settings.minion_opts.items() %}
+    {{ key }}: {{ value | tojson }}
+    {%- endfor %}
+'''
+
+
+def get_settings(settings=None):
+    """Returns the settings for the templates with defaults applied"""
+    result = dict(default_settings)
+    result.update({ key: value for key, value in (settings or dict()).items() if value is not None })
+    return result
+
+def get_params(root_dir, roster_file, folder_pub, folder_priv, settings=None):
+    """Returns all parameters the configuration is generated from"""
+    return { 'version': template_version, 'root_dir': root_dir, 'roster_file': roster_file,
+             'folder_pub': folder_pub, 'folder_priv': folder_priv, 'settings': get_settings(settings) }
+
+def get_params_hash(params):
+    """Returns a hash of the given parameters"""
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def render(template, params):
+    """Renders the given template with the given parameters"""
+    config = jinja2.Template(textwrap.dedent(template).lstrip()).render(**params)
+    yaml.load(config, Loader=yaml.SafeLoader)  # make sure that the result is valid
+    return config + '\n'
+
+def is_current(salt_dir, params):
+    """Returns whether the configuration in the given directory was generated from the given parameters"""
+    try:
+        with open(os.path.join(salt_dir, stamp_filename), 'r') as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return stamp.get('hash') == get_params_hash(params)
+
+def write(salt_dir, params):
+    """Writes master and minion configuration to the given directory"""
+    master_name = os.path.join(salt_dir, 'master')
+    minion_name = os.path.join(salt_dir, 'minion')
+    logger.debug(f'Writing Salt master config file [{master_name}] and minion config file [{minion_name}]')
+    with open(master_name, 'w') as f:
+        f.write(render(master_template, params))
+    with open(minion_name, 'w') as f:
+        f.write(render(minion_template, params))
+    with open(os.path.join(salt_dir, stamp_filename), 'w') as f:
+        json.dump({ 'version': template_version, 'hash': get_params_hash(params) }, f)
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for capturing the JSON output of Salt runs per target and summarizing the results"""
+
+import datetime
+import json
+import logging
+import os
+import re
+import shlex
+import sys
+import textwrap
+import yaml
+
+
+logger = logging.getLogger(__name__)
+state_functions = ['state.apply', 'state.highstate', 'state.sls', 'state.sls_id', 'state.single', 'state.top']  # functions whose results are captured
+summary_suffix = '.summary.json'
+max_comment_length = 500  # characters of a state comment kept in the summary
+
+token_re = re.compile(r'["{}\[\],:]')
+string_re = re.compile(r'["\\]')
+colors = { 'Clean': '\033[0;32m', 'Changed': '\033[0;36m', 'Failed': '\033[0;31m', 'Differs': '\033[0;33m' }
+color_reset = '\033[0;0m'
+
+
+def is_capturable(args_string):
+    """Returns whether the output of a Salt run with the given arguments shall be captured"""
+    try:
+        args = shlex.split(args_string)
+    except ValueError:
+        return False
+    if any([(arg == '--out') or arg.startswith('--out=') or (arg == '--static') for arg in args]):
+        return False  # the user chose the output format
+    return any([arg in state_functions for arg in args])
+
+def parse_state_key(key):
+    """Returns state ID and function (e.g. "file.managed") of the given state key"""
+    parts = key.split('_|-')
+    if len(parts) != 4:
+        return key, ''
+    return parts[1], f'{parts[0]}.{parts[3]}'
+
+def get_duration(state):
+    """Returns the duration of the given state result in milliseconds"""
+    duration = state.get('duration', 0)
+    if isinstance(duration, str):
+        duration = duration.split()[0]  # older Salt versions: "1.23 ms"
+    try:
+        return float(duration)
+    except ValueError:
+        return 0.0
+
+def get_status(state):
+    """Returns the status of the given state result like Salt's terse output does"""
+    if state.get('result') is False:
+        return 'Failed'
+    if state.get('result') is None:
+        return 'Differs'
+    return 'Changed' if state.get('changes') else 'Clean'
+
+
+class OutputParser():
+    """Incrementally parses the JSON documents printed by Salt ("{target: {key: value, ...}}")
+
+    The callback is called with target, key and value for each entry of a target's result. If the result of a target
+    is no dictionary, key is 'None'. Only a single value is kept in memory at a time."""
+
+    def __init__(self, callback):
+        """Object initialization"""
+        self.callback = callback
+        self.stack = []  # open containers ('{' or '[')
+        self.expect = 'value'  # whether a key or a value is expected next (None after a value)
+        self.in_string = False
+        self.escape = False
+        self.keys = [None, None]  # current target and current key
+        self.key_chunks = None  # chunks of the key being read
+        self.value_chunks = None  # chunks of the value being captured
+        self.value_depth = None  # depth of the value being captured
+        self.value_is_container = False
+
+    def start_value(self, text):
+        """Starts capturing a value"""
+        self.value_chunks = [text]
+        self.value_depth = len(self.stack)
+
+    def finish_value(self):
+        """Finishes capturing a value and passes it to the callback"""
+        text = ''.join(self.value_chunks)
+        depth = self.value_depth
+        self.value_chunks = None
+        self.value_depth = None
+        self.value_is_container = False
+        self.expect = None
+        try:
+            value = json.loads(text)
+        except ValueError as e:
+            logger.warning(f'Ignoring invalid value in Salt output [{e}]')
+            return
+        if depth == 2:
+            self.callback(self.keys[0], self.keys[1], value)
+        elif depth == 1:
+            self.callback(self.keys[0], None, value)
+
+    def feed_string(self, text, pos):
+        """Processes text within a string; returns the new position"""
+        if self.escape:
+            end = pos + 1
+            self.escape = False
+        else:
+            match = string_re.search(text, pos)
+            if match is None:
+                end = len(text)
+            else:
+                end = match.end()
+                if match.group() == '\\':
+                    self.escape = True
+                else:
+                    self.in_string = False
+        chunk = text[pos:end]
+        if self.key_chunks is not None:
+            self.key_chunks.append(chunk)
+            if not self.in_string:
+                key = json.loads(''.join(self.key_chunks))
+                self.key_chunks = None
+                self.keys[len(self.stack) - 1] = key
+                if len(self.stack) == 1:
+                    self.keys[1] = None
+        elif self.value_chunks is not None:
+            self.value_chunks.append(chunk)
+        return end
+
+    def feed_token(self, token):
+        """Processes a structural character outside of strings"""
+        depth = len(self.stack)
+        if self.value_chunks is not None:
+            if self.value_is_container:
+                self.value_chunks.append(token)
+                if token in '{[':
+                    self.stack.append(token)
+                elif token in '}]':
+                    self.stack.pop()
+                    if len(self.stack) == self.value_depth:
+                        self.finish_value()
+                elif token == '"':
+                    self.in_string = True
+                return
+            if token not in ',}]':
+                self.value_chunks.append(token)
+                if token == '"':
+                    self.in_string = True
+                return
+            self.finish_value()  # a scalar value ends with the next separator
+        if token == '"':
+            self.in_string = True
+            if (self.expect == 'key') and (depth in [1, 2]):
+                self.key_chunks = ['"']
+            elif (self.expect == 'value') and (depth in [1, 2]):
+                self.start_value('"')
+        elif token in '{[':
+            if (self.expect == 'value') and (depth == 1) and (token == '{'):
+                self.stack.append(token)  # dictionary of a target
+                self.expect = 'key'
+            elif (self.expect == 'value') and (depth in [1, 2]):
+                self.start_value(token)
+                self.value_is_container = True
+                self.stack.append(token)
+            else:
+                self.stack.append(token)
+                self.expect = 'key' if token == '{' else 'value'
+        elif token in '}]':
+            if self.stack:
+                self.stack.pop()
+            self.expect = None
+            if not self.stack:
+                self.keys = [None, None]  # document finished
+                self.expect = 'value'
+        elif token == ',':
+            self.expect = 'key' if (self.stack and (self.stack[-1] == '{')) else 'value'
+        elif token == ':':
+            self.expect = 'value'
+
+    def feed(self, text):
+        """Processes the next part of the output"""
+        pos = 0
+        while pos < len(text):
+            if self.in_string:
+                pos = self.feed_string(text, pos)
+                continue
+            match = token_re.search(text, pos)
+            end = len(text) if (match is None) else match.start()
+            skipped = text[pos:end]
+            if self.value_chunks is not None:
+                self.value_chunks.append(skipped)
+            elif (self.expect == 'value') and (len(self.stack) in [1, 2]) and skipped.strip():
+                self.start_value(skipped)  # scalar value (number, true, false, null)
+            if match is None:
+                break
+            self.feed_token(match.group())
+            pos = match.end()
+
+    def close(self):
+        """Finishes parsing"""
+        if (self.value_chunks is not None) and not self.value_is_container:
+            self.finish_value()
+        if self.stack or self.in_string:
+            logger.warning('Salt output ended unexpectedly')
+
+
+class ResultRecorder():
+    """Captures the JSON output of a Salt run into a result file and prints it in human readable form"""
+
+    def __init__(self, results_dir, target, command, args_string, keep=20):
+        """Object initialization"""
+        self.results_dir = results_dir
+        self.target = target
+        self.command = command
+        self.args_string = args_string
+        self.keep = keep  # number of result files kept per target
+        self.time_start = datetime.datetime.now()
+        self.folder = os.path.join(results_dir, get_target_folder_name(target))
+        self.filename = os.path.join(self.folder, f'{self.time_start.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.json')
+        self.file = None
+        self.parser = OutputParser(self.handle_entry)
+        self.color = sys.stdout.isatty()
+        self.host = None  # host whose results are currently printed
+        self.hosts = dict()  # host -> counters
+        self.changed = []
+        self.failed = []
+
+    def open(self):
+        """Opens the result file"""
+        os.makedirs(self.folder, mode=0o700, exist_ok=True)
+        self.file = open(self.filename, 'w')
+        logger.debug(f'Capturing Salt results in [{self.filename}]')
+
+    def handle_line(self, line):
+        """Handles a line of Salt's standard output"""
+        self.file.write(line)
+        self.parser.feed(line)
+
+    def handle_entry(self, host, key, value):
+        """Handles an entry of Salt's output for a host"""
+        if host != self.host:
+            self.print_host_summary()
+            self.host = host
+            print(f'{host}:')
+        if (key is not None) and ('_|-' in key) and isinstance(value, dict):
+            self.handle_state(host, key, value)
+        elif key is None:
+            if isinstance(value, list) or (value is False):
+                self.get_counters(host)['failed'] += 1
+                self.failed.append({ 'host': host, 'id': '(result)', 'function': '', 'duration': 0.0, 'comment': str(value)[:max_comment_length] })
+            print(textwrap.indent(format_value(value), '    '))
+        else:
+            print(textwrap.indent(format_value({ key: value }), '    '))
+
+    def get_counters(self, host):
+        """Returns the counters of the given host"""
+        return self.hosts.setdefault(host, { 'total': 0, 'changed': 0, 'failed': 0, 'duration': 0.0 })
+
+    def handle_state(self, host, key, state):
+        """Handles the result of a state"""
+        state_id, function = parse_state_key(key)
+        status = get_status(state)
+        duration = get_duration(state)
+        counters = self.get_counters(host)
+        counters['total'] += 1
+        counters['duration'] += duration
+        entry = { 'host': host, 'id': state.get('__id__', state_id), 'function': function, 'duration': duration }
+        if status == 'Failed':
+            counters['failed'] += 1
+            self.failed.append(entry | { 'comment': str(state.get('comment', ''))[:max_comment_length] })
+        elif status == 'Changed':
+            counters['changed'] += 1
+            self.changed.append(entry)
+        if status == 'Clean':
+            text = f'  Name: {state.get("name", state_id)} - Function: {function} - Result: {status} - Duration: {duration:.1f} ms'
+        else:
+            text = format_state_details(state, state_id, function, duration)  # like Salt's "state_output: changes"
+        print(f'{colors[status]}{text}{color_reset}' if self.color else text)
+
+    def print_host_summary(self):
+        """Prints the summary of the states of the current host"""
+        counters = self.hosts.get(self.host)
+        if (counters is None) or (counters['total'] == 0):
+            return
+        print()
+        print(f'Summary for {self.host}')
+        print(f'Succeeded: {counters["total"] - counters["failed"]} (changed={counters["changed"]})')
+        print(f'Failed:    {counters["failed"]}')
+        print(f'Total states run: {counters["total"]}')
+        print(f'Total run time: {counters["duration"] / 1000:.3f} s')
+
+    def close(self, rc):
+        """Finishes capturing and writes the summary of the run"""
+        self.parser.close()
+        self.print_host_summary()
+        self.file.close()
+        summary = {
+            'target': self.target, 'command': self.command, 'args': self.args_string, 'rc': rc,
+            'start': self.time_start.isoformat(timespec='seconds'),
+            'duration': (datetime.datetime.now() - self.time_start).total_seconds(),
+            'hosts': self.hosts, 'changed': self.changed, 'failed': self.failed,
+        }
+        with open(self.filename.removesuffix('.json') + summary_suffix, 'w') as f:
+            json.dump(summary, f)
+        self.remove_old_results()
+
+    def remove_old_results(self):
+        """Removes the results of all but the latest runs of the target"""
+        summaries = sorted([name for name in os.listdir(self.folder) if name.endswith(summary_suffix)])
+        for name in summaries[:-self.keep] if (self.keep > 0) else []:
+            base = name.removesuffix(summary_suffix)
+            for filename in [name, base + '.json']:
+                try:
+                    os.remove(os.path.join(self.folder, filename))
+                except FileNotFoundError:
+                    pass
+
+
+def format_nested(value, indent=0):
+    """Returns the lines of the given value formatted like Salt's nested outputter (multiline strings such as diffs as they are)"""
+    prefix = ' ' * indent
+    if isinstance(value, dict):
+        lines = [prefix + '----------']
+        for key, item in value.items():
+            if isinstance(item, (dict, list)) or (isinstance(item, str) and ('\n' in item)):
+                lines.append(f'{prefix}{key}:')
+                lines += format_nested(item, indent + 4)
+            else:
+                lines.append(f'{prefix}{key}: {'' if item is None else item}')
+        return lines
+    if isinstance(value, list):
+        lines = []
+        for item in value:
+            if isinstance(item, (dict, list)):
+                lines += format_nested(item, indent)
+            else:
+                lines.append(f'{prefix}- {item}')
+        return lines
+    return [prefix + line for line in str(value).splitlines()]
+
+def format_state_details(state, state_id, function, duration):
+    """Returns the result of a state with comment and changes formatted like Salt's highstate outputter"""
+    comment = str(state.get('comment', '')).rstrip('\n').replace('\n', '\n' + ' ' * 14)
+    lines = [
+        '----------',
+        f'          ID: {state.get("__id__", state_id)}',
+        f'    Function: {function}',
+        f'        Name: {state.get("name", state_id)}',
+        f'      Result: {state.get("result")}',
+        f'     Comment: {comment}',
+        f'     Started: {state.get("start_time", "")}',
+        f'    Duration: {duration:.1f} ms',
+        '     Changes:',
+    ]
+    if state.get('changes'):
+        lines += format_nested(state['changes'], 14)
+    return '\n'.join(lines)
+
+def format_value(value):
+    """Returns the given value in human readable form (YAML)"""
+    if not isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return yaml.safe_dump(value, default_flow_style=False, allow_unicode=True).rstrip('\n')
+
+def format_state(state):
+    """Returns host, ID, function and duration of the given state of a summary in one line"""
+    function = f' ({state["function"]})' if state['function'] else ''
+    return f'{state["host"]}: {state["id"]}{function} {state["duration"]:.1f} ms'
+
+def get_target_folder_name(target):
+    """Returns the name of the results folder of the given target"""
+    return re.sub(r'[^A-Za-z0-9._@-]', '_', target) or '_'
+
+def load_summaries(results_dir, target=None, count=5):
+    """Returns the summaries of the latest runs (of the given target), oldest first"""
+    if not os.path.isdir(results_dir):
+        return []
+    folders = [get_target_folder_name(target)] if (target is not None) else os.listdir(results_dir)
+    names = []
+    for folder in folders:
+        folder = os.path.join(results_dir, folder)
+        if os.path.isdir(folder):
+            names += [(name, os.path.join(folder, name)) for name in os.listdir(folder) if name.endswith(summary_suffix)]
+    summaries = []
+    for _, filename in sorted(names)[-count:]:
+        try:
+            with open(filename, 'r') as f:
+                summaries.append(json.load(f) | { 'file': filename.removesuffix(summary_suffix) + '.json' })
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring invalid result summary [{filename}] [{e}]')
+    return summaries
+
+def print_summaries(summaries):
+    """Prints the changed and failed states and durations of the given runs"""
+    for summary in summaries:
+        hosts = summary['hosts'].values()
+        total = sum([host['total'] for host in hosts])
+        changed = sum([host['changed'] for host in hosts])
+        failed = sum([host['failed'] for host in hosts])
+        print(f'{summary["start"]}  {summary["command"]} {summary["args"]}')
+        print(f'  Exit code: {summary["rc"]}  Duration: {summary["duration"]:.1f}s  States: {total}  Changed: {changed}  Failed: {failed}  Hosts: {len(summary["hosts"])}')
+        for state in summary['failed']:
+            print(f'  FAILED   {format_state(state)}')
+            print(textwrap.indent(state['comment'].strip(), '           '))
+        for state in summary['changed']:
+            print(f'  CHANGED  {format_state(state)}')
+        print(f'  Result file: {summary["file"]}')
+        print()
+    if not summaries:
+        print('No results captured yet')
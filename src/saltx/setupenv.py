@@ -2,6 +2,7 @@
 
 """Helper functions for interacting and setting up the software environment"""
 
+import hashlib
 import logging
 import os
 import pathlib
@@ -12,8 +13,11 @@ import subprocess
 import tempfile
 import textwrap
 import time
+import urllib.request
+import zipfile
 
 from . import processexec
+from . import saltconf
 
 
 apt_os = ['debian', 'linuxmint', 'ubuntu']
@@ -58,7 +62,7 @@ def get_os_pkgmanager():
         logger.error(f'Unsupported Linux [{id}]')
         return None
 
-def run_process(command, env=None, cwd=None,  shell=False, print_stdout=True, print_stderr=True, requires_root=False, preserve_env=False, exit_on_error=None):
+def run_process(command, env=None, cwd=None,  shell=False, print_stdout=True, print_stderr=True, requires_root=False, preserve_env=False, exit_on_error=None, stdout_handler=None):
     """Execute a command and return result"""
     if requires_root:
         if not is_root():
@@ -70,7 +74,7 @@ def run_process(command, env=None, cwd=None,  shell=False, print_stdout=True, pr
                 logger.critical(f'Can\'t run command [{command}] as "sudo" tool is not installed. Aborting.')
                 exit(exit_on_error)
                 return -1, None, None
-    rc, out, err = processexec.run_process(command, env=env, cwd=cwd, shell=shell, print_stdout=print_stdout, print_stderr=print_stderr)
+    rc, out, err = processexec.run_process(command, env=env, cwd=cwd, shell=shell, print_stdout=print_stdout, print_stderr=print_stderr, stdout_handler=stdout_handler)
     if (rc != 0) and (exit_on_error is not None):
         logger.critical(f'Running command [{command}] failed, return code [{rc}]. Aborting.')
         exit(exit_on_error)
@@ -118,25 +122,98 @@ def touch_file(filename):
     with open(filename, 'a'):  # "append" avoid unneeded truncate
         os.utime(filename, None)  # update the modification and access times to the current time
 
-def download_bitwarden_cli(url, target):
-    """Downloads and extracts the Bitwarden CLI tool"""
+def is_private_dir(dirname):
+    """Returns whether the given directory is owned by the current user and not writable by others"""
+    dir_stat = os.stat(dirname)
+    return (dir_stat.st_uid == os.getuid()) and not (dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+def get_download_cache_dir(cache_dir=None, private=False):
+    """Returns the directory for caching downloads (system-wide if writable, user-specific otherwise; only user-private ones if requested)"""
+    if cache_dir is not None:
+        candidates = [cache_dir]
+    else:
+        candidates = ['/var/cache/saltx']
+    candidates.append('~/.cache/saltx')
+    for candidate in candidates:
+        candidate = os.path.expanduser(candidate)
+        try:
+            os.makedirs(candidate, mode=0o700, exist_ok=True)
+        except OSError:
+            continue
+        if os.access(candidate, os.W_OK | os.X_OK) and (not private or is_private_dir(candidate)):
+            return candidate
+    return None
+
+def get_file_sha256(filename):
+    """Returns the SHA-256 digest of the given file as hex string"""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def download_to_cache(url, sha256=None, cache_dir=None):
+    """Returns the filename of the cached download of the given URL; downloads it if not yet cached"""
+    # Without a configured digest, the cached file is looked up by a mapping from URL to digest; as others could tamper with
+    # this mapping in a shared cache directory, only a user-private cache directory is used in this case
+    pinned = sha256 is not None
+    cache_dir = get_download_cache_dir(cache_dir, private=not pinned)
+    if cache_dir is None:
+        raise Exception('No writable download cache directory available')
+    # Files are stored by their SHA-256 digest
+    url_filename = os.path.join(cache_dir, 'url_' + hashlib.sha256(url.encode()).hexdigest())
+    if not pinned:
+        logger.warning(f'No SHA-256 digest configured for [{url}]; the download is not verified')
+        try:
+            with open(url_filename, 'r') as f:
+                sha256 = f.read().strip()
+        except FileNotFoundError:
+            pass
+    if sha256 is not None:
+        cached_filename = os.path.join(cache_dir, sha256.lower())
+        if os.path.isfile(cached_filename):
+            if get_file_sha256(cached_filename) == sha256.lower():
+                logger.info(f'Using cached download [{cached_filename}] for [{url}]')
+                return cached_filename
+            logger.warning(f'Cached download [{cached_filename}] is corrupt; downloading again')
+    logger.info(f'Downloading [{url}]...')
+    with tempfile.NamedTemporaryFile(dir=cache_dir, prefix='download_', delete=False) as f:
+        filename_tmp = f.name
+    try:
+        with open(filename_tmp, 'wb') as f, urllib.request.urlopen(url) as response:
+            shutil.copyfileobj(response, f)
+        digest = get_file_sha256(filename_tmp)
+        if pinned and (digest != sha256.lower()):
+            raise Exception(f'SHA-256 digest [{digest}] of download [{url}] does not match expected digest [{sha256}]')
+        cached_filename = os.path.join(cache_dir, digest)
+        os.chmod(filename_tmp, 0o644)  # allow other users to use the cache
+        os.replace(filename_tmp, cached_filename)
+    finally:
+        if os.path.exists(filename_tmp):
+            os.remove(filename_tmp)
+    if not pinned:
+        with open(url_filename, 'w') as f:
+            f.write(digest)
+    return cached_filename
+
+def download_bitwarden_cli(url, target, sha256=None, cache_dir=None):
+    """Downloads (using a cache) and extracts the Bitwarden CLI tool"""
     target_dir = os.path.dirname(target)
-    target_tmp = os.path.join(target_dir, 'bw.zip')
+    target_tmp = None
     try:
         os.makedirs(target_dir, exist_ok=True)
-        #subprocess.run(['wget', '-O', target_tmp, url], check=True)        
-        command = f'wget -o /dev/null -O {target_tmp} {url}'
-        rc, _, _ = run_process(command)
-        if rc != 0:
-            raise Exception(f'Command [{command}] failed')
-        #subprocess.run(['unzip', target_tmp, '-d', target_dir], check=True)
-        command = f'unzip {target_tmp} -d {target_dir}'
-        rc, _, _ = run_process(command)
-        if rc != 0:
-            raise Exception(f'Command [{command}] failed')
-        os.remove(target_tmp)
+        zip_filename = download_to_cache(url, sha256=sha256, cache_dir=cache_dir)
+        with zipfile.ZipFile(zip_filename) as zip_file:
+            # Extract to a temporary file first so that the tool is replaced atomically
+            with zip_file.open('bw') as source, tempfile.NamedTemporaryFile(dir=target_dir, prefix='bw_', delete=False) as f:
+                target_tmp = f.name
+                shutil.copyfileobj(source, f)
+        os.chmod(target_tmp, 0o755)
+        os.replace(target_tmp, target)
     except Exception as e:
         logger.error(str(e))
+        if (target_tmp is not None) and os.path.exists(target_tmp):
+            os.remove(target_tmp)
         return False
     if not os.path.isfile(target):
         logger.error('No error downloading and extracting Bitwarden CLI tool; but tool is still not present as expected')
@@ -265,38 +342,22 @@ def write_saltfile(saltfile_name):
         f.write(config)
     return True
 
-def write_salt_conf(saltfile_name, folder_pub, folder_priv):
-    """Write Salt configuration"""
+def write_salt_conf(saltfile_name, folder_pub, folder_priv, root_dir=None, settings=None):
+    """Write Salt configuration from the templates (using another root directory than the config directory if provided)"""
     # Salt directory
     salt_dir = os.path.dirname(saltfile_name)
     if not os.path.isdir(salt_dir):
         os.mkdir(salt_dir)
+    write_roster = root_dir is None  # a separate root directory already contains its roster file
+    if root_dir is None:
+        root_dir = salt_dir
+    roster_name = os.path.join(root_dir, 'roster')
     # Salt master file and minion file
-    master_name = os.path.join(salt_dir, 'master')
-    minion_name = os.path.join(salt_dir, 'minion')
-    logger.debug(f'Writing Salt master config file [{master_name}] and minion config file [{minion_name}]')
-    config = f'''
-        root_dir: {salt_dir}
-
-        file_roots:
-          base:
-            - {folder_priv}/state
-            - {folder_pub}/state
-        
-        pillar_roots:
-          base:
-            - {folder_priv}/pillar
-            - {folder_pub}/pillar
-    '''
-    config = textwrap.dedent(config).lstrip()
-    with open(master_name, 'w') as f:
-        f.write(config)
-    with open(minion_name, 'w') as f:
-        f.write(config)
+    saltconf.write(salt_dir, saltconf.get_params(root_dir, roster_name, folder_pub, folder_priv, settings))
     # Salt roster file
-    roster_name = os.path.join(salt_dir, 'roster')
-    logger.debug(f'Writing Salt roster config file [{roster_name}]')    
-    with open(roster_name, 'w') as f:
-        f.write('')
+    if write_roster and not os.path.exists(roster_name):
+        logger.debug(f'Writing Salt roster config file [{roster_name}]')    
+        with open(roster_name, 'w') as f:
+            f.write('')
     # All successful
     return True
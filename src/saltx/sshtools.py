@@ -6,10 +6,17 @@ import collections
 import logging
 import os
 import random
+import shutil
 import string
 import subprocess
 import tempfile
 
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+except ImportError:
+    serialization = None  # fall back to using ssh-keygen
+
 from . import setupenv
 
 
@@ -17,13 +24,21 @@ logger = logging.getLogger(__name__)
 
 
 KeyPairData = collections.namedtuple('KeyPairData', ['priv_key', 'pub_key', 'priv_key_filename', 'pub_key_filename'])
+key_types = ['ed25519', 'ecdsa', 'rsa']  # supported key types in order of preference when looking for existing keys
 
 
 class SshTools():
 
     @staticmethod
-    def get_filenames(dirname):
-        priv_key_filename = os.path.join(dirname, 'id_rsa')
+    def get_filenames(dirname, key_type=None):
+        """Returns the key pair filenames for the given key type (or of the first existing key pair if not provided)"""
+        if key_type is None:
+            key_type = 'rsa'  # used before other types were supported
+            for existing_type in key_types:
+                if os.path.isfile(os.path.join(dirname, f'id_{existing_type}')):
+                    key_type = existing_type
+                    break
+        priv_key_filename = os.path.join(dirname, f'id_{key_type}')
         pub_key_filename = f'{priv_key_filename}.pub'
         return priv_key_filename, pub_key_filename
 
@@ -38,21 +53,111 @@ class SshTools():
         return KeyPairData(priv_key, pub_key, priv_key_filename, pub_key_filename)
 
     @staticmethod
-    def create_keypair(dirname=None):
-        """Create an ssh key pair using ssh-keygen and return it"""
+    def generate_keypair_files(priv_key_filename, pub_key_filename, key_type):
+        """Generates an ssh key pair in-process and writes it to the given files (returns False if not possible)"""
+        if serialization is None:
+            return False
+        if key_type == 'ed25519':
+            key = ed25519.Ed25519PrivateKey.generate()
+        elif key_type == 'ecdsa':
+            key = ec.generate_private_key(ec.SECP256R1())
+        elif key_type == 'rsa':
+            key = rsa.generate_private_key(public_exponent=65537, key_size=3072)
+        else:
+            return False
+        priv_key = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH, serialization.NoEncryption())
+        pub_key = key.public_key().public_bytes(serialization.Encoding.OpenSSH, serialization.PublicFormat.OpenSSH) + b' saltx\n'
+        # Use the same permissions as ssh-keygen
+        for filename, data, mode in [(priv_key_filename, priv_key, 0o600), (pub_key_filename, pub_key, 0o644)]:
+            descriptor = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+            with open(descriptor, 'wb') as f:
+                f.write(data)
+        return True
+
+    @staticmethod
+    def create_keypair(dirname=None, key_type='ed25519'):
+        """Create an ssh key pair (in-process if possible, using ssh-keygen otherwise) and return it"""
         keydata = None
         with tempfile.TemporaryDirectory() as tmpdirname:
             dirname = tmpdirname if (dirname is None) else dirname
-            logger.debug(f'Creating ssh key pair in directory [{dirname}]')
-            priv_key_filename, pub_key_filename = SshTools.get_filenames(dirname)
-            rc, out, err = setupenv.run_process(f'ssh-keygen -C saltx -f {priv_key_filename} -N ""', print_stdout=False, print_stderr=False)
+            logger.debug(f'Creating ssh key pair of type [{key_type}] in directory [{dirname}]')
+            priv_key_filename, pub_key_filename = SshTools.get_filenames(dirname, key_type)
+            if SshTools.generate_keypair_files(priv_key_filename, pub_key_filename, key_type):
+                rc = 0
+            else:
+                rc, out, err = setupenv.run_process(f'ssh-keygen -t {key_type} -C saltx -f {priv_key_filename} -N ""', print_stdout=False, print_stderr=False)
             if rc == 0:
                 keydata = SshTools.read_keypair(dirname)
                 logger.info(f'Created ssh key pair in [{dirname}], public key is [{keydata.pub_key}]')
             else:
-                logger.error('Creating ssh key pair failed [{err}]')
+                logger.error(f'Creating ssh key pair failed [{err}]')
         return keydata
 
+    @staticmethod
+    def is_pool_entry_complete(entry_dir, key_type):
+        """Returns whether the given key pool entry contains a complete key pair"""
+        return all([os.path.isfile(filename) for filename in SshTools.get_filenames(entry_dir, key_type)])
+
+    @staticmethod
+    def fill_pool(pool_dir, count, key_type='ed25519'):
+        """Makes sure that the pool directory contains the given number of pre-generated key pairs of the given type"""
+        pool_dir = os.path.join(pool_dir, key_type)
+        os.makedirs(pool_dir, mode=0o700, exist_ok=True)
+        available = len([entry for entry in os.listdir(pool_dir) if entry.startswith('key_') and SshTools.is_pool_entry_complete(os.path.join(pool_dir, entry), key_type)])
+        for i in range(available, count):
+            # Create the key pair under a temporary name so that it is only taken from the pool when complete
+            entry_dir = tempfile.mkdtemp(prefix='tmp_', dir=pool_dir)
+            try:
+                if SshTools.create_keypair(entry_dir, key_type) is None:
+                    return False
+                os.rename(entry_dir, os.path.join(pool_dir, 'key_' + os.path.basename(entry_dir)[len('tmp_'):]))
+            except OSError as e:
+                logger.error(f'Adding ssh key pair to pool [{pool_dir}] failed [{e}]')
+                return False
+            finally:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+        logger.info(f'Key pool [{pool_dir}] contains [{max(available, count)}] key pairs')
+        return True
+
+    @staticmethod
+    def take_from_pool(pool_dir, dirname, key_type='ed25519'):
+        """Moves a pre-generated key pair of the given type from the pool into the given directory and returns it"""
+        staging_dir = os.path.join(pool_dir, 'taken')  # on the file system of the pool so that entries can be claimed atomically
+        pool_dir = os.path.join(pool_dir, key_type)
+        if not os.path.isdir(pool_dir):
+            return None
+        os.makedirs(staging_dir, mode=0o700, exist_ok=True)
+        for entry in sorted(os.listdir(pool_dir)):
+            entry_dir = os.path.join(pool_dir, entry)
+            if not entry.startswith('key_') or not SshTools.is_pool_entry_complete(entry_dir, key_type):
+                continue
+            taken_dir = os.path.join(staging_dir, f'{key_type}_{entry}')
+            try:
+                os.rename(entry_dir, taken_dir)  # atomic so that each key pair is only taken once
+            except OSError:
+                continue  # taken concurrently
+            # Copy the key pair as the target directory may be on another file system
+            created = []
+            try:
+                for source, target, mode in zip(SshTools.get_filenames(taken_dir, key_type), SshTools.get_filenames(dirname, key_type), [0o600, 0o644]):
+                    with open(source, 'rb') as f:
+                        data = f.read()
+                    descriptor = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+                    created.append(target)
+                    with open(descriptor, 'wb') as f:
+                        f.write(data)
+            except OSError as e:
+                logger.warning(f'Taking ssh key pair from pool for [{dirname}] failed [{e}]')
+                for target in created:
+                    os.remove(target)  # do not leave a partial key pair behind
+                return None
+            finally:
+                shutil.rmtree(taken_dir, ignore_errors=True)
+            keydata = SshTools.read_keypair(dirname)
+            logger.info(f'Took ssh key pair from pool for [{dirname}], public key is [{keydata.pub_key}]')
+            return keydata
+        return None
+
     @staticmethod
     def get_keypair(dirname=None):
         """Ensure an ssh key pair exists in a given directory and return it"""
@@ -63,17 +168,40 @@ class SshTools():
             return None
 
     @staticmethod
-    def ensure_keypair(dirname=None):
+    def ensure_keypair(dirname=None, key_type='ed25519', pool_dir=None):
         """Ensure an ssh key pair exists in a given directory and return it"""
         result = SshTools.get_keypair(dirname)
+        if (result is None) and (pool_dir is not None):
+            result = SshTools.take_from_pool(pool_dir, dirname, key_type)
         if result is None:
-            return SshTools.create_keypair(dirname)
+            return SshTools.create_keypair(dirname, key_type)
         return result
 
     @staticmethod
-    def call_sshcopyid(user, host, port, keyfile):
+    def call_sshcopyid(user, host, port, keyfile, ssh_options='', print_output=True):
         """Call ssh-copy-id with the given arguments"""
-        rc, out, err = setupenv.run_process(f'ssh-copy-id -i {keyfile} -p {port} {user}@{host}', print_stdout=True, print_stderr=True)
+        rc, out, err = setupenv.run_process(f'ssh-copy-id {ssh_options} -i {keyfile} -p {port} {user}@{host}', print_stdout=print_output, print_stderr=print_output)
+        if (rc != 0) and not print_output:
+            logger.error(f'Deploying public key to [{user}:{host}] failed [{err.strip()}]')
+        return rc == 0
+
+    @staticmethod
+    def get_effective_config(user, host, port):
+        """Returns the ssh client configuration applying to the given host as dictionary (returns 'None' if not available)"""
+        try:
+            result = subprocess.run(['ssh', '-G', '-p', str(port), '-l', user, host], capture_output=True, text=True, timeout=10)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.debug(f'Could not determine ssh configuration for [{host}] [{e}]')
+            return None
+        if result.returncode != 0:
+            logger.debug(f'Could not determine ssh configuration for [{host}] [{result.stderr.strip()}]')
+            return None
+        return dict(line.partition(' ')[::2] for line in result.stdout.splitlines() if line)
+
+    @staticmethod
+    def stop_control_master(user, host, port, control_path):
+        """Stop the multiplexing master connection to the given host (if any)"""
+        rc, out, err = setupenv.run_process(f'ssh -O exit -o ControlPath={control_path} -p {port} {user}@{host}', print_stdout=False, print_stderr=False)
         return rc == 0
 
     @staticmethod
@@ -101,11 +229,11 @@ class SshTools():
         return True
 
     @staticmethod
-    def install_pubkey_usingsudo(user, host, port, keystring):
+    def install_pubkey_usingsudo(user, host, port, keystring, ssh_options='', print_output=True):
         """Install an ssh key in authorized_keys file using sudo on a remote host"""
-        cmd = f"ssh -t -o StrictHostKeyChecking=no -p {port} {user}@{host} "
+        cmd = f"ssh -t -o StrictHostKeyChecking=no {ssh_options} -p {port} {user}@{host} "
         cmd += r'''"sudo bash -c 'ESCAPED_STRING=\$(printf \"%s\" \"''' + keystring + r'''\"); mkdir -p ~/.ssh; chmod 700 ~/.ssh; grep -qxFs \"\${ESCAPED_STRING}\" ~/.ssh/authorized_keys || echo \"\${ESCAPED_STRING}\" >> ~/.ssh/authorized_keys'"'''
-        rc, out, err = setupenv.run_process(cmd, shell=True, print_stdout=True, print_stderr=True)
+        rc, out, err = setupenv.run_process(cmd, shell=True, print_stdout=print_output, print_stderr=print_output)
         if rc != 0:
             logger.error(f'Adding public key to root\'s authorized_keys file on [{user}:{host}] failed')
             return False
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""Class for an index of the target hosts known in the private State folder"""
+
+import fnmatch
+import json
+import logging
+import os
+import re
+import yaml
+
+from . import sshtools
+
+
+logger = logging.getLogger(__name__)
+filename_target_config = 'target.yaml'  # optional file in target folder with host, aliases, user and port
+
+
+class TargetIndex():
+
+    def __init__(self, folder, target_prefix, cache_filename=None):
+        """Object initialization"""
+        self.folder = folder
+        self.target_prefix = target_prefix
+        self.cache_filename = cache_filename
+        self.targets = dict()  # target name -> target data
+        self.lookup = dict()  # target name or alias -> target name
+        self.mtimes = dict()  # folder or target config name -> modification time at time of indexing ('None' if not present)
+
+    def read_target_config(self, dirname):
+        """Returns the target configuration in the given target folder"""
+        try:
+            with open(os.path.join(dirname, filename_target_config), 'r') as f:
+                target_cfg = yaml.load(f, Loader=yaml.SafeLoader)
+        except FileNotFoundError:
+            return dict()
+        except yaml.YAMLError as e:
+            logger.warning(f'Ignoring invalid target config in [{dirname}] [{e}]')
+            return dict()
+        return target_cfg if isinstance(target_cfg, dict) else dict()
+
+    def get_aliases(self, dirname, target_cfg):
+        """Returns the aliases of the given target configuration"""
+        aliases = target_cfg.get('aliases', [])
+        if not isinstance(aliases, list):
+            logger.warning(f'Ignoring aliases in [{dirname}], list expected [{aliases}]')
+            return []
+        return [str(alias) for alias in aliases]
+
+    @staticmethod
+    def get_mtime(path):
+        """Returns the modification time of the given path ('None' if not present)"""
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def build(self):
+        """Builds the index by scanning the folder"""
+        logger.debug(f'Building target index for [{self.folder}]')
+        self.targets = dict()
+        self.mtimes = dict()
+        if not os.path.isdir(self.folder):
+            return
+        self.mtimes[''] = os.stat(self.folder).st_mtime_ns
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.is_dir() or not entry.name.startswith(self.target_prefix):
+                    continue
+                name = entry.name[len(self.target_prefix):]
+                self.mtimes[entry.name] = entry.stat().st_mtime_ns
+                filename_cfg = os.path.join(entry.name, filename_target_config)
+                self.mtimes[filename_cfg] = self.get_mtime(os.path.join(self.folder, filename_cfg))
+                target_cfg = self.read_target_config(entry.path)
+                priv_key_filename, _ = sshtools.SshTools.get_filenames(entry.path)
+                port = target_cfg.get('port')
+                self.targets[name] = {
+                    'dir': entry.path,
+                    'host': target_cfg.get('host'),
+                    'aliases': self.get_aliases(entry.path, target_cfg),
+                    'user': target_cfg.get('user'),
+                    'port': None if (port is None) else str(port),
+                    'key': priv_key_filename if os.path.isfile(priv_key_filename) else None,
+                }
+        self.update_lookup()
+
+    def update_lookup(self):
+        """Updates the mapping of names and aliases to targets"""
+        self.lookup = dict()
+        for name, data in self.targets.items():
+            for alias in [data['host']] + data['aliases']:
+                if alias is not None:
+                    self.lookup[alias.lower()] = name
+        for name in self.targets:
+            self.lookup[name.lower()] = name  # target names take precedence over aliases
+
+    def is_cache_valid(self, cache):
+        """Returns whether the cached index is still current"""
+        if (cache.get('folder') != self.folder) or (cache.get('target_prefix') != self.target_prefix):
+            return False
+        mtimes = cache.get('mtimes', dict())
+        if '' not in mtimes:
+            return False
+        for name in [name for name in mtimes if name.startswith(self.target_prefix) and ('/' not in name)]:
+            if os.path.join(name, filename_target_config) not in mtimes:
+                return False  # cache written before target configs were tracked
+        for name, mtime in mtimes.items():
+            try:
+                if self.get_mtime(os.path.join(self.folder, name)) != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def load(self):
+        """Loads the index from the cache file if still current; rebuilds and saves it otherwise"""
+        if self.cache_filename is not None:
+            try:
+                with open(self.cache_filename, 'r') as f:
+                    cache = json.load(f)
+                if self.is_cache_valid(cache):
+                    self.targets = cache['targets']
+                    self.mtimes = cache['mtimes']
+                    self.update_lookup()
+                    return
+            except (OSError, ValueError, KeyError):
+                pass  # cache not present or invalid
+        self.build()
+        self.save()
+
+    def save(self):
+        """Saves the index to the cache file"""
+        if self.cache_filename is None:
+            return False
+        cache = { 'folder': self.folder, 'target_prefix': self.target_prefix, 'mtimes': self.mtimes, 'targets': self.targets }
+        filename_tmp = f'{self.cache_filename}.tmp'
+        try:
+            descriptor = os.open(filename_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(descriptor, 'w') as f:
+                json.dump(cache, f)
+            os.replace(filename_tmp, self.cache_filename)
+        except OSError as e:
+            logger.warning(f'Could not write target index cache [{self.cache_filename}] [{e}]')
+            return False
+        return True
+
+    def find(self, target):
+        """Returns the name and data of the given target (host name, short host name or alias); (None, None) if not found"""
+        target = target.lower()
+        name = self.lookup.get(target)
+        if name is None:
+            name = self.lookup.get(target.partition('.')[0])
+        if name is None:
+            return None, None
+        return name, self.targets[name]
+
+    def match(self, pattern=None):
+        """Returns (name, data) tuples of matching targets (regular expression if prefixed with "re:", glob if containing wildcards, prefix otherwise)"""
+        if pattern is None:
+            matches = lambda name: True
+        elif pattern.startswith('re:'):
+            regex = re.compile(pattern[3:])
+            matches = lambda name: regex.search(name) is not None
+        elif any([ch in pattern for ch in '*?[']):
+            matches = lambda name: fnmatch.fnmatchcase(name, pattern)
+        else:
+            matches = lambda name: name.startswith(pattern)
+        result = []
+        for name, data in sorted(self.targets.items()):
+            if any([matches(alias) for alias in [name, data['host']] + data['aliases'] if alias is not None]):
+                result.append((name, data))
+        return result
@@ -2,7 +2,11 @@
 
 """Managing the interaction with the user"""
 
+from . import conflictpolicy
+from . import queryuser
 
+
+@queryuser.serialize_prompts
 def get_user_choice(sync_to_file, text, file_size=None, file_mtime=None, item_size=None, item_mtime=None):
     """Ask the user how to treat a certain case"""
     
@@ -45,3 +49,51 @@ def on_updatefile(sync_to_file, item, file_size, file_mtime, item_size, item_mti
     """Callback function for the case that an item exists in local file and in credential fault"""
     sync_to_file = get_user_choice(sync_to_file, f'[{item}] differs:', file_size, file_mtime, item_size, item_mtime)
     return sync_to_file
+
+def print_conflicts(conflicts):
+    """Prints a table of the given differences with the currently selected decisions"""
+
+    def format_side(mtime, size):
+        return '-' if size is None else f'{mtime.strftime('%Y-%m-%d %H:%M:%S')} {size:>8}'
+
+    kinds = { 'onlyfile': 'only local', 'onlyvault': 'only vault', 'update': 'differs' }
+    width = max([len(conflict['item']) for conflict in conflicts] + [4])
+    print()
+    print(f'{"#":>4}  {"Item":<{width}}  {"Difference":<10}  {"Local file (UTC, bytes)":<28}  {"Vault (UTC, bytes)":<28}  Decision')
+    for number, conflict in enumerate(conflicts, start=1):
+        print(f'{number:>4}  {conflict['item']:<{width}}  {kinds[conflict['kind']]:<10}  {format_side(conflict['file_mtime'], conflict['file_size']):<28}  '
+              f'{format_side(conflict['item_mtime'], conflict['item_size']):<28}  {conflictpolicy.ConflictPolicy.describe(conflict)}')
+
+@queryuser.serialize_prompts
+def resolve_conflicts(conflicts):
+    """Callback function deciding on all differences at once based on bulk rules entered by the user"""
+    policy = conflictpolicy.ConflictPolicy()
+    choices = { '<': 'to-file', '>': 'to-vault', '/': 'skip', 'n': 'newest', 'd': 'default' }
+    help_text = ('Enter "<" (mirror to file), ">" (mirror to vault), "n" (newest wins), "d" (default) or "/" (skip)\n'
+                 '  alone for all items, after a Collection name or glob for its items, or after a number for a single item;\n'
+                 '  "save <file>" saves the rules as conflict policy for unattended runs; enter applies the decisions')
+    print(help_text)
+    while True:
+        for conflict in conflicts:
+            conflict['sync_to_file'] = policy.decide(conflict)
+        print_conflicts(conflicts)
+        s = input('Command ("?" for help), enter to apply: ').strip()
+        if s == '':
+            break
+        target, _, choice = s.rpartition(' ')
+        target = target.strip()
+        if target == 'save':
+            policy.save(choice)
+            continue
+        if (s == '?') or (choice not in choices):
+            print(help_text)
+            continue
+        if target == '':
+            policy = conflictpolicy.ConflictPolicy(default=choices[choice])  # replaces all previous rules
+        elif target.isdigit() and (1 <= int(target) <= len(conflicts)):
+            policy.items[conflicts[int(target) - 1]['item']] = choices[choice]
+        elif ':' in target:
+            policy.collections.pop(target, None)  # the last matching rule applies
+            policy.collections[target] = choices[choice]
+        else:
+            print('Invalid choice. Try again.')
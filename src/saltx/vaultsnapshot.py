@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""Class providing vault access based on a local snapshot of the vault (used when the vault is not reachable)"""
+
+import datetime
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotVault():
+
+    def __init__(self, filename):
+        """Object initialization"""
+        self.filename = filename
+        self.offline = True
+        self.items = dict()  # item name -> item data
+        self.collections = dict()  # collection name -> collection data
+        self.pending = dict()  # item name -> change made offline
+        self.pending_collections = dict()  # collection name -> 'create' or 'delete'
+
+    def is_present(self):
+        """Returns whether a snapshot file is present"""
+        return os.path.isfile(self.filename)
+
+    def load(self):
+        """Loads the snapshot from file"""
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        self.items = data.get('items', dict())
+        self.collections = data.get('collections', dict())
+        self.pending = data.get('pending', dict())
+        self.pending_collections = data.get('pending_collections', dict())
+        return True
+
+    def save(self):
+        """Saves the snapshot to file atomically"""
+        data = { 'items': self.items, 'collections': self.collections, 'pending': self.pending, 'pending_collections': self.pending_collections }
+        filename_tmp = f'{self.filename}.tmp'
+        descriptor = os.open(filename_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(descriptor, 'w') as f:
+            json.dump(data, f)
+        os.replace(filename_tmp, self.filename)
+        return True
+
+    def save_from(self, vault):
+        """Replaces the snapshot by the current content of the given vault (keeping the queued changes)"""
+        logger.debug(f'Saving vault snapshot [{self.filename}]')
+        self.items = { name: { key: item.get(key) for key in ['id', 'name', 'notes', 'revisionDate'] } for name, item in vault.get_all_items().items() }
+        self.collections = { name: { key: collection.get(key) for key in ['id', 'name'] } for name, collection in vault.get_all_collections().items() }
+        return self.save()  # changes not yet applied stay queued
+
+    def replay_pending(self, vault):
+        """Applies the changes made offline to the given vault; changes conflicting with changes in the vault are dropped, failed ones stay queued"""
+        if not len(self.pending) and not len(self.pending_collections):
+            return True
+        logger.info(f'Applying [{len(self.pending)}] changes made offline to vault...')
+        failed = dict()
+        failed_collections = dict()
+        collections = vault.get_all_collections()
+        for name, change in self.pending_collections.items():
+            if (change == 'create') and (name not in collections) and not vault.create_collection(name):
+                failed_collections[name] = change
+        items = vault.get_all_items()
+        for name, change in sorted(self.pending.items()):
+            current = items.get(name)
+            if ((current or dict()).get('revisionDate')) != change['base']:
+                logger.warning(f'[{name}] was changed in vault while being changed offline; not applying offline change')
+                continue
+            if change['op'] == 'create':
+                ok = vault.create_item(name, change['collection'], change['notes'])
+            elif change['op'] == 'update':
+                ok = vault.update_item(current.get('id'), change['notes'])
+            elif change['op'] == 'delete':
+                ok = vault.delete_item(current.get('id'))
+            if not ok:
+                logger.warning(f'Applying offline change of [{name}] failed; keeping it for the next update')
+                failed[name] = change
+        for name, change in self.pending_collections.items():
+            if (change == 'delete') and (name in collections) and not vault.delete_collection(name):
+                failed_collections[name] = change
+        self.pending = failed
+        self.pending_collections = failed_collections
+        self.save()
+        return not len(failed) and not len(failed_collections)
+
+    def get_revision_date(self):
+        """Returns the current time in the format of the item revision date"""
+        return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def get_name_by_id(self, itemid):
+        """Returns the name of the item with the given identifier"""
+        for name, item in self.items.items():
+            if item.get('id') == itemid:
+                return name
+        return None
+
+    def reset_call_budget(self):
+        """No Bitwarden CLI calls are made offline"""
+
+    def log_call_stats(self):
+        """No Bitwarden CLI calls are made offline"""
+
+    def dump_call_stats(self, filename):
+        """No Bitwarden CLI calls are made offline"""
+        return True
+
+    def is_org_present(self):
+        """Returns whether our organization is present in the snapshot"""
+        return True
+
+    def get_all_items(self):
+        """Returns a dictionary of all items in the snapshot"""
+        return self.items
+
+    def get_items(self, realm):
+        """Returns a dictionary of items for the given realm"""
+        return { key: value for key, value in self.items.items() if key.startswith(f'{realm}:')}
+
+    def get_item(self, name):
+        """Returns the data of an item"""
+        return self.items.get(name)
+
+    def create_item(self, name, collection, data):
+        """Creates an item with the given data in the snapshot and queues the change"""
+        change = self.pending.get(name)
+        if (change is not None) and (change['op'] == 'delete'):
+            self.pending[name] = { 'op': 'update', 'notes': data, 'base': change['base'] }
+        else:
+            self.pending[name] = { 'op': 'create', 'collection': collection, 'notes': data, 'base': None }
+        self.items[name] = { 'id': f'offline:{name}', 'name': name, 'notes': data, 'revisionDate': self.get_revision_date() }
+        return self.save()
+
+    def update_item(self, itemid, data):
+        """Updates an item with the given identifier in the snapshot and queues the change"""
+        name = self.get_name_by_id(itemid)
+        if name is None:
+            return False
+        change = self.pending.get(name)
+        if change is None:
+            self.pending[name] = { 'op': 'update', 'notes': data, 'base': self.items[name].get('revisionDate') }
+        else:
+            change['notes'] = data
+        self.items[name]['notes'] = data
+        self.items[name]['revisionDate'] = self.get_revision_date()
+        return self.save()
+
+    def delete_item(self, itemid):
+        """Deletes an item with the given identifier from the snapshot and queues the change"""
+        name = self.get_name_by_id(itemid)
+        if name is None:
+            return False
+        change = self.pending.get(name)
+        if change is None:
+            self.pending[name] = { 'op': 'delete', 'base': self.items[name].get('revisionDate') }
+        elif change['op'] == 'create':
+            del self.pending[name]
+        else:
+            self.pending[name] = { 'op': 'delete', 'base': change['base'] }
+        del self.items[name]
+        return self.save()
+
+    def get_all_collections(self):
+        """Returns a dictionary of all collections in the snapshot"""
+        return self.collections
+
+    def get_collections(self, realm):
+        """Returns a dictionary of collections for the given realm"""
+        return { key: value for key, value in self.collections.items() if key.startswith(f'{realm}:')}
+
+    def create_collection(self, name):
+        """Creates a collection in the snapshot and queues the change"""
+        self.collections[name] = { 'id': f'offline:{name}', 'name': name }
+        self.pending_collections[name] = 'create'
+        return self.save()
+
+    def delete_collection(self, name):
+        """Deletes a collection from the snapshot and queues the change"""
+        self.collections.pop(name, None)
+        self.pending_collections[name] = 'delete'
+        return self.save()
@@ -3,20 +3,34 @@
 """Class for syncing a Bitwarden/Vaultwarden vault with local directories"""
 
 import base64
+import concurrent.futures
+import ctypes
 import datetime
+import hashlib
+import json
 import logging
 import os
 import pathlib
+import re
+import stat
+import tempfile
+import time
+import zlib
 
 from . import bwvault
+from . import metrics
 
 
 logger = logging.getLogger(__name__)
+encoding_marker = '#saltx-encoding:'  # first line of notes that are stored encoded, followed by the encoding
+chunk_separator = '//'  # separates item name and chunk hash in names of chunk items (cannot occur in file paths)
+orphan_chunk_grace_period = datetime.timedelta(hours=1)  # chunk items without item are only deleted when older (another client might be storing the item)
+tmp_suffix = '.saltx-tmp'  # suffix of temporary files written before being renamed to the target file
 
 
 class VaultSync():
 
-    def __init__(self, realms, vault, auto_create_locally=False, auto_update_locally=False, auto_delete_locally=False):
+    def __init__(self, realms, vault, auto_create_locally=False, auto_update_locally=False, auto_delete_locally=False, state_filename=None, compress=False, compress_threshold=None, max_notes_size=10000, chunking=False, chunk_workers=1):
         """Object initialization"""
         self.realms = realms
         self.vault = vault
@@ -24,14 +38,297 @@ class VaultSync():
         self.auto_create_locally = auto_create_locally
         self.auto_update_locally = auto_update_locally
         self.auto_delete_locally = auto_delete_locally
+        self.state_filename = state_filename  # file to keep the sync state in between runs
+        self.state = dict()  # realm -> { 'path', 'revision_date' (high-water mark), 'files' (filename -> [mtime_ns, size] when last in sync) }
+        self.compress = compress  # store notes larger than the threshold compressed
+        self.compress_threshold = max_notes_size if (compress_threshold is None) else compress_threshold  # by default only compress what would not fit otherwise
+        self.max_notes_size = max_notes_size
+        self.chunking = chunking  # store files too large for one item in several chunk items
+        self.chunk_workers = chunk_workers
 
-    def get_file_hierarchy(self, path):
-        """Gets all files within 'path' recursively (relative to 'path') and returns a set"""
+    def encode_notes(self, data):
+        """Returns the notes field for the given file content; binary content is base64-encoded, large content compressed if enabled"""
+        try:
+            text = data.decode('UTF-8')
+            if '\x00' in text:
+                text = None
+        except UnicodeDecodeError:
+            text = None  # binary content
+        if (text is not None) and not text.startswith(encoding_marker):
+            if not (self.compress and (len(text) > self.compress_threshold)):
+                return text  # plain text readable by other clients
+        return self.encode_payload(data, compress=self.compress)
+
+    def encode_payload(self, data, compress=True):
+        """Returns the encoded notes field for the given bytes (compressed if enabled and smaller)"""
+        encoding = 'base64'
+        if compress:
+            data_compressed = zlib.compress(data, 9)
+            if len(data_compressed) < len(data):
+                data = data_compressed
+                encoding = 'zlib+base64'
+        payload = base64.b64encode(data).decode('ascii')
+        return f'{encoding_marker} {encoding}\n{payload}'
+
+    def decode_payload(self, notes):
+        """Returns the bytes of an encoded notes field; raises ValueError if it cannot be decoded"""
+        header, _, payload = notes.partition('\n')
+        encoding = header[len(encoding_marker):].strip()
+        try:
+            data = base64.b64decode(payload, validate=True)
+            if encoding == 'zlib+base64':
+                data = zlib.decompress(data)
+            elif encoding != 'base64':
+                raise ValueError(f'unknown encoding [{encoding}]')
+            return data
+        except zlib.error as e:
+            raise ValueError(str(e))  # base64 decoding errors are ValueErrors already
+
+    def decode_notes(self, notes, item=None, vaultdata=None):
+        """Returns the file content (bytes) for the given notes field (chunks are looked up in the vault data); raises ValueError if it cannot be decoded"""
+        if not notes.startswith(encoding_marker):
+            return notes.encode('UTF-8')  # plain text
+        header, _, payload = notes.partition('\n')
+        if header[len(encoding_marker):].strip() == 'chunked':
+            return self.read_chunked(item, json.loads(payload), vaultdata)
+        return self.decode_payload(notes)
+
+    def get_chunk_name(self, item, chunk_hash):
+        """Returns the name of the chunk item with the given hash"""
+        return f'{item}{chunk_separator}{chunk_hash}'
+
+    def get_chunk_names(self, item, vaultdata):
+        """Returns the names of the chunk items of the given item in the vault data"""
+        prefix = f'{item}{chunk_separator}'
+        return { name for name in vaultdata.keys() if name.startswith(prefix) }
+
+    def split_chunks(self, data):
+        """Splits data into chunks whose encoding fits into a note; chunk ends are content-defined so that changes only affect nearby chunks"""
+        max_size = (self.max_notes_size - 100) * 3 // 4  # even incompressible data fits after base64 encoding
+        chunks = []
+        start = pos = 0
+        while pos < len(data):
+            end = data.find(b'\n', pos)
+            end = len(data) if (end == -1) else end + 1
+            if end - start > max_size:
+                if pos == start:
+                    pos = start + max_size  # line longer than a chunk
+                chunks.append(data[start:pos])
+                start = pos
+                continue
+            line = data[pos:end]
+            pos = end
+            # End the chunk after lines with certain hash values, not at fixed offsets
+            if (pos - start >= max_size // 4) and (zlib.crc32(line) % 16 == 0):
+                chunks.append(data[start:pos])
+                start = pos
+        if start < len(data):
+            chunks.append(data[start:])
+        return chunks
+
+    def read_chunked(self, item, manifest, vaultdata):
+        """Reassembles and verifies the content of an item stored in chunk items"""
+        parts = []
+        for chunk_hash in manifest.get('chunks', []):
+            chunkdata = vaultdata.get(self.get_chunk_name(item, chunk_hash))
+            if chunkdata is None:
+                raise ValueError(f'chunk [{chunk_hash}] missing')
+            data = self.decode_payload(chunkdata.get('notes') or '')
+            if hashlib.sha256(data).hexdigest()[:32] != chunk_hash:
+                raise ValueError(f'chunk [{chunk_hash}] corrupt')
+            parts.append(data)
+        data = b''.join(parts)
+        if hashlib.sha256(data).hexdigest() != manifest.get('sha256'):
+            raise ValueError('content does not match hash in manifest')
+        return data
+
+    def write_chunks(self, item, collection, data, chunk_names_old):
+        """Creates the chunk items not yet present in the vault; returns the manifest notes or None on failure"""
+        chunks = [(hashlib.sha256(chunk).hexdigest()[:32], chunk) for chunk in self.split_chunks(data)]
+        manifest = { 'sha256': hashlib.sha256(data).hexdigest(), 'size': len(data), 'chunks': [chunk_hash for chunk_hash, _ in chunks] }
+        chunks_new = { chunk_hash: chunk for chunk_hash, chunk in chunks if self.get_chunk_name(item, chunk_hash) not in chunk_names_old }
+        logger.info(f'Storing [{item}] in [{len(chunks)}] chunk items, [{len(chunks_new)}] of them changed')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.chunk_workers) as executor:
+            futures = [executor.submit(self.vault.create_item, self.get_chunk_name(item, chunk_hash), collection, self.encode_payload(chunk)) for chunk_hash, chunk in chunks_new.items()]
+            if not all([future.result() for future in futures]):
+                logger.error(f'Storing chunk items of [{item}] failed')
+                return None
+        return f'{encoding_marker} chunked\n{json.dumps(manifest)}'
+
+    def is_orphan_chunk_expired(self, itemdata):
+        """Returns whether a chunk item without item is old enough to be deleted (chunk items are created before their item)"""
+        try:
+            revision_date = datetime.datetime.fromisoformat(itemdata.get('revisionDate'))  # requires Python >=3.11
+        except (TypeError, ValueError):
+            return False
+        if revision_date.tzinfo is None:
+            revision_date = revision_date.replace(tzinfo=datetime.timezone.utc)
+        return datetime.datetime.now(datetime.timezone.utc) - revision_date > orphan_chunk_grace_period
+
+    def delete_chunks(self, chunk_names, vaultdata):
+        """Deletes the given chunk items"""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.chunk_workers) as executor:
+            futures = [executor.submit(self.vault.delete_item, vaultdata[name].get('id')) for name in sorted(chunk_names)]
+            return all([future.result() for future in futures])
+
+    def store_in_vault(self, item, collection, data, itemdata, vaultdata):
+        """Creates or updates (if item data is given) the item for the given content; content too large for an item is stored in chunk items if enabled"""
+        notes = self.encode_notes(data)
+        chunk_names_old = self.get_chunk_names(item, vaultdata)
+        chunk_names = set()
+        if self.chunking and (len(notes) > self.max_notes_size):
+            notes = self.write_chunks(item, collection, data, chunk_names_old)
+            if notes is None:
+                return False
+            manifest = json.loads(notes.partition('\n')[2])
+            chunk_names = { self.get_chunk_name(item, chunk_hash) for chunk_hash in manifest['chunks'] }
+        self.check_notes_size(item, notes)
+        if itemdata is None:
+            ok = self.vault.create_item(item, collection, notes)
+        else:
+            ok = self.vault.update_item(itemdata.get('id'), notes)
+        if ok and len(chunk_names_old - chunk_names):
+            self.delete_chunks(chunk_names_old - chunk_names, vaultdata)  # no longer referenced
+        return ok
+
+    def check_notes_size(self, item, notes):
+        """Warns if the notes field for the given item probably exceeds the maximum size"""
+        if len(notes) > self.max_notes_size:
+            logger.warning(f'Size [{len(notes)}] of notes of item [{item}] probably exceeds allowed maximum size [{self.max_notes_size}]{'' if self.compress else '; consider enabling compression ("bw.compress")'}')
+
+    def load_state(self):
+        """Loads the sync state of the last run"""
+        self.state = dict()
+        if self.state_filename is None:
+            return
+        try:
+            with open(self.state_filename, 'r') as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring unreadable vault sync state [{self.state_filename}] [{e}]')
+
+    def save_state(self):
+        """Saves the sync state atomically"""
+        if self.state_filename is None:
+            return
+        filename_tmp = f'{self.state_filename}.tmp'
+        descriptor = os.open(filename_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(descriptor, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(filename_tmp, self.state_filename)
+
+    def get_realm_state(self, realm, path):
+        """Returns high-water mark and file states of the last sync of the realm"""
+        realm_state = self.state.get(realm)
+        if (realm_state is None) or (realm_state.get('path') != path):
+            return None, dict()
+        revision_date = realm_state.get('revision_date')
+        if revision_date is not None:
+            revision_date = datetime.datetime.fromisoformat(revision_date)
+        return revision_date, realm_state.get('files', dict())
+
+    def set_realm_state(self, realm, path, vaultdata, files_synced, subpaths=None):
+        """Remembers high-water mark and file states of the realm after a (partial) sync"""
+        if self.vault.offline:
+            return  # revision dates of changes made offline are not set by the server
+        if subpaths is not None:
+            # The mark only covers the whole realm; thus just update the file states of the synced scope
+            revision_date_last, files_last = self.get_realm_state(realm, path)
+            if revision_date_last is not None:
+                files = { item: file_state for item, file_state in files_last.items() if not self.is_in_scope(item, subpaths) }
+                files.update(files_synced)
+                self.state[realm]['files'] = files
+            return
+        revision_dates = [itemdata.get('revisionDate') for itemdata in vaultdata.values() if itemdata.get('revisionDate')]
+        revision_date = max(revision_dates, key=datetime.datetime.fromisoformat) if len(revision_dates) else None
+        self.state[realm] = { 'path': path, 'revision_date': revision_date, 'files': files_synced }
+
+    def get_file_hierarchy(self, path, subpaths=None):
+        """Gets all files within 'path' (or only within the given subpaths of it) recursively (relative to 'path') and returns a set"""
         filelist = set()
-        for folder, subfolders, files in os.walk(path):
-            filelist.update([os.path.relpath(os.path.join(folder, file), path) for file in files])
+        for subpath in ([''] if subpaths is None else subpaths):
+            if os.path.isfile(os.path.join(path, subpath)):
+                filelist.add(subpath)
+                continue
+            for folder, subfolders, files in os.walk(os.path.join(path, subpath)):
+                filelist.update([os.path.relpath(os.path.join(folder, file), path) for file in files if not file.endswith(tmp_suffix)])
+                self.remove_stale_tmp_files(folder, [file for file in files if file.endswith(tmp_suffix)])
         return filelist
 
+    def remove_stale_tmp_files(self, folder, files):
+        """Removes temporary files left over by interrupted writes"""
+        for file in files:
+            filename = os.path.join(folder, file)
+            try:
+                if os.path.getmtime(filename) < time.time() - 3600:  # not written by a sync running concurrently
+                    logger.info(f'Removing stale temporary file [{filename}]')
+                    os.unlink(filename)
+            except OSError:
+                pass
+
+    @staticmethod
+    def get_filesystem_type(path):
+        """Returns the type of the file system containing the given path (from /proc/mounts; 'None' if unknown)"""
+        path = os.path.realpath(path)
+        result = None
+        result_length = -1
+        try:
+            with open('/proc/mounts', 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 3:
+                        continue
+                    mount_point = re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), fields[1])  # e.g. "\040" for a space
+                    if ((path == mount_point) or path.startswith(mount_point.rstrip(os.path.sep) + os.path.sep)) and (len(mount_point) > result_length):
+                        result, result_length = fields[2], len(mount_point)
+        except OSError:
+            pass
+        return result
+
+    def flush_filesystem(self, path):
+        """Writes the data of the file system containing the given path to disk
+
+        Called once per realm instead of syncing each written file. syncfs is used for local file systems; on FUSE
+        file systems (e.g. EncFS) it does not reach the backing file system, so everything is synced then."""
+        filesystem_type = self.get_filesystem_type(path)
+        if (filesystem_type is not None) and not filesystem_type.startswith('fuse'):
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                descriptor = os.open(path, os.O_RDONLY)
+                try:
+                    if libc.syncfs(descriptor) == 0:
+                        return
+                finally:
+                    os.close(descriptor)
+            except (OSError, AttributeError):
+                pass
+        os.sync()
+
+    def parse_scope(self, filters):
+        """Returns a dictionary mapping the realms to sync to their subpaths to sync (None for the whole realm); raises ValueError for invalid filters"""
+        scope = dict()
+        for scope_filter in filters:
+            realm, _, subpath = scope_filter.partition(':')
+            if realm not in self.realms:
+                raise ValueError(f'unknown realm [{realm}]')
+            subpath = os.path.normpath(subpath) if subpath else ''
+            if subpath.startswith('..') or os.path.isabs(subpath):
+                raise ValueError(f'invalid path [{subpath}]')
+            if subpath in ['', '.']:
+                scope[realm] = None  # whole realm
+            elif scope.get(realm, []) is not None:
+                scope.setdefault(realm, []).append(subpath)
+        return scope
+
+    def is_in_scope(self, item, subpaths):
+        """Returns whether the given item (or chunk item) is within the given subpaths (None for the whole realm)"""
+        if subpaths is None:
+            return True
+        filename = self.get_filename(item.partition(chunk_separator)[0])
+        return any([(filename == subpath) or filename.startswith(subpath + os.path.sep) for subpath in subpaths])
+
     def get_root_folder(self, filepath):
         """Gets the highest-level folder of a filepath"""
         return filepath.split(os.path.sep)[0]
@@ -59,43 +356,51 @@ class VaultSync():
             names.add(self.get_collection_name(realm, filename))
         return names
 
-    def sync_folder_and_vault(self, realm, path):
-        """Syncs a local folder and a key vault"""
+    def sync_folder_and_vault(self, realm, path, subpaths=None):
+        """Syncs a local folder and a key vault (optionally only the given subpaths of the folder)"""
         
         def set_file_last_modified(filename, dt):
             """Sets the modification time of the given file (incl. full path)"""
             dt_epoch = dt.timestamp()
             os.utime(filename, (dt_epoch, dt_epoch))        
         
-        def write_to_file(filename, s, timestamp=None):
-            """Writes the provided string to file and optionally sets file modification time"""
+        def get_file_state(filename):
+            """Returns modification time and size of the given file for detecting changes"""
+            file_stat = os.stat(filename)
+            return [file_stat.st_mtime_ns, file_stat.st_size]
+
+        def write_to_file(filename, data, timestamp=None):
+            """Writes the provided bytes to file atomically (via a temporary file) and optionally sets file modification time"""
+            nonlocal files_changed
             logger.info(f'Writing file [{filename}]')            
+            filename_tmp = None
             try:
                 filename = pathlib.Path(filename)
                 filename.parent.mkdir(parents=True, exist_ok=True) # make sure needed directories exist
-                descriptor = os.open(
-                    path=filename,
-                    flags=(
-                        os.O_WRONLY     # access mode: write only
-                        | os.O_CREAT    # create if not exists
-                        | os.O_TRUNC    # truncate the file to zero
-                    ),
-                    mode=0o600          # no permissions to other users
-                )
-                with open(descriptor, 'w') as file:
-                    file.write(s)
+                # Temporary file in the same directory so that it can be renamed; no permissions to other users
+                descriptor, filename_tmp = tempfile.mkstemp(dir=filename.parent, prefix='.', suffix=tmp_suffix)
+                with open(descriptor, 'wb') as file:
+                    file.write(data)  # made durable by flushing the file system once per realm (see flush_filesystem)
+                if filename.exists():
+                    os.chmod(filename_tmp, stat.S_IMODE(filename.stat().st_mode))  # keep permissions of the existing file
                 if timestamp is not None:
-                    set_file_last_modified(filename, timestamp)
-            except e:
+                    set_file_last_modified(filename_tmp, timestamp)
+                os.replace(filename_tmp, filename)
+                files_changed = True
+            except OSError as e:
                 logger.error(f'Error writing to file "{filename}"\n[{e}]')
+                if filename_tmp is not None and os.path.exists(filename_tmp):
+                    os.unlink(filename_tmp)
                 return False
             return True                
                 
         def delete_file(filename, with_empty_parents=False):
             """Deletes the file with the given path and optionally all empty higher-level directories"""
+            nonlocal files_changed
             logger.info(f'Deleting file [{filename}]')
             try:
                 os.unlink(filename)
+                files_changed = True
                 # If requested, remove all empty parent directories
                 if with_empty_parents:
                     dir = os.path.dirname(filename)
@@ -105,22 +410,33 @@ class VaultSync():
                             dir = os.path.dirname(dir)
                         else:
                             break
-            except e:
+            except OSError as e:
                 logger.error(f'Error deleting file "{filename}" (and empty directories)\n[{e}]')
                 return False
             return True
 
+        files_changed = False
         # Get items from files and vault
-        filepaths = self.get_file_hierarchy(path)
+        filepaths = self.get_file_hierarchy(path, subpaths)
         fileitems = { f'{realm}:{item}' for item in filepaths }
         vaultdata = self.vault.get_items(realm)
-        vaultitems = set(vaultdata.keys())
+        if subpaths is not None:
+            vaultdata = { name: itemdata for name, itemdata in vaultdata.items() if self.is_in_scope(name, subpaths) }
+        vaultitems = { name for name in vaultdata.keys() if chunk_separator not in name }
         items_onlyfile =  fileitems - vaultitems        
         items_onlyvault = vaultitems - fileitems
         vaultcollections = None
         if len(items_onlyfile) or len(items_onlyvault):
             vaultcollections = set(self.vault.get_collections(realm).keys())
-        # Iterate over all items
+            vaultcollections_scope = vaultcollections
+            if subpaths is not None:
+                # Only collections that are synced completely may be deleted
+                vaultcollections_scope = { collection for collection in vaultcollections if collection.partition(':')[2] in subpaths }
+        # Items that did not change in the vault since the last sync and whose file did not change either are not compared
+        revision_date_last, files_last = self.get_realm_state(realm, path)
+        files_synced = dict()
+        # Iterate over all items and collect those that differ
+        conflicts = []
         for item in sorted(fileitems | vaultitems):
             # Get known data into variables
             filename = self.get_filename(item, path)
@@ -130,91 +446,125 @@ class VaultSync():
                 file_mtime = file_stat.st_mtime
                 file_mtime = datetime.datetime.fromtimestamp(file_mtime, tz=datetime.timezone.utc)
                 file_size = file_stat.st_size
-                with open(filename, 'rb') as file:
-                    file_content_raw = file.read()                    
-                len_encoded = len(base64.b64encode(file_content_raw))
-                if len_encoded > 10000:
-                    logger.warn(f'Encoded size [{len_encoded}] of file [{filename}] probably exceeds allowed maximum size [10000]')
-                try:
-                    with open(filename, 'r') as file:
-                        file_content = file.read()
-                    if file_content != file_content_raw.decode('UTF-8'):
-                        logger.warning(f'File [{filename}] contains non-Unix line breaks or binary characters that are converted')
-                except UnicodeDecodeError as e:
-                    logger.warning(f'Binary characters in file [{filename}]; skipping this file')
-                    continue
+                file_state = [file_stat.st_mtime_ns, file_size]
             else:
                 file_mtime = None
                 file_size = None
                 file_content = None
+                file_state = None
+            if item in vaultitems:
+                itemdata = vaultdata[item]
+                item_mtime = datetime.datetime.fromisoformat(itemdata.get('revisionDate'))  # requires Python >=3.11
+            else:
+                itemdata = None
+                item_mtime = None
+            if (item in fileitems) and (item in vaultitems) and (revision_date_last is not None):
+                if (item_mtime <= revision_date_last) and (files_last.get(item) == file_state):
+                    files_synced[item] = file_state
+                    continue
+            if item in fileitems:
+                with open(filename, 'rb') as file:
+                    file_content = file.read()
             if item in vaultitems:
-                itemdata = self.vault.get_item(item)
                 item_notes = itemdata.get('notes')
                 if item_notes is None:
                     item_notes = ''
-                item_size = len(item_notes)
-                item_mtime = datetime.datetime.fromisoformat(itemdata.get('revisionDate'))  # requires Python >=3.11
+                try:
+                    item_content = self.decode_notes(item_notes, item, vaultdata)
+                except ValueError as e:
+                    logger.error(f'Notes of item [{item}] cannot be decoded [{e}]; skipping this item')
+                    continue
+                item_size = len(item_content)
             else:
-                item_notes = None
+                item_content = None
                 item_size = None
-                item_mtime = None
-            # Perform actions depending on current state
+            # Determine the kind of difference and the default action
             if item in items_onlyfile: # item is only present locally in file, not in vault
-                if self.auto_delete_locally:
-                    sync_to_file = True
-                else:
-                    sync_to_file = self.call_hook('onlyfile', sync_to_file=False, item=item, file_size=file_size, file_mtime=file_mtime)
-                if sync_to_file is None:
-                    pass  # skip this file
-                else:
-                    if sync_to_file:
-                        if delete_file(filename, with_empty_parents=True):
-                            fileitems.remove(item)
-                    else:
-                        collection = self.get_collection_name(realm, self.get_filename(item))
-                        if collection not in vaultcollections:
-                            if self.vault.create_collection(collection):
-                                vaultcollections.add(collection)
-                        if self.vault.create_item(item, collection, file_content):
-                            vaultitems.add(item)
+                kind, sync_to_file_default, auto = 'onlyfile', False, self.auto_delete_locally
             elif item in items_onlyvault: # item is only present in vault
-                if self.auto_create_locally:
-                    sync_to_file = True
+                kind, sync_to_file_default, auto = 'onlyvault', True, self.auto_create_locally
+            elif file_content != item_content: # item is present in local file and in vault, but the data differs
+                kind, sync_to_file_default, auto = 'update', (file_mtime < item_mtime), self.auto_update_locally
+            else:
+                files_synced[item] = file_state
+                continue
+            conflicts.append({ 'item': item, 'kind': kind, 'collection': self.get_collection_name(realm, self.get_filename(item)),
+                               'file_size': file_size, 'file_mtime': file_mtime, 'item_size': item_size, 'item_mtime': item_mtime,
+                               'default': sync_to_file_default, 'sync_to_file': True if auto else None, 'auto': auto,
+                               'filename': filename, 'file_content': file_content, 'file_state': file_state, 'item_content': item_content, 'itemdata': itemdata })
+        # Decide on all differences before changing anything
+        self.resolve_conflicts([conflict for conflict in conflicts if not conflict['auto']])
+        # Perform actions depending on current state and decision
+        for conflict in conflicts:
+            item = conflict['item']
+            filename = conflict['filename']
+            sync_to_file = conflict['sync_to_file']
+            if sync_to_file is None:
+                continue  # skip this file
+            if conflict['kind'] == 'onlyfile':
+                if sync_to_file:
+                    if delete_file(filename, with_empty_parents=True):
+                        fileitems.remove(item)
+                        self.count_operation(realm, 'file_delete')
                 else:
-                    sync_to_file = self.call_hook('onlyvault', sync_to_file=True, item=item, item_size=item_size, item_mtime=item_mtime)
-                if sync_to_file is None:
-                    pass  # skip this file
+                    collection = conflict['collection']
+                    if collection not in vaultcollections:
+                        if self.vault.create_collection(collection):
+                            vaultcollections.add(collection)
+                    if self.store_in_vault(item, collection, conflict['file_content'], None, vaultdata):
+                        vaultitems.add(item)
+                        files_synced[item] = conflict['file_state']
+                        self.count_operation(realm, 'vault_create')
+            elif conflict['kind'] == 'onlyvault':
+                if sync_to_file:
+                    if write_to_file(filename, conflict['item_content'], conflict['item_mtime']):
+                        fileitems.add(item)
+                        files_synced[item] = get_file_state(filename)
+                        self.count_operation(realm, 'file_create')
                 else:
-                    if sync_to_file:
-                        filename = self.get_filename(item, path)
-                        if write_to_file(filename, item_notes, item_mtime):
-                            fileitems.add(item)
-                    else:
-                        if self.vault.delete_item(itemdata.get('id')):
-                            vaultitems.remove(item)                        
-            else: # item is present in local file and in vault
-                if file_content != item_notes: # does the data differ?
-                    if self.auto_update_locally:
-                        sync_to_file = True
-                    else:
-                        sync_to_file = self.call_hook('update', sync_to_file=(file_mtime < item_mtime), item=item, file_size=file_size, file_mtime=file_mtime, item_size=item_size, item_mtime=item_mtime)
-                    if sync_to_file is None:
-                        pass  # skip this file
-                    else:
-                        if sync_to_file:
-                            write_to_file(filename, item_notes, item_mtime)
-                        else:
-                            self.vault.update_item(itemdata.get('id'), file_content)
+                    if self.vault.delete_item(conflict['itemdata'].get('id')):
+                        vaultitems.remove(item)                        
+                        self.delete_chunks(self.get_chunk_names(item, vaultdata), vaultdata)
+                        self.count_operation(realm, 'vault_delete')
+            else:
+                if sync_to_file:
+                    if write_to_file(filename, conflict['item_content'], conflict['item_mtime']):
+                        files_synced[item] = get_file_state(filename)
+                        self.count_operation(realm, 'file_update')
+                else:
+                    if self.store_in_vault(item, conflict['collection'], conflict['file_content'], conflict['itemdata'], vaultdata):
+                        files_synced[item] = conflict['file_state']
+                        self.count_operation(realm, 'vault_update')
+        # Delete chunk items whose item is gone (e.g. deleted using another client)
+        chunk_names_orphaned = { name for name, itemdata in vaultdata.items()
+                                 if (chunk_separator in name) and (name.partition(chunk_separator)[0] not in vaultitems) and self.is_orphan_chunk_expired(itemdata) }
+        if len(chunk_names_orphaned):
+            logger.info(f'Deleting [{len(chunk_names_orphaned)}] chunk items of deleted items')
+            self.delete_chunks(chunk_names_orphaned, vaultdata)
         # Find collections that became empty and thus can to be deleted
         if len(items_onlyfile) or len(items_onlyvault):
             vaultcollections_needed = self.get_collection_names(vaultitems)
-            for collection in (vaultcollections - vaultcollections_needed):
+            for collection in (vaultcollections_scope - vaultcollections_needed):
                 self.vault.delete_collection(collection)
+        if files_changed:
+            self.flush_filesystem(path)  # once per realm instead of once per file
+        self.set_realm_state(realm, path, vaultdata, files_synced, subpaths)
 
-    def sync_all(self):
-        """Syncs all local realms with key vault"""
+    def count_operation(self, realm, operation):
+        """Counts a successful sync operation in the metrics of this run"""
+        metrics.registry.inc('vault_sync_items_total', { 'realm': realm, 'operation': operation })
+
+    def sync_all(self, filters=None):
+        """Syncs all local realms with key vault (or just the parts selected by the given filters "<realm>[:<path>]")"""
+        scope = None if not filters else self.parse_scope(filters)
+        self.vault.reset_call_budget()
+        self.load_state()
         for realm, path in self.realms.items():
-            self.sync_folder_and_vault(realm, path)
+            if (scope is not None) and (realm not in scope):
+                continue
+            with metrics.registry.timer('vault_sync_duration_seconds', { 'realm': realm }):
+                self.sync_folder_and_vault(realm, path, None if scope is None else scope[realm])
+        self.save_state()
 
     def register_hook(self, hook, func):
         """Registers a hook function for a certain hook"""
@@ -224,9 +574,24 @@ class VaultSync():
             self.hooks['onlyvault'] = func
         elif hook == 'update':
             self.hooks['update'] = func
+        elif hook == 'resolve':
+            self.hooks['resolve'] = func
         else:
            raise ValueError('Invalid argument exception')
 
+    def resolve_conflicts(self, conflicts):
+        """Sets the decision ('sync_to_file') for each of the given differences using the registered hooks"""
+        if not len(conflicts):
+            return
+        func = self.hooks.get('resolve')
+        if func is not None:
+            func(conflicts)  # decides on all differences at once
+            return
+        for conflict in conflicts:
+            conflict['sync_to_file'] = self.call_hook(conflict['kind'], sync_to_file=conflict['default'], item=conflict['item'],
+                                                      file_size=conflict['file_size'], file_mtime=conflict['file_mtime'],
+                                                      item_size=conflict['item_size'], item_mtime=conflict['item_mtime'])
+
     def call_hook(self, hook, sync_to_file, item, file_size=None, file_mtime=None, item_size=None, item_mtime=None):
         """Calls a hook function (if defined)"""
         func = self.hooks.get(hook)
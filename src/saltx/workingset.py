@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""Class for mirroring a folder into RAM-backed storage for the duration of a run"""
+
+import atexit
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+filename_pid = '.saltx_pid'  # file in the working set directory containing the ID of the process using it
+
+
+class WorkingSet():
+
+    def __init__(self, folder_source, base_dir=None):
+        """Object initialization"""
+        self.folder_source = folder_source
+        if base_dir is None:
+            # Both locations are usually tmpfs; the runtime directory is owned by the user
+            base_dir = os.environ.get('XDG_RUNTIME_DIR', '/dev/shm')
+        self.base_dir = os.path.expanduser(base_dir)
+        self.folder_base = None  # directory created for this run
+        self.folder = None  # copy of the source folder
+        self.snapshot = dict()  # relative filename -> (mtime, size) at copy time
+
+    def get_file_stats(self, path):
+        """Returns a dictionary mapping all files within 'path' (relative to 'path') to their modification time and size"""
+        stats = dict()
+        for folder, subfolders, files in os.walk(path):
+            for file in files:
+                filename = os.path.join(folder, file)
+                file_stat = os.lstat(filename)
+                stats[os.path.relpath(filename, path)] = (file_stat.st_mtime_ns, file_stat.st_size)
+        return stats
+
+    @staticmethod
+    def is_process_running(pid):
+        """Returns whether a process with the given ID exists"""
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass  # exists, but owned by another user
+        return True
+
+    def remove_leftovers(self):
+        """Wipes working sets of the user left behind by processes no longer running (e.g. killed or crashed)"""
+        with os.scandir(self.base_dir) as entries:
+            for entry in entries:
+                if not entry.name.startswith('saltx_') or not entry.is_dir(follow_symlinks=False) or (entry.stat(follow_symlinks=False).st_uid != os.getuid()):
+                    continue
+                try:
+                    with open(os.path.join(entry.path, filename_pid), 'r') as f:
+                        pid = int(f.read())
+                except (OSError, ValueError):
+                    pid = None  # not yet written or incomplete
+                    if time.time() - entry.stat(follow_symlinks=False).st_mtime < 60:
+                        continue
+                if (pid is None) or not self.is_process_running(pid):
+                    logger.info(f'Removing RAM-backed working set [{entry.path}] left behind')
+                    shutil.rmtree(entry.path, ignore_errors=True)
+
+    def create(self):
+        """Copies the source folder into a new directory in RAM-backed storage"""
+        if not os.path.isdir(self.base_dir):
+            logger.error(f'Directory [{self.base_dir}] for RAM-backed working set does not exist')
+            return False
+        try:
+            self.remove_leftovers()
+            self.folder_base = tempfile.mkdtemp(prefix='saltx_', dir=self.base_dir)  # only accessible by the user
+            with open(os.path.join(self.folder_base, filename_pid), 'w') as f:
+                f.write(str(os.getpid()))
+            self.folder = os.path.join(self.folder_base, 'private')
+            logger.debug(f'Copying [{self.folder_source}] to RAM-backed working set [{self.folder}]')
+            shutil.copytree(self.folder_source, self.folder, symlinks=True)
+            self.snapshot = self.get_file_stats(self.folder)
+        except OSError as e:
+            logger.error(f'Creating RAM-backed working set in [{self.base_dir}] failed [{e}]')
+            self.remove()
+            return False
+        return True
+
+    def sync_back(self):
+        """Copies files that were created or changed in the working set back to the source folder and deletes files deleted in it"""
+        if self.folder is None:
+            return False
+        stats = self.get_file_stats(self.folder)
+        for filename, stat in stats.items():
+            if self.snapshot.get(filename) != stat:
+                logger.info(f'Syncing back changed file [{filename}] from RAM-backed working set')
+                target = os.path.join(self.folder_source, filename)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copy2(os.path.join(self.folder, filename), target, follow_symlinks=False)
+        for filename in self.snapshot:
+            if filename not in stats:
+                logger.info(f'Deleting file [{filename}] deleted in RAM-backed working set')
+                try:
+                    os.remove(os.path.join(self.folder_source, filename))
+                except FileNotFoundError:
+                    pass
+        return True
+
+    def remove(self):
+        """Wipes the working set"""
+        if self.folder_base is not None:
+            logger.debug(f'Removing RAM-backed working set [{self.folder_base}]')
+            shutil.rmtree(self.folder_base, ignore_errors=True)
+            self.folder_base = None
+            self.folder = None
+
+    def close(self):
+        """Syncs back changes and wipes the working set"""
+        try:
+            self.sync_back()
+        finally:
+            self.remove()
+
+    @staticmethod
+    def handle_signal(signum, frame):
+        """Exits the program so that the exit handlers run"""
+        raise SystemExit(128 + signum)
+
+    def register_auto_close(self):
+        """Registers syncing back and wiping of the working set on program exit (also when terminated by SIGTERM or SIGHUP)"""
+        atexit.register(self.close)
+        if threading.current_thread() is threading.main_thread():
+            for signum in [signal.SIGTERM, signal.SIGHUP]:
+                if signal.getsignal(signum) == signal.SIG_DFL:
+                    signal.signal(signum, self.handle_signal)